@@ -5,3 +5,4 @@ from .rgat import sparse_rgat_layer
 from .rgcn import sparse_rgcn_layer
 from .rgdcn import sparse_rgdcn_layer
 from .rgin import sparse_rgin_layer
+from .graph_structure import GraphStructure
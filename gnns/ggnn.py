@@ -2,7 +2,8 @@ from typing import List, Optional
 
 import tensorflow as tf
 
-from utils import get_gated_unit, get_aggregation_function
+from utils import get_gated_unit, get_linear_aggregation_normalizer, EdgeTypeLinearLayers
+from .graph_structure import GraphStructure
 
 
 def sparse_ggnn_layer(node_embeddings: tf.Tensor,
@@ -11,7 +12,10 @@ def sparse_ggnn_layer(node_embeddings: tf.Tensor,
                       num_timesteps: int = 1,
                       gated_unit_type: str = "gru",
                       activation_function: str = "tanh",
-                      message_aggregation_function: str = "sum"
+                      message_aggregation_function: str = "sum",
+                      message_passing_implementation: str = "gather_scatter",
+                      num_weight_bases: Optional[int] = None,
+                      graph_structure: Optional[GraphStructure] = None,
                       ) -> tf.Tensor:
     """
     Compute new graph states by neural message passing and gated units on the nodes.
@@ -43,6 +47,19 @@ def sparse_ggnn_layer(node_embeddings: tf.Tensor,
         gated_unit_type: Type of the recurrent unit used (one of RNN, GRU and LSTM).
         activation_function: Type of activation function used.
         message_aggregation_function: Type of aggregation function used for messages.
+        message_passing_implementation: Either "gather_scatter" (gather source states per
+            edge, scatter messages to targets) or "sparse_matmul" (compute A_\ell * H * W_\ell
+            using sparse adjacency matrices A_\ell; requires a linear aggregation function).
+        num_weight_bases: Optional number B of bases V_b to decompose the W_\ell into, i.e.,
+            W_\ell = \sum_b a_{\ell,b} V_b. If None, separate weights are used per edge type.
+        graph_structure: Optional GraphStructure for adjacency_lists, shared across layers.
+            If not provided, it is computed in this layer.
+
+    Note:
+        For aggregation functions that are linear in the messages (sum, mean, sqrt_n), the
+        messages are never materialised per edge if an edge type has more edges than there
+        are nodes; instead, we sum up the source states per target node and apply W_\ell
+        once per node.
 
     Returns:
         float32 tensor of shape [V, state_dim]
@@ -50,55 +67,92 @@ def sparse_ggnn_layer(node_embeddings: tf.Tensor,
     num_nodes = tf.shape(node_embeddings, out_type=tf.int32)[0]
     if state_dim is None:
         state_dim = tf.shape(node_embeddings, out_type=tf.int32)[1]
+    if graph_structure is None:
+        graph_structure = GraphStructure(adjacency_lists, num_nodes)
 
     # === Prepare things we need across all timesteps:
-    message_aggregation_fn = get_aggregation_function(message_aggregation_function)
+    aggregation_normalizer = get_linear_aggregation_normalizer(message_aggregation_function)
+    if message_passing_implementation not in ("gather_scatter", "sparse_matmul"):
+        raise ValueError("Unknown message passing implementation '%s'!" % message_passing_implementation)
+    use_sparse_matmul = message_passing_implementation == "sparse_matmul"
     gated_cell = get_gated_unit(state_dim, gated_unit_type, activation_function)
-    edge_type_to_message_transformation_layers = []  # Layers to compute the message from a source state
-    edge_type_to_message_targets = []  # List of tensors of message targets
-    # for each edge type, create a dense linear layer to project into the state dimension.
-    for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
-        edge_type_to_message_transformation_layers.append(
-            tf.keras.layers.Dense(units=state_dim,
-                                  use_bias=False,
-                                  activation=None,
-                                  name="Edge_%i_Weight" % edge_type_idx))
-        # append the column vector of targets (i.e., only the second column of the list)
-        # for the edge types to the edge_type_to_message_targets
-        edge_type_to_message_targets.append(adjacency_list_for_edge_type[:, 1])
-        # Produces row vectors of targets (i.e., [[1, 2], [1, 5]] turns to [2 5]
-
-    # Let M be the number of messages (sum of all E):
-    message_targets = tf.concat(edge_type_to_message_targets, axis=0)  # Shape [M]
-    # single row vector of all message targets
+    # for each edge type, create a dense linear layer to project into the state dimension
+    # (optionally decomposed into num_weight_bases bases shared across edge types).
+    edge_type_to_message_transformation_layers = \
+        EdgeTypeLinearLayers(num_edge_types=graph_structure.num_edge_types,
+                             units=state_dim,
+                             num_bases=num_weight_bases,
+                             name="Weight")
+    # With shared bases, linear aggregations are cheapest when summing up source states per
+    # edge type first, and then mixing them and applying the bases in a single matmul:
+    aggregate_source_states_first = \
+        use_sparse_matmul or (aggregation_normalizer is not None and num_weight_bases is not None)
 
     cur_node_states = node_embeddings
     for _ in range(num_timesteps):
-        messages = []  # list of tensors of messages of shape [E, D]
+        messages = []  # list of tensors of messages of shape [E, D] (or [V, D] if already summed up per node)
         message_source_states = []  # list of tensors of edge source states of shape [E, D]
+        if not aggregate_source_states_first and aggregation_normalizer is None and num_weight_bases is not None:
+            # Apply the bases once per node instead of once per edge:
+            edge_type_to_transformed_states = \
+                edge_type_to_message_transformation_layers.transform_all_types(cur_node_states)  # L tensors of shape [V, D]
 
         # Collect incoming messages per edge type
-        for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
-            edge_sources = adjacency_list_for_edge_type[:, 0] # Shape [E]
-            edge_source_states = tf.nn.embedding_lookup(params=cur_node_states,
-                                                        ids=edge_sources)  # Shape [E, D]
-            all_messages_for_edge_type = \
-                edge_type_to_message_transformation_layers[edge_type_idx](edge_source_states)# Shape [E,D]
+        for edge_type_idx in range(graph_structure.num_edge_types):
+            if use_sparse_matmul:
+                # Aggregation normalisation is baked into the values of the adjacency matrix:
+                messages.append(graph_structure.multiply_with_adjacency_matrix(cur_node_states,
+                                                                               edge_type_idx,
+                                                                               message_aggregation_function))  # Shape [V, D]
+                continue
+
+            if aggregate_source_states_first:
+                edge_source_states = graph_structure.gather_from_edge_sources(cur_node_states, edge_type_idx)  # Shape [E, D]
+                messages.append(graph_structure.sum_per_target(edge_source_states, edge_type_idx))  # Shape [V, D]
+                continue
+
+            if aggregation_normalizer is not None:
+                # Linear aggregation: directly compute the per-node sum of messages of this type,
+                # without necessarily computing the [E, D] messages first.
+                messages.append(
+                    graph_structure.sum_linear_messages_per_target(
+                        node_states=cur_node_states,
+                        edge_type_idx=edge_type_idx,
+                        message_transformation=lambda inputs: (
+                            edge_type_to_message_transformation_layers.transform(inputs, edge_type_idx))))  # Shape [V, D]
+                continue
+
+            edge_source_states = graph_structure.gather_from_edge_sources(cur_node_states, edge_type_idx)  # Shape [E, D]
+
+            if num_weight_bases is not None:
+                all_messages_for_edge_type = \
+                    graph_structure.gather_from_edge_sources(edge_type_to_transformed_states[edge_type_idx],
+                                                             edge_type_idx)  # Shape [E, D]
+            else:
+                all_messages_for_edge_type = \
+                    edge_type_to_message_transformation_layers.transform(edge_source_states, edge_type_idx)  # Shape [E,D]
             # This just projects the edge source states to the desired dimension through the linear layers that
-            # were added to the list abvoe on line 62.
+            # were created above.
 
             messages.append(all_messages_for_edge_type) # List of tensors of shape [E,D]
             message_source_states.append(edge_source_states) # List if tensors of shape [E,D]
 
-        messages = tf.concat(messages, axis=0)  # Shape [M, D]
-        aggregated_messages = \
-            message_aggregation_fn(data=messages,
-                                   segment_ids=message_targets,
-                                   num_segments=num_nodes)  # Shape [V, D]
-        # this function sums the node states based on message targets.
-        # thus, every node in the messages list that is to the same target will be
-        # summed together. Thus, the length of this vector is the number of
-        # nodes (or more precisely, the number of message targets).
+        if use_sparse_matmul:
+            aggregated_messages = edge_type_to_message_transformation_layers.sum_over_types(messages)  # Shape [V, D]
+        elif aggregate_source_states_first:
+            aggregated_messages = \
+                aggregation_normalizer(edge_type_to_message_transformation_layers.sum_over_types(messages),
+                                       graph_structure.num_incoming_messages)  # Shape [V, D]
+        elif aggregation_normalizer is not None:
+            aggregated_messages = aggregation_normalizer(tf.add_n(messages),
+                                                         graph_structure.num_incoming_messages)  # Shape [V, D]
+        else:
+            aggregated_messages = \
+                graph_structure.aggregate_messages_per_type(messages, message_aggregation_function)  # Shape [V, D]
+            # this function sums the node states based on message targets.
+            # thus, every node in the messages list that is to the same target will be
+            # summed together. Thus, the length of this vector is the number of
+            # nodes (or more precisely, the number of message targets).
 
         # pass updated vertex features into RNN cell
         # first parameter is the input (shape [batch, feature] in this case [V, D].
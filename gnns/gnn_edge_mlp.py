@@ -1,7 +1,8 @@
 from typing import List, Optional
 import tensorflow as tf
 
-from utils import get_activation, get_aggregation_function, SMALL_NUMBER, MLP
+from utils import get_activation, MLP
+from .graph_structure import GraphStructure
 
 
 def sparse_gnn_edge_mlp_layer(
@@ -14,7 +15,8 @@ def sparse_gnn_edge_mlp_layer(
         message_aggregation_function: str = "sum",
         normalize_by_num_incoming: bool = False,
         use_target_state_as_input: bool = True,
-        num_edge_hidden_layers: int = 1
+        num_edge_hidden_layers: int = 1,
+        graph_structure: Optional[GraphStructure] = None,
         ) -> tf.Tensor:
     """
     Compute new graph states by neural message passing using an edge MLP.
@@ -56,6 +58,8 @@ def sparse_gnn_edge_mlp_layer(
         num_edge_hidden_layers: Number of hidden layers of the edge MLP.
         message_weights_dropout_ratio: Dropout ratio applied to the weights used
             to compute message passing functions.
+        graph_structure: Optional GraphStructure for adjacency_lists, shared across layers.
+            If not provided, it is computed in this layer.
 
     Returns:
         float32 tensor of shape [V, state_dim]
@@ -63,57 +67,51 @@ def sparse_gnn_edge_mlp_layer(
     num_nodes = tf.shape(node_embeddings, out_type=tf.int32)[0]
     if state_dim is None:
         state_dim = tf.shape(node_embeddings, out_type=tf.int32)[1]
+    if graph_structure is None:
+        graph_structure = GraphStructure(adjacency_lists, num_nodes, type_to_num_incoming_edges)
 
     # === Prepare things we need across all timesteps:
     activation_fn = get_activation(activation_function)
-    message_aggregation_fn = get_aggregation_function(message_aggregation_function)
     edge_type_to_edge_mlp = []  # MLPs to compute the edge messages
-    edge_type_to_message_targets = []  # List of tensors of message targets
-    for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
+    for edge_type_idx in range(graph_structure.num_edge_types):
         edge_type_to_edge_mlp.append(
             MLP(out_size=state_dim,
                 hidden_layers=num_edge_hidden_layers,
                 activation_fun=tf.nn.elu,
                 name="Edge_%i_MLP" % edge_type_idx))
-        edge_type_to_message_targets.append(adjacency_list_for_edge_type[:, 1])
-
-    # Let M be the number of messages (sum of all E):
-    message_targets = tf.concat(edge_type_to_message_targets, axis=0)  # Shape [M]
 
     cur_node_states = node_embeddings
     for _ in range(num_timesteps):
         messages_per_type = []  # list of tensors of messages of shape [E, D]
         # Collect incoming messages per edge type
-        for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
-            edge_sources = adjacency_list_for_edge_type[:, 0]
-            edge_targets = adjacency_list_for_edge_type[:, 1]
-            edge_source_states = \
-                tf.nn.embedding_lookup(params=cur_node_states,
-                                       ids=edge_sources)  # Shape [E, D]
-
-            edge_mlp_inputs = edge_source_states
-            if use_target_state_as_input:
-                edge_target_states = \
-                    tf.nn.embedding_lookup(params=cur_node_states,
-                                           ids=edge_targets)  # Shape [E, D]
-                edge_mlp_inputs = tf.concat([edge_source_states, edge_target_states],
-                                            axis=1)  # Shape [E, 2*D]
-
-            messages = edge_type_to_edge_mlp[edge_type_idx](edge_mlp_inputs)  # Shape [E, D]
+        for edge_type_idx in range(graph_structure.num_edge_types):
+            edge_sources = graph_structure.edge_sources[edge_type_idx]
+            edge_targets = graph_structure.edge_targets[edge_type_idx]
+            if graph_structure.is_self_loop_edge_type(edge_type_idx):
+                # Self-loops have exactly one message per node, so no gathering is needed:
+                if use_target_state_as_input:
+                    edge_mlp_inputs = tf.concat([cur_node_states, cur_node_states], axis=1)  # Shape [V, 2*D]
+                else:
+                    edge_mlp_inputs = cur_node_states  # Shape [V, D]
+                messages = edge_type_to_edge_mlp[edge_type_idx](edge_mlp_inputs)  # Shape [V, D]
+            elif use_target_state_as_input:
+                # Avoid materialising the [E, 2*D] edge MLP inputs by splitting the first MLP layer:
+                messages = edge_type_to_edge_mlp[edge_type_idx].call_with_split_input(
+                    input_parts=[cur_node_states, cur_node_states],
+                    part_indices=[edge_sources, edge_targets])  # Shape [E, D]
+            else:
+                edge_source_states = graph_structure.gather_from_edge_sources(cur_node_states, edge_type_idx)  # Shape [E, D]
+                messages = edge_type_to_edge_mlp[edge_type_idx](edge_source_states)  # Shape [E, D]
 
             if normalize_by_num_incoming:
-                per_message_num_incoming_edges = \
-                    tf.nn.embedding_lookup(params=type_to_num_incoming_edges[edge_type_idx, :],
-                                           ids=edge_targets)  # Shape [E, H]
-                messages = tf.expand_dims(1.0 / (per_message_num_incoming_edges + SMALL_NUMBER), axis=-1) * messages
+                messages = \
+                    tf.expand_dims(graph_structure.get_edge_inverse_num_incoming_edges(edge_type_idx), axis=-1) \
+                    * messages  # Shape [E, D]
+            messages = activation_fn(messages)  # Shape [E, D]  (Apply nonlinearity to Edge-MLP outputs as well)
             messages_per_type.append(messages)
 
-        all_messages = tf.concat(messages_per_type, axis=0)  # Shape [M, D]
-        all_messages = activation_fn(all_messages)  # Shape [M, D]  (Apply nonlinearity to Edge-MLP outputs as well)
         aggregated_messages = \
-            message_aggregation_fn(data=all_messages,
-                                   segment_ids=message_targets,
-                                   num_segments=num_nodes)  # Shape [V, D]
+            graph_structure.aggregate_messages_per_type(messages_per_type, message_aggregation_function)  # Shape [V, D]
 
         new_node_states = aggregated_messages
         new_node_states = tf.contrib.layers.layer_norm(new_node_states)
@@ -2,7 +2,8 @@ from typing import List, Optional
 import tensorflow as tf
 
 
-from utils import get_activation, get_aggregation_function, SMALL_NUMBER
+from utils import get_activation, EdgeTypeLinearLayers
+from .graph_structure import GraphStructure
 
 
 def sparse_gnn_film_layer(node_embeddings: tf.Tensor,
@@ -13,6 +14,8 @@ def sparse_gnn_film_layer(node_embeddings: tf.Tensor,
                           activation_function: Optional[str] = "ReLU",
                           message_aggregation_function: str = "sum",
                           normalize_by_num_incoming: bool = False,
+                          num_weight_bases: Optional[int] = None,
+                          graph_structure: Optional[GraphStructure] = None,
                           ) -> tf.Tensor:
     """
     Compute new graph states by neural message passing modulated by the target state.
@@ -51,6 +54,11 @@ def sparse_gnn_film_layer(node_embeddings: tf.Tensor,
         message_aggregation_function: Type of aggregation function used for messages.
         normalize_by_num_incoming: Flag indicating if messages should be scaled by 1/(number
             of incoming edges).
+        num_weight_bases: Optional number B of bases to decompose the W_\ell and the
+            F_{\ell,\alpha}, F_{\ell,\beta} into, i.e., W_\ell = \sum_b a_{\ell,b} V_b. If None,
+            separate weights are used per edge type.
+        graph_structure: Optional GraphStructure for adjacency_lists, shared across layers.
+            If not provided, it is computed in this layer.
 
     Returns:
         float32 tensor of shape [V, state_dim]
@@ -58,62 +66,60 @@ def sparse_gnn_film_layer(node_embeddings: tf.Tensor,
     num_nodes = tf.shape(node_embeddings, out_type=tf.int32)[0]
     if state_dim is None:
         state_dim = tf.shape(node_embeddings, out_type=tf.int32)[1]
+    if graph_structure is None:
+        graph_structure = GraphStructure(adjacency_lists, num_nodes, type_to_num_incoming_edges)
 
     # === Prepare things we need across all timesteps:
     activation_fn = get_activation(activation_function)
-    message_aggregation_fn = get_aggregation_function(message_aggregation_function)
-    edge_type_to_message_transformation_layers = []  # Layers to compute the message from a source state
-    edge_type_to_film_computation_layers = []  # Layers to compute the \beta/\gamma weights for FiLM
-    edge_type_to_message_targets = []  # List of tensors of message targets
-    for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
-        edge_type_to_message_transformation_layers.append(
-            tf.keras.layers.Dense(units=state_dim,
-                                  use_bias=False,
-                                  activation=None,  # Activation only after FiLM modulation
-                                  name="Edge_%i_Weight" % edge_type_idx))
-        edge_type_to_film_computation_layers.append(
-            tf.keras.layers.Dense(units=2 * state_dim,  # Computes \gamma, \beta in one go
-                                  use_bias=False,
-                                  activation=None,
-                                  name="Edge_%i_FiLM_Computations" % edge_type_idx))
-        edge_type_to_message_targets.append(adjacency_list_for_edge_type[:, 1])
-
-    # Let M be the number of messages (sum of all E):
-    message_targets = tf.concat(edge_type_to_message_targets, axis=0)  # Shape [M]
+    # Layers to compute the message from a source state (activation only after FiLM modulation):
+    edge_type_to_message_transformation_layers = \
+        EdgeTypeLinearLayers(num_edge_types=graph_structure.num_edge_types,
+                             units=state_dim,
+                             num_bases=num_weight_bases,
+                             name="Weight")
+    # Layers to compute the \beta/\gamma weights for FiLM (computes \gamma, \beta in one go):
+    edge_type_to_film_computation_layers = \
+        EdgeTypeLinearLayers(num_edge_types=graph_structure.num_edge_types,
+                             units=2 * state_dim,
+                             num_bases=num_weight_bases,
+                             name="FiLM_Computations")
 
     cur_node_states = node_embeddings
     for _ in range(num_timesteps):
         messages_per_type = []  # list of tensors of messages of shape [E, D]
+        edge_type_to_film_weights = \
+            edge_type_to_film_computation_layers.transform_all_types(cur_node_states)  # L tensors of shape [V, 2*D]
+        if num_weight_bases is not None:
+            # Apply the bases once per node instead of once per edge:
+            edge_type_to_transformed_states = \
+                edge_type_to_message_transformation_layers.transform_all_types(cur_node_states)  # L tensors of shape [V, D]
         # Collect incoming messages per edge type
-        for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
-            edge_sources = adjacency_list_for_edge_type[:, 0]
-            edge_targets = adjacency_list_for_edge_type[:, 1]
-            edge_source_states = \
-                tf.nn.embedding_lookup(params=cur_node_states,
-                                       ids=edge_sources)  # Shape [E, D]
-            messages = edge_type_to_message_transformation_layers[edge_type_idx](edge_source_states)  # Shape [E, D]
+        for edge_type_idx in range(graph_structure.num_edge_types):
+            if num_weight_bases is not None:
+                messages = graph_structure.gather_from_edge_sources(edge_type_to_transformed_states[edge_type_idx],
+                                                                    edge_type_idx)  # Shape [E, D]
+            else:
+                edge_source_states = \
+                    graph_structure.gather_from_edge_sources(cur_node_states, edge_type_idx)  # Shape [E, D]
+                messages = \
+                    edge_type_to_message_transformation_layers.transform(edge_source_states, edge_type_idx)  # Shape [E, D]
 
             if normalize_by_num_incoming:
-                per_message_num_incoming_edges = \
-                    tf.nn.embedding_lookup(params=type_to_num_incoming_edges[edge_type_idx, :],
-                                           ids=edge_targets)  # Shape [E, H]
-                messages = tf.expand_dims(1.0 / (per_message_num_incoming_edges + SMALL_NUMBER), axis=-1) * messages
+                messages = \
+                    tf.expand_dims(graph_structure.get_edge_inverse_num_incoming_edges(edge_type_idx), axis=-1) \
+                    * messages  # Shape [E, D]
 
-            film_weights = edge_type_to_film_computation_layers[edge_type_idx](cur_node_states)
+            film_weights = edge_type_to_film_weights[edge_type_idx]  # Shape [V, 2*D]
             per_message_film_weights = \
-                tf.nn.embedding_lookup(params=film_weights, ids=edge_targets)
+                graph_structure.gather_from_edge_targets(film_weights, edge_type_idx)  # Shape [E, 2*D]
             per_message_film_gamma_weights = per_message_film_weights[:, :state_dim]  # Shape [E, D]
             per_message_film_beta_weights = per_message_film_weights[:, state_dim:]  # Shape [E, D]
 
             modulated_messages = per_message_film_gamma_weights * messages + per_message_film_beta_weights
-            messages_per_type.append(modulated_messages)
+            messages_per_type.append(activation_fn(modulated_messages))  # Shape [E, D]
 
-        all_messages = tf.concat(messages_per_type, axis=0)  # Shape [M, D]
-        all_messages = activation_fn(all_messages)  # Shape [M, D]
         aggregated_messages = \
-            message_aggregation_fn(data=all_messages,
-                                   segment_ids=message_targets,
-                                   num_segments=num_nodes)  # Shape [V, D]
+            graph_structure.aggregate_messages_per_type(messages_per_type, message_aggregation_function)  # Shape [V, D]
         new_node_states = aggregated_messages
         # new_node_states = activation_fn(new_node_states)
 
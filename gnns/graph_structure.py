@@ -0,0 +1,613 @@
+from typing import Callable, Dict, List, Optional
+
+import tensorflow as tf
+
+from utils import get_aggregation_function, get_linear_aggregation_normalizer, sum_linear_messages_per_target, \
+    SMALL_NUMBER
+
+
+class GraphStructure(object):
+    """
+    Information about the structure of a (batched) graph that is shared by all GNN layers.
+    Creating this once per batch (instead of once in every GNN layer) avoids re-computing
+    concatenations of edge targets, slices of the adjacency lists, and normalisation
+    coefficients in every layer.
+
+    We use the following abbreviations in shape descriptions:
+    * V: number of nodes
+    * G: number of graphs
+    * L: number of different edge types
+    * E: number of edges of a given edge type
+    * S: number of global node edges of a given edge type
+    * M: number of messages (sum of all E)
+
+    One edge type can be declared to be the self-loop edge type, connecting every node
+    to itself. Its adjacency list is never read (and so does not need to be fed), and
+    layers use gather_from_edge_sources/gather_from_edge_targets/sum_per_target to
+    evaluate it directly on the [V, D] node states, without any gather/scatter ops.
+
+    Similarly, edge types can be declared to be the reverse of another edge type. Their
+    adjacency lists are created by flipping the edges of the original type, and so do not
+    need to be fed either.
+
+    Finally, edge types can connect nodes to the global node of their graph, given only as
+    the list of (source) nodes with such an edge. These edges are never materialised as
+    adjacency lists: messages to the global nodes are aggregated per graph and written to
+    the global nodes, and messages from the global nodes (along the reverse edge type) are
+    gathered from the global node states. Edge values of such a type hold the E values of
+    the edges in its adjacency list, followed by the S values of its global node edges.
+    """
+    def __init__(self,
+                 adjacency_lists: List[tf.Tensor],
+                 num_nodes: tf.Tensor,
+                 type_to_num_incoming_edges: Optional[tf.Tensor] = None,
+                 sort_messages_by_target: bool = False,
+                 accumulate_messages_per_type: bool = False,
+                 self_loop_edge_type_idx: Optional[int] = None,
+                 reverse_edge_types: Optional[Dict[int, int]] = None,
+                 global_node_edge_sources: Optional[Dict[int, tf.Tensor]] = None,
+                 graph_nodes_list: Optional[tf.Tensor] = None,
+                 global_node_ids: Optional[tf.Tensor] = None,
+                 ):
+        """
+        Arguments:
+            adjacency_lists: List of L adjacency lists, represented as int32 tensors of shape
+                [E, 2]. Concretely, adjacency_lists[l][k,:] == [v, u] means that the k-th edge
+                of type l connects node v to node u.
+            num_nodes: int32 scalar, the number of nodes V.
+            type_to_num_incoming_edges: Optional float32 tensor of shape [L, V] representing
+                the number of incoming edges of a given type. Concretely,
+                type_to_num_incoming_edges[l, v] is the number of edge of type l connecting
+                to node v. Required for per-edge-type normalisation.
+            sort_messages_by_target: Flag indicating if messages should be aggregated by sorted
+                segment operations, using a permutation of messages that sorts them by target.
+            accumulate_messages_per_type: Flag indicating if messages given per edge type
+                should be aggregated per edge type and accumulated, instead of aggregating
+                the concatenation of all messages (see aggregate_messages_per_type).
+            self_loop_edge_type_idx: Optional index of an edge type that connects each node
+                to itself. Its entries in adjacency_lists and type_to_num_incoming_edges are
+                ignored.
+            reverse_edge_types: Optional map from edge types to the edge type they are the
+                reverse of. Their entries in adjacency_lists and type_to_num_incoming_edges
+                are ignored.
+            global_node_edge_sources: Optional map from edge types to int32 tensors of shape
+                [S], holding the nodes that have an edge of that type to the global node of
+                their graph (in addition to the edges in adjacency_lists). The reverse edge
+                types of these types get the corresponding edges from the global nodes.
+            graph_nodes_list: int32 tensor of shape [V], mapping nodes to their graph.
+                Required for global_node_edge_sources.
+            global_node_ids: int32 tensor of shape [G], the global node of each graph.
+                Required for global_node_edge_sources.
+        """
+        self.__num_nodes = num_nodes
+        self.__sort_messages_by_target = sort_messages_by_target
+        self.__accumulate_messages_per_type = accumulate_messages_per_type
+        self.__self_loop_edge_type_idx = self_loop_edge_type_idx
+        self.__global_node_ids = global_node_ids
+        self.__num_graphs = None  # type: Optional[tf.Tensor]
+        # Map from edge types to the nodes with a global node edge and their graphs (both of shape [S]):
+        self.__global_node_edges = {}  # type: Dict[int, tuple]
+        self.__edge_types_to_global_nodes = set()  # Types of edges pointing to the global nodes (not from them)
+        self.__num_adjacency_list_edges = {}  # type: Dict[int, tf.Tensor]  # E of types with global node edges
+
+        with tf.name_scope("graph_structure"):
+            # Create the edges that are not fed in, and their numbers of incoming edges:
+            adjacency_lists = list(adjacency_lists)
+            edge_type_to_num_incoming_edges = {}  # type: Dict[int, tf.Tensor]
+            if self_loop_edge_type_idx is not None:
+                node_ids = tf.range(num_nodes, dtype=tf.int32)  # Shape [V]
+                adjacency_lists[self_loop_edge_type_idx] = tf.stack([node_ids, node_ids], axis=1)  # Shape [V, 2]
+                edge_type_to_num_incoming_edges[self_loop_edge_type_idx] = tf.ones(shape=[num_nodes])  # Shape [V]
+            for (reverse_edge_type_idx, edge_type_idx) in sorted((reverse_edge_types or {}).items()):
+                assert edge_type_idx not in reverse_edge_types, \
+                    "Edge type %i cannot be the reverse of a reverse edge type" % reverse_edge_type_idx
+                reverse_adjacency_list = tf.reverse(adjacency_lists[edge_type_idx], axis=[1])  # Shape [E, 2]
+                adjacency_lists[reverse_edge_type_idx] = reverse_adjacency_list
+                edge_type_to_num_incoming_edges[reverse_edge_type_idx] = \
+                    tf.unsorted_segment_sum(data=tf.ones_like(reverse_adjacency_list[:, 1], dtype=tf.float32),
+                                            segment_ids=reverse_adjacency_list[:, 1],
+                                            num_segments=num_nodes)  # Shape [V]
+            self.__edge_sources = [adjacency_list[:, 0] for adjacency_list in adjacency_lists]  # L tensors of shape [E]
+            self.__edge_targets = [adjacency_list[:, 1] for adjacency_list in adjacency_lists]  # L tensors of shape [E]
+
+            # Add the edges to and from global nodes, which are only given by their (non-global) node:
+            if global_node_edge_sources:
+                assert graph_nodes_list is not None and global_node_ids is not None, \
+                    "Global node edges require graph_nodes_list and global_node_ids"
+                self.__num_graphs = tf.shape(global_node_ids, out_type=tf.int32)[0]
+            for (edge_type_idx, edge_type_sources) in sorted((global_node_edge_sources or {}).items()):
+                edge_type_graphs = tf.gather(params=graph_nodes_list, indices=edge_type_sources)  # Shape [S]
+                self.__global_node_edges[edge_type_idx] = (edge_type_sources, edge_type_graphs)
+                self.__edge_types_to_global_nodes.add(edge_type_idx)
+            for (reverse_edge_type_idx, edge_type_idx) in sorted((reverse_edge_types or {}).items()):
+                if edge_type_idx in self.__global_node_edges:
+                    self.__global_node_edges[reverse_edge_type_idx] = self.__global_node_edges[edge_type_idx]
+            for (edge_type_idx, (edge_type_nodes, edge_type_graphs)) in sorted(self.__global_node_edges.items()):
+                self.__num_adjacency_list_edges[edge_type_idx] = \
+                    tf.shape(self.__edge_targets[edge_type_idx], out_type=tf.int32)[0]
+                edge_type_global_nodes = tf.gather(params=global_node_ids, indices=edge_type_graphs)  # Shape [S]
+                if edge_type_idx in self.__edge_types_to_global_nodes:
+                    (global_edge_sources, global_edge_targets) = (edge_type_nodes, edge_type_global_nodes)
+                    num_incoming_global_node_edges = \
+                        self.pool_to_global_nodes(tf.ones_like(edge_type_nodes, dtype=tf.float32), edge_type_idx)  # Shape [V]
+                else:
+                    (global_edge_sources, global_edge_targets) = (edge_type_global_nodes, edge_type_nodes)
+                    num_incoming_global_node_edges = \
+                        tf.unsorted_segment_sum(data=tf.ones_like(edge_type_nodes, dtype=tf.float32),
+                                                segment_ids=edge_type_nodes,
+                                                num_segments=num_nodes)  # Shape [V]
+                self.__edge_sources[edge_type_idx] = \
+                    tf.concat([self.__edge_sources[edge_type_idx], global_edge_sources], axis=0)  # Shape [E + S]
+                self.__edge_targets[edge_type_idx] = \
+                    tf.concat([self.__edge_targets[edge_type_idx], global_edge_targets], axis=0)  # Shape [E + S]
+                if type_to_num_incoming_edges is not None:
+                    edge_type_to_num_incoming_edges[edge_type_idx] = \
+                        edge_type_to_num_incoming_edges.get(edge_type_idx, type_to_num_incoming_edges[edge_type_idx]) \
+                        + num_incoming_global_node_edges
+
+            if type_to_num_incoming_edges is not None and len(edge_type_to_num_incoming_edges) > 0:
+                type_to_num_incoming_edges = \
+                    tf.stack([edge_type_to_num_incoming_edges.get(edge_type_idx,
+                                                                  type_to_num_incoming_edges[edge_type_idx])
+                              for edge_type_idx in range(len(adjacency_lists))],
+                             axis=0)  # Shape [L, V]
+            self.__adjacency_lists = adjacency_lists
+            self.__type_to_num_incoming_edges = type_to_num_incoming_edges
+            self.__message_sources = tf.concat(self.__edge_sources, axis=0)  # Shape [M]
+            self.__message_targets = tf.concat(self.__edge_targets, axis=0)  # Shape [M]
+            num_edges_per_type = tf.stack([tf.shape(edge_targets, out_type=tf.int32)[0]
+                                           for edge_targets in self.__edge_targets])  # Shape [L]
+            self.__type_offsets = tf.concat([tf.zeros(shape=[1], dtype=tf.int32),
+                                             tf.cumsum(num_edges_per_type)],
+                                            axis=0)  # Shape [L + 1]
+            self.__num_incoming_messages = \
+                tf.unsorted_segment_sum(data=tf.ones_like(self.__message_targets, dtype=tf.float32),
+                                        segment_ids=self.__message_targets,
+                                        num_segments=num_nodes)  # Shape [V]
+
+        # Things that are only computed on demand (but then shared across all layers):
+        self.__type_to_inverse_num_incoming_edges = None  # type: Optional[tf.Tensor]
+        self.__type_to_edge_inverse_num_incoming_edges = {}  # type: Dict[int, tf.Tensor]
+        self.__message_target_sort_permutation = None  # type: Optional[tf.Tensor]
+        self.__adjacency_matrices = {}  # type: Dict[tuple, tf.SparseTensor]
+
+    @property
+    def num_edge_types(self) -> int:
+        return len(self.__adjacency_lists)
+
+    @property
+    def num_nodes(self) -> tf.Tensor:
+        """int32 scalar, the number of nodes V."""
+        return self.__num_nodes
+
+    @property
+    def adjacency_lists(self) -> List[tf.Tensor]:
+        """L int32 tensors of shape [E, 2] (without global node edges)."""
+        return self.__adjacency_lists
+
+    @property
+    def type_to_num_incoming_edges(self) -> Optional[tf.Tensor]:
+        """float32 tensor of shape [L, V]."""
+        return self.__type_to_num_incoming_edges
+
+    @property
+    def self_loop_edge_type_idx(self) -> Optional[int]:
+        """Index of the edge type connecting each node to itself, if any."""
+        return self.__self_loop_edge_type_idx
+
+    def is_self_loop_edge_type(self, edge_type_idx: int) -> bool:
+        return edge_type_idx == self.__self_loop_edge_type_idx
+
+    def is_global_node_edge_type(self, edge_type_idx: int) -> bool:
+        """True iff edges of this type connect nodes to (or from) the global node of their graph."""
+        return edge_type_idx in self.__global_node_edges
+
+    @property
+    def edge_sources(self) -> List[tf.Tensor]:
+        """L int32 tensors of shape [E (+ S)], the source node of each edge of a type."""
+        return self.__edge_sources
+
+    @property
+    def edge_targets(self) -> List[tf.Tensor]:
+        """L int32 tensors of shape [E (+ S)], the target node of each edge of a type."""
+        return self.__edge_targets
+
+    @property
+    def message_sources(self) -> tf.Tensor:
+        """int32 tensor of shape [M], the concatenation of all edge sources."""
+        return self.__message_sources
+
+    @property
+    def message_targets(self) -> tf.Tensor:
+        """int32 tensor of shape [M], the concatenation of all edge targets."""
+        return self.__message_targets
+
+    @property
+    def type_offsets(self) -> tf.Tensor:
+        """
+        int32 tensor of shape [L + 1]. Messages of edge type l are at indices
+        type_offsets[l]:type_offsets[l+1] of message_sources/message_targets.
+        """
+        return self.__type_offsets
+
+    @property
+    def num_incoming_messages(self) -> tf.Tensor:
+        """float32 tensor of shape [V], the number of incoming edges (of all types) per node."""
+        return self.__num_incoming_messages
+
+    @property
+    def type_to_inverse_num_incoming_edges(self) -> tf.Tensor:
+        """float32 tensor of shape [L, V], holding 1/(number of incoming edges of type l)."""
+        if self.__type_to_inverse_num_incoming_edges is None:
+            assert self.__type_to_num_incoming_edges is not None, \
+                "Normalisation by number of incoming edges requires type_to_num_incoming_edges"
+            with tf.name_scope("graph_structure"):
+                self.__type_to_inverse_num_incoming_edges = \
+                    1.0 / (self.__type_to_num_incoming_edges + SMALL_NUMBER)
+        return self.__type_to_inverse_num_incoming_edges
+
+    def get_edge_inverse_num_incoming_edges(self, edge_type_idx: int) -> tf.Tensor:
+        """
+        Returns:
+            float32 tensor of shape [E], holding 1/(number of incoming edges of the same type
+            at the target) for each edge of type edge_type_idx.
+        """
+        if edge_type_idx not in self.__type_to_edge_inverse_num_incoming_edges:
+            with tf.name_scope("graph_structure"):
+                self.__type_to_edge_inverse_num_incoming_edges[edge_type_idx] = \
+                    self.gather_from_edge_targets(self.type_to_inverse_num_incoming_edges[edge_type_idx, :],
+                                                  edge_type_idx)
+        return self.__type_to_edge_inverse_num_incoming_edges[edge_type_idx]
+
+    def gather_from_global_nodes(self, node_values: tf.Tensor, edge_type_idx: int) -> tf.Tensor:
+        """
+        Arguments:
+            node_values: tensor of shape [V, ...].
+            edge_type_idx: Index of an edge type l with global node edges.
+
+        Returns:
+            tensor of shape [S, ...], holding the values of the global node of each global
+            node edge of type l.
+        """
+        (_, edge_type_graphs) = self.__global_node_edges[edge_type_idx]
+        global_node_values = tf.gather(params=node_values, indices=self.__global_node_ids)  # Shape [G, ...]
+        return tf.gather(params=global_node_values, indices=edge_type_graphs)
+
+    def pool_to_global_nodes(self,
+                             edge_values: tf.Tensor,
+                             edge_type_idx: int,
+                             segment_aggregation_fn: Callable = tf.unsorted_segment_sum,
+                             ) -> tf.Tensor:
+        """
+        Arguments:
+            edge_values: tensor of shape [S, ...], one entry per global node edge of type l.
+            edge_type_idx: Index of an edge type l with edges to the global nodes.
+            segment_aggregation_fn: Segment function used to aggregate the values, i.e.,
+                tf.unsorted_segment_sum or tf.unsorted_segment_max.
+
+        Returns:
+            tensor of shape [V, ...], holding the aggregated values of all global node edges
+            of a graph at its global node.
+        """
+        (_, edge_type_graphs) = self.__global_node_edges[edge_type_idx]
+        graph_values = segment_aggregation_fn(data=edge_values,
+                                              segment_ids=edge_type_graphs,
+                                              num_segments=self.__num_graphs)  # Shape [G, ...]
+        return segment_aggregation_fn(data=graph_values,
+                                      segment_ids=self.__global_node_ids,
+                                      num_segments=self.__num_nodes)
+
+    def gather_from_edge_sources(self, node_values: tf.Tensor, edge_type_idx: int) -> tf.Tensor:
+        """
+        Arguments:
+            node_values: tensor of shape [V, ...].
+            edge_type_idx: Index of the edge type l.
+
+        Returns:
+            tensor of shape [E (+ S), ...], holding the values of the source of each edge of type l.
+        """
+        if self.is_self_loop_edge_type(edge_type_idx):
+            return node_values
+        if edge_type_idx in self.__global_node_edges and edge_type_idx not in self.__edge_types_to_global_nodes:
+            return tf.concat([tf.nn.embedding_lookup(params=node_values,
+                                                     ids=self.__adjacency_lists[edge_type_idx][:, 0]),
+                              self.gather_from_global_nodes(node_values, edge_type_idx)],
+                             axis=0)
+        return tf.nn.embedding_lookup(params=node_values, ids=self.__edge_sources[edge_type_idx])
+
+    def gather_from_edge_targets(self, node_values: tf.Tensor, edge_type_idx: int) -> tf.Tensor:
+        """
+        Arguments:
+            node_values: tensor of shape [V, ...].
+            edge_type_idx: Index of the edge type l.
+
+        Returns:
+            tensor of shape [E (+ S), ...], holding the values of the target of each edge of type l.
+        """
+        if self.is_self_loop_edge_type(edge_type_idx):
+            return node_values
+        if edge_type_idx in self.__edge_types_to_global_nodes:
+            return tf.concat([tf.nn.embedding_lookup(params=node_values,
+                                                     ids=self.__adjacency_lists[edge_type_idx][:, 1]),
+                              self.gather_from_global_nodes(node_values, edge_type_idx)],
+                             axis=0)
+        return tf.nn.embedding_lookup(params=node_values, ids=self.__edge_targets[edge_type_idx])
+
+    def __aggregate_per_target(self,
+                               edge_values: tf.Tensor,
+                               edge_type_idx: int,
+                               segment_aggregation_fn: Callable,
+                               accumulation_fn: Callable,
+                               ) -> tf.Tensor:
+        """
+        Aggregate edge values of type l (given as in gather_from_edge_sources) per target node,
+        pooling the values of edges to global nodes per graph.
+
+        Returns:
+            tensor of shape [V, ...]
+        """
+        if self.is_self_loop_edge_type(edge_type_idx):
+            return edge_values  # Already one value per node
+        if edge_type_idx not in self.__global_node_edges:
+            return segment_aggregation_fn(data=edge_values,
+                                          segment_ids=self.__edge_targets[edge_type_idx],
+                                          num_segments=self.__num_nodes)
+
+        num_adjacency_list_edges = self.__num_adjacency_list_edges[edge_type_idx]
+        global_node_edge_values = edge_values[num_adjacency_list_edges:]  # Shape [S, ...]
+        if edge_type_idx in self.__edge_types_to_global_nodes:
+            aggregated_global_node_edge_values = \
+                self.pool_to_global_nodes(global_node_edge_values, edge_type_idx, segment_aggregation_fn)
+        else:
+            (edge_type_nodes, _) = self.__global_node_edges[edge_type_idx]
+            aggregated_global_node_edge_values = segment_aggregation_fn(data=global_node_edge_values,
+                                                                        segment_ids=edge_type_nodes,
+                                                                        num_segments=self.__num_nodes)
+        aggregated_adjacency_list_edge_values = \
+            segment_aggregation_fn(data=edge_values[:num_adjacency_list_edges],
+                                   segment_ids=self.__adjacency_lists[edge_type_idx][:, 1],
+                                   num_segments=self.__num_nodes)
+        return accumulation_fn(aggregated_adjacency_list_edge_values, aggregated_global_node_edge_values)
+
+    def sum_per_target(self, edge_values: tf.Tensor, edge_type_idx: int) -> tf.Tensor:
+        """
+        Arguments:
+            edge_values: float32 tensor of shape [E (+ S), ...], one entry per edge of type l.
+            edge_type_idx: Index of the edge type l.
+
+        Returns:
+            float32 tensor of shape [V, ...], holding the sum of the values of all incoming
+            edges of type l for each node.
+        """
+        return self.__aggregate_per_target(edge_values, edge_type_idx, tf.unsorted_segment_sum, tf.add)
+
+    def sum_linear_messages_per_target(self,
+                                       node_states: tf.Tensor,
+                                       edge_type_idx: int,
+                                       message_transformation: Callable[[tf.Tensor], tf.Tensor],
+                                       target_scaling_factors: Optional[tf.Tensor] = None,
+                                       ) -> tf.Tensor:
+        """
+        Compute \sum_{(u, v) \in A_\ell} c_v * (W * h_u) for all nodes v, where W is a linear map
+        (see utils.sum_linear_messages_per_target). For global node edges, W is applied once per
+        graph: to the sum of the source states of a graph for edges to its global node, and to
+        the global node state for edges from it.
+
+        Arguments:
+            node_states: float32 tensor of shape [V, D], the states h of all nodes.
+            edge_type_idx: Index of the edge type l.
+            message_transformation: Linear function (without bias) mapping [N, D] to [N, H].
+            target_scaling_factors: Optional float32 tensor of shape [V], holding the factors c_v.
+
+        Returns:
+            float32 tensor of shape [V, H]
+        """
+        if self.is_self_loop_edge_type(edge_type_idx):
+            # Self-loops have exactly one message per node, so this is a plain dense layer:
+            aggregated_messages = message_transformation(node_states)  # Shape [V, H]
+        else:
+            adjacency_list = self.__adjacency_lists[edge_type_idx]
+            aggregated_messages = \
+                sum_linear_messages_per_target(node_states=node_states,
+                                               edge_sources=adjacency_list[:, 0],
+                                               edge_targets=adjacency_list[:, 1],
+                                               num_nodes=self.__num_nodes,
+                                               message_transformation=message_transformation)  # Shape [V, H]
+        if edge_type_idx in self.__edge_types_to_global_nodes:
+            (edge_type_nodes, edge_type_graphs) = self.__global_node_edges[edge_type_idx]
+            graph_source_state_sums = \
+                tf.unsorted_segment_sum(data=tf.gather(params=node_states, indices=edge_type_nodes),
+                                        segment_ids=edge_type_graphs,
+                                        num_segments=self.__num_graphs)  # Shape [G, D]
+            aggregated_messages += tf.unsorted_segment_sum(data=message_transformation(graph_source_state_sums),
+                                                           segment_ids=self.__global_node_ids,
+                                                           num_segments=self.__num_nodes)  # Shape [V, H]
+        elif edge_type_idx in self.__global_node_edges:
+            (edge_type_nodes, edge_type_graphs) = self.__global_node_edges[edge_type_idx]
+            global_node_messages = \
+                message_transformation(tf.gather(params=node_states, indices=self.__global_node_ids))  # Shape [G, H]
+            aggregated_messages += \
+                tf.unsorted_segment_sum(data=tf.gather(params=global_node_messages, indices=edge_type_graphs),
+                                        segment_ids=edge_type_nodes,
+                                        num_segments=self.__num_nodes)  # Shape [V, H]
+        if target_scaling_factors is not None:
+            aggregated_messages *= tf.expand_dims(target_scaling_factors, axis=-1)
+        return aggregated_messages
+
+    @property
+    def message_target_sort_permutation(self) -> tf.Tensor:
+        """int32 tensor of shape [M], a (stable) permutation sorting all messages by their target."""
+        if self.__message_target_sort_permutation is None:
+            with tf.name_scope("graph_structure"):
+                self.__message_target_sort_permutation = \
+                    tf.argsort(self.__message_targets, stable=True)
+        return self.__message_target_sort_permutation
+
+    def __get_target_factors(self,
+                             edge_type_idx: int,
+                             aggregation_function: str,
+                             normalize_by_num_incoming: bool,
+                             ) -> tf.Tensor:
+        """
+        Returns:
+            float32 tensor of shape [V], holding the factor by which the sum of incoming
+            messages of type l is scaled for each node (see get_adjacency_matrix).
+        """
+        aggregation_normalizer = get_linear_aggregation_normalizer(aggregation_function)
+        if aggregation_normalizer is None:
+            raise ValueError("Aggregation function '%s' cannot be expressed as sparse matrix product!"
+                             % aggregation_function)
+        # Apply the aggregation normaliser to a column of ones to get the per-target factors:
+        target_factors = \
+            aggregation_normalizer(tf.ones(shape=[self.__num_nodes, 1]),
+                                   self.__num_incoming_messages)[:, 0]  # Shape [V]
+        if normalize_by_num_incoming:
+            target_factors *= self.type_to_inverse_num_incoming_edges[edge_type_idx, :]
+        return target_factors
+
+    def get_adjacency_matrix(self,
+                             edge_type_idx: int,
+                             aggregation_function: str = "sum",
+                             normalize_by_num_incoming: bool = False,
+                             ) -> tf.SparseTensor:
+        """
+        Get the adjacency matrix A_\ell of an edge type as sparse tensor, such that
+        tf.sparse.sparse_dense_matmul(A_\ell, H) aggregates the states H of the edge sources
+        per target node. Normalisation for the aggregation function (e.g., 1/(number of
+        incoming messages) for mean) and by the number of incoming edges of this type is
+        baked into the values of the matrix.
+        Global node edges are not part of the matrix (see multiply_with_adjacency_matrix).
+
+        Arguments:
+            edge_type_idx: Index of the edge type l.
+            aggregation_function: Name of a linear aggregation function (sum, mean, sqrt_n).
+            normalize_by_num_incoming: Flag indicating if entries should be scaled by
+                1/(number of incoming edges of type l).
+
+        Returns:
+            float32 sparse tensor of shape [V, V], with A[v, u] != 0 iff (u, v) is an edge.
+        """
+        key = (edge_type_idx, aggregation_function, normalize_by_num_incoming)
+        if key not in self.__adjacency_matrices:
+            edge_sources = self.__adjacency_lists[edge_type_idx][:, 0]
+            edge_targets = self.__adjacency_lists[edge_type_idx][:, 1]
+            with tf.name_scope("graph_structure"):
+                target_factors = \
+                    self.__get_target_factors(edge_type_idx, aggregation_function, normalize_by_num_incoming)  # Shape [V]
+                edge_values = tf.gather(params=target_factors, indices=edge_targets)  # Shape [E]
+                num_nodes = tf.cast(self.__num_nodes, dtype=tf.int64)
+                self.__adjacency_matrices[key] = \
+                    tf.SparseTensor(indices=tf.cast(tf.stack([edge_targets, edge_sources], axis=1), dtype=tf.int64),
+                                    values=edge_values,
+                                    dense_shape=tf.stack([num_nodes, num_nodes]))
+        return self.__adjacency_matrices[key]
+
+    def multiply_with_adjacency_matrix(self,
+                                       node_values: tf.Tensor,
+                                       edge_type_idx: int,
+                                       aggregation_function: str = "sum",
+                                       normalize_by_num_incoming: bool = False,
+                                       ) -> tf.Tensor:
+        """
+        Compute A_\ell * H for the adjacency matrix A_\ell of get_adjacency_matrix, adding the
+        contribution of global node edges by aggregating per graph (for edges to the global
+        nodes) or by gathering from the global nodes (for edges from them).
+
+        Arguments:
+            node_values: float32 tensor of shape [V, D], the states H.
+            edge_type_idx: Index of the edge type l.
+            aggregation_function: Name of a linear aggregation function (sum, mean, sqrt_n).
+            normalize_by_num_incoming: Flag indicating if results should be scaled by
+                1/(number of incoming edges of type l).
+
+        Returns:
+            float32 tensor of shape [V, D]
+        """
+        adjacency_matrix = self.get_adjacency_matrix(edge_type_idx, aggregation_function, normalize_by_num_incoming)
+        aggregated_values = tf.sparse.sparse_dense_matmul(adjacency_matrix, node_values)  # Shape [V, D]
+        if edge_type_idx not in self.__global_node_edges:
+            return aggregated_values
+
+        (edge_type_nodes, _) = self.__global_node_edges[edge_type_idx]
+        if edge_type_idx in self.__edge_types_to_global_nodes:
+            global_node_edge_sums = \
+                self.pool_to_global_nodes(tf.gather(params=node_values, indices=edge_type_nodes), edge_type_idx)
+        else:
+            global_node_edge_sums = \
+                tf.unsorted_segment_sum(data=self.gather_from_global_nodes(node_values, edge_type_idx),
+                                        segment_ids=edge_type_nodes,
+                                        num_segments=self.__num_nodes)  # Shape [V, D]
+        target_factors = self.__get_target_factors(edge_type_idx, aggregation_function, normalize_by_num_incoming)
+        return aggregated_values + tf.expand_dims(target_factors, axis=-1) * global_node_edge_sums
+
+    def aggregate_messages(self, messages: tf.Tensor, aggregation_function: str) -> tf.Tensor:
+        """
+        Aggregate messages (one per edge, ordered as message_targets) per target node.
+
+        Arguments:
+            messages: float32 tensor of shape [M, D].
+            aggregation_function: Name of the aggregation function, see
+                utils.get_aggregation_function.
+
+        Returns:
+            float32 tensor of shape [V, D]
+        """
+        sorted_aggregation_fn = {
+            'sum': tf.sparse.segment_sum,
+            'unsorted_segment_sum': tf.sparse.segment_sum,
+            'mean': tf.sparse.segment_mean,
+            'unsorted_segment_mean': tf.sparse.segment_mean,
+            'sqrt_n': tf.sparse.segment_sqrt_n,
+            'unsorted_segment_sqrt_n': tf.sparse.segment_sqrt_n,
+        }.get(aggregation_function)
+        if self.__sort_messages_by_target and sorted_aggregation_fn is not None:
+            # Sparse segment ops gather and reduce in one go, using that the segments are sorted:
+            message_permutation = self.message_target_sort_permutation
+            return sorted_aggregation_fn(data=messages,
+                                         indices=message_permutation,
+                                         segment_ids=tf.gather(self.__message_targets, message_permutation),
+                                         num_segments=self.__num_nodes)
+        message_aggregation_fn = get_aggregation_function(aggregation_function)
+        return message_aggregation_fn(data=messages,
+                                      segment_ids=self.__message_targets,
+                                      num_segments=self.__num_nodes)
+
+    def aggregate_messages_per_type(self, per_type_messages: List[tf.Tensor], aggregation_function: str) -> tf.Tensor:
+        """
+        Aggregate messages (one list entry per edge type, ordered as edge_targets) per target node.
+        If accumulate_messages_per_type is set, the messages of each edge type are aggregated
+        into a [V, D] accumulator directly (which works as sum, mean and sqrt_n can be computed
+        from per-node sums and counts, and max from per-type maxima). This avoids creating
+        the [M, D] concatenation of all messages, so that peak memory scales with the largest
+        edge type instead of with M. Messages are always accumulated like this if there are
+        global node edges, so that messages to global nodes can be aggregated per graph.
+
+        Arguments:
+            per_type_messages: List of L float32 tensors of shape [E (+ S), D].
+            aggregation_function: Name of the aggregation function, see
+                utils.get_aggregation_function.
+
+        Returns:
+            float32 tensor of shape [V, D]
+        """
+        if not self.__accumulate_messages_per_type and len(self.__global_node_edges) == 0:
+            return self.aggregate_messages(tf.concat(per_type_messages, axis=0), aggregation_function)
+
+        aggregation_normalizer = get_linear_aggregation_normalizer(aggregation_function)
+        if aggregation_normalizer is None:  # max
+            segment_aggregation_fn, accumulation_fn = tf.unsorted_segment_max, tf.maximum
+        else:
+            segment_aggregation_fn, accumulation_fn = tf.unsorted_segment_sum, tf.add
+
+        aggregated_messages = None  # type: Optional[tf.Tensor]
+        for (edge_type_idx, messages) in enumerate(per_type_messages):
+            aggregated_type_messages = \
+                self.__aggregate_per_target(messages, edge_type_idx, segment_aggregation_fn, accumulation_fn)  # Shape [V, D]
+            if aggregated_messages is None:
+                aggregated_messages = aggregated_type_messages
+            else:
+                aggregated_messages = accumulation_fn(aggregated_messages, aggregated_type_messages)
+
+        if aggregation_normalizer is not None:
+            aggregated_messages = aggregation_normalizer(aggregated_messages, self.__num_incoming_messages)
+        return aggregated_messages
@@ -3,7 +3,8 @@ from typing import List, Optional
 import tensorflow as tf
 from dpu_utils.tfutils import unsorted_segment_log_softmax
 
-from utils import get_activation
+from utils import get_activation, EdgeTypeLinearLayers
+from .graph_structure import GraphStructure
 
 
 def sparse_rgat_layer(node_embeddings: tf.Tensor,
@@ -11,7 +12,9 @@ def sparse_rgat_layer(node_embeddings: tf.Tensor,
                       state_dim: Optional[int],
                       num_heads: int = 4,
                       num_timesteps: int = 1,
-                      activation_function: Optional[str] = "tanh"
+                      activation_function: Optional[str] = "tanh",
+                      num_weight_bases: Optional[int] = None,
+                      graph_structure: Optional[GraphStructure] = None,
                       ) -> tf.Tensor:
     """
     Compute new graph states by neural message passing using attention. This generalises
@@ -51,6 +54,10 @@ def sparse_rgat_layer(node_embeddings: tf.Tensor,
         num_heads: Number of attention heads to use.
         num_timesteps: Number of repeated applications of this message passing layer.
         activation_function: Type of activation function used.
+        num_weight_bases: Optional number B of bases V_b to decompose the W_\ell into, i.e.,
+            W_\ell = \sum_b a_{\ell,b} V_b. If None, separate weights are used per edge type.
+        graph_structure: Optional GraphStructure for adjacency_lists, shared across layers.
+            If not provided, it is computed in this layer.
 
     Returns:
         float32 tensor of shape [V, state_dim]
@@ -59,25 +66,25 @@ def sparse_rgat_layer(node_embeddings: tf.Tensor,
     if state_dim is None:
         state_dim = tf.shape(node_embeddings, out_type=tf.int32)[1]
     per_head_dim = state_dim // num_heads
+    if graph_structure is None:
+        graph_structure = GraphStructure(adjacency_lists, num_nodes)
 
     # === Prepare things we need across all timesteps:
     activation_fn = get_activation(activation_function)
-    edge_type_to_state_transformation_layers = []  # Layers to compute the message from a source state
+    # Layers to compute the message from a source state (optionally decomposed into shared bases):
+    edge_type_to_state_transformation_layers = \
+        EdgeTypeLinearLayers(num_edge_types=graph_structure.num_edge_types,
+                             units=state_dim,
+                             num_bases=num_weight_bases,
+                             name="Weight")
     edge_type_to_attention_parameters = []  # Parameters for the attention mechanism
-    edge_type_to_message_targets = []  # List of tensors of message targets
-    for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
-        edge_type_to_state_transformation_layers.append(
-            tf.keras.layers.Dense(units=state_dim,
-                                  use_bias=False,
-                                  activation=None,
-                                  name="Edge_%i_Weight" % edge_type_idx))
+    for edge_type_idx in range(graph_structure.num_edge_types):
         edge_type_to_attention_parameters.append(
             tf.get_variable(shape=(2 * state_dim),
                             name="Edge_%i_Attention_Parameters" % edge_type_idx))
-        edge_type_to_message_targets.append(adjacency_list_for_edge_type[:, 1])
 
     # Let M be the number of messages (sum of all E):
-    message_targets = tf.concat(edge_type_to_message_targets, axis=0)  # Shape [M]
+    message_targets = graph_structure.message_targets  # Shape [M]
 
     cur_node_states = node_embeddings
     for _ in range(num_timesteps):
@@ -88,17 +95,15 @@ def sparse_rgat_layer(node_embeddings: tf.Tensor,
         # Note:
         #  We compute the state transformations (to make use of the wider, faster matrix multiplication),
         #  and then split into the individual attention heads via some reshapes:
-        for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
-            edge_sources = adjacency_list_for_edge_type[:, 0]
-            edge_targets = adjacency_list_for_edge_type[:, 1]
-
-            transformed_states = \
-                edge_type_to_state_transformation_layers[edge_type_idx](cur_node_states)  # Shape [V, D]
+        edge_type_to_transformed_states = \
+            edge_type_to_state_transformation_layers.transform_all_types(cur_node_states)  # L tensors of shape [V, D]
+        for edge_type_idx in range(graph_structure.num_edge_types):
+            transformed_states = edge_type_to_transformed_states[edge_type_idx]  # Shape [V, D]
 
             edge_transformed_source_states = \
-                tf.nn.embedding_lookup(params=transformed_states, ids=edge_sources)  # Shape [E, D]
+                graph_structure.gather_from_edge_sources(transformed_states, edge_type_idx)  # Shape [E, D]
             edge_transformed_target_states = \
-                tf.nn.embedding_lookup(params=transformed_states, ids=edge_targets)  # Shape [E, D]
+                graph_structure.gather_from_edge_targets(transformed_states, edge_type_idx)  # Shape [E, D]
 
             per_edge_per_head_transformed_source_states = \
                 tf.reshape(edge_transformed_source_states, shape=(-1, num_heads, per_head_dim))
@@ -2,7 +2,8 @@ from typing import List, Optional
 
 import tensorflow as tf
 
-from utils import get_activation, get_aggregation_function, SMALL_NUMBER
+from utils import get_activation, get_linear_aggregation_normalizer, EdgeTypeLinearLayers
+from .graph_structure import GraphStructure
 
 
 def sparse_rgcn_layer(node_embeddings: tf.Tensor,
@@ -14,12 +15,16 @@ def sparse_rgcn_layer(node_embeddings: tf.Tensor,
                       message_aggregation_function: str = "sum",
                       normalize_by_num_incoming: bool = True,
                       use_both_source_and_target: bool = False,
+                      message_passing_implementation: str = "gather_scatter",
+                      num_weight_bases: Optional[int] = None,
+                      graph_structure: Optional[GraphStructure] = None,
                       ) -> tf.Tensor:
     """
     Compute new graph states by neural message passing.
     This implements the R-GCN model (Schlichtkrull et al., https://arxiv.org/pdf/1703.06103.pdf)
-    for the case of few relations / edge types, i.e., we do not use the dimensionality-reduction
-    tricks from section 2.2 of that paper.
+    for the case of few relations / edge types, i.e., by default we do not use the
+    dimensionality-reduction tricks from section 2.2 of that paper (but basis decomposition
+    can be enabled via num_weight_bases).
     For this, we assume existing node states h^t_v and a list of per-edge-type adjacency
     matrices A_\ell.
 
@@ -53,6 +58,23 @@ def sparse_rgcn_layer(node_embeddings: tf.Tensor,
         message_aggregation_function: Type of aggregation function used for messages.
         normalize_by_num_incoming: Flag indicating if messages should be scaled by 1/(number
             of incoming edges).
+        use_both_source_and_target: Flag indicating if messages should be computed from
+            both the source and the target state (True) or only the source state (False).
+        message_passing_implementation: Either "gather_scatter" (gather source states per
+            edge, scatter messages to targets) or "sparse_matmul" (compute A_\ell * H * W_\ell
+            using sparse adjacency matrices A_\ell with the normalisation 1/c_{v,\ell} baked
+            in; requires a linear aggregation function and use_both_source_and_target=False).
+        num_weight_bases: Optional number B of bases V_b to decompose the W_\ell into, i.e.,
+            W_\ell = \sum_b a_{\ell,b} V_b (Sect. 2.2 of the R-GCN paper). If None, separate
+            weights are used per edge type.
+        graph_structure: Optional GraphStructure for adjacency_lists, shared across layers.
+            If not provided, it is computed in this layer.
+
+    Note:
+        If use_both_source_and_target is False and the aggregation function is linear in the
+        messages (sum, mean, sqrt_n), the messages are never materialised per edge if an edge
+        type has more edges than there are nodes; instead, we sum up the source states per
+        target node and apply W_\ell once per node.
 
     Returns:
         float32 tensor of shape [V, state_dim]
@@ -60,56 +82,112 @@ def sparse_rgcn_layer(node_embeddings: tf.Tensor,
     num_nodes = tf.shape(node_embeddings, out_type=tf.int32)[0]
     if state_dim is None:
         state_dim = tf.shape(node_embeddings, out_type=tf.int32)[1]
+    if graph_structure is None:
+        graph_structure = GraphStructure(adjacency_lists, num_nodes, type_to_num_incoming_edges)
 
     # === Prepare things we need across all timesteps:
     activation_fn = get_activation(activation_function)
-    message_aggregation_fn = get_aggregation_function(message_aggregation_function)
-    edge_type_to_message_transformation_layers = []  # Layers to compute the message from a source state
-    edge_type_to_message_targets = []  # List of tensors of message targets
-    for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
-        edge_type_to_message_transformation_layers.append(
-            tf.keras.layers.Dense(units=state_dim,
-                                  use_bias=False,
-                                  activation=None,
-                                  name="Edge_%i_Weight" % edge_type_idx))
-        edge_type_to_message_targets.append(adjacency_list_for_edge_type[:, 1])
-
-    # Let M be the number of messages (sum of all E):
-    message_targets = tf.concat(edge_type_to_message_targets, axis=0)  # Shape [M]
+    if use_both_source_and_target:
+        aggregation_normalizer = None  # Messages depend on the target state as well
+    else:
+        aggregation_normalizer = get_linear_aggregation_normalizer(message_aggregation_function)
+    if message_passing_implementation not in ("gather_scatter", "sparse_matmul"):
+        raise ValueError("Unknown message passing implementation '%s'!" % message_passing_implementation)
+    use_sparse_matmul = message_passing_implementation == "sparse_matmul"
+    if use_sparse_matmul and use_both_source_and_target:
+        raise ValueError("Sparse matrix multiplication cannot be used with use_both_source_and_target!")
+    # Layers to compute the message from a source state (optionally decomposed into shared bases):
+    edge_type_to_message_transformation_layers = \
+        EdgeTypeLinearLayers(num_edge_types=graph_structure.num_edge_types,
+                             units=state_dim,
+                             num_bases=num_weight_bases,
+                             name="Weight")
+    # With shared bases, linear aggregations are cheapest when summing up source states per
+    # edge type first, and then mixing them and applying the bases in a single matmul:
+    aggregate_source_states_first = \
+        use_sparse_matmul or (aggregation_normalizer is not None and num_weight_bases is not None)
 
     cur_node_states = node_embeddings
     for _ in range(num_timesteps):
-        messages_per_type = []  # list of tensors of messages of shape [E, H]
+        messages_per_type = []  # list of tensors of messages of shape [E, H] (or [V, H] if already summed up per node)
+        if not aggregate_source_states_first and aggregation_normalizer is None \
+                and num_weight_bases is not None and not use_both_source_and_target:
+            # Apply the bases once per node instead of once per edge:
+            edge_type_to_transformed_states = \
+                edge_type_to_message_transformation_layers.transform_all_types(cur_node_states)  # L tensors of shape [V, H]
+
         # Collect incoming messages per edge type
-        for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
-            edge_sources = adjacency_list_for_edge_type[:, 0]
-            edge_targets = adjacency_list_for_edge_type[:, 1]
-            edge_source_states = \
-                tf.nn.embedding_lookup(params=cur_node_states,
-                                       ids=edge_sources)  # Shape [E, H]
+        for edge_type_idx in range(graph_structure.num_edge_types):
+            if use_sparse_matmul:
+                # Normalisation is baked into the values of the adjacency matrix:
+                messages_per_type.append(
+                    graph_structure.multiply_with_adjacency_matrix(cur_node_states,
+                                                                   edge_type_idx,
+                                                                   message_aggregation_function,
+                                                                   normalize_by_num_incoming))  # Shape [V, H]
+                continue
+
+            if aggregation_normalizer is not None:
+                # Linear aggregation: directly compute the per-node sum of messages of this type,
+                # without necessarily computing the [E, H] messages first.
+                if normalize_by_num_incoming:
+                    target_scaling_factors = \
+                        graph_structure.type_to_inverse_num_incoming_edges[edge_type_idx, :]  # Shape [V]
+                else:
+                    target_scaling_factors = None
+
+                if aggregate_source_states_first:
+                    edge_source_states = \
+                        graph_structure.gather_from_edge_sources(cur_node_states, edge_type_idx)  # Shape [E, H]
+                    aggregated_source_states = graph_structure.sum_per_target(edge_source_states, edge_type_idx)  # Shape [V, H]
+                    if target_scaling_factors is not None:
+                        aggregated_source_states *= tf.expand_dims(target_scaling_factors, axis=-1)
+                    messages_per_type.append(aggregated_source_states)
+                    continue
+
+                messages_per_type.append(
+                    graph_structure.sum_linear_messages_per_target(
+                        node_states=cur_node_states,
+                        edge_type_idx=edge_type_idx,
+                        message_transformation=lambda inputs: (
+                            edge_type_to_message_transformation_layers.transform(inputs, edge_type_idx)),
+                        target_scaling_factors=target_scaling_factors))  # Shape [V, H]
+                continue
+
+            edge_source_states = graph_structure.gather_from_edge_sources(cur_node_states, edge_type_idx)  # Shape [E, H]
 
             if use_both_source_and_target:
-                edge_target_states = \
-                    tf.nn.embedding_lookup(params=cur_node_states,
-                                           ids=edge_targets)  # Shape [E, H]
+                edge_target_states = graph_structure.gather_from_edge_targets(cur_node_states, edge_type_idx)  # Shape [E, H]
                 edge_state_pairs = tf.concat([edge_source_states, edge_target_states], axis=-1)  # Shape [E, 2H]
-                messages = edge_type_to_message_transformation_layers[edge_type_idx](edge_state_pairs)  # Shape [E, H]
+                messages = \
+                    edge_type_to_message_transformation_layers.transform(edge_state_pairs, edge_type_idx)  # Shape [E, H]
+            elif num_weight_bases is not None:
+                messages = graph_structure.gather_from_edge_sources(edge_type_to_transformed_states[edge_type_idx],
+                                                                    edge_type_idx)  # Shape [E, H]
             else:
-                messages = edge_type_to_message_transformation_layers[edge_type_idx](edge_source_states)  # Shape [E, H]
+                messages = \
+                    edge_type_to_message_transformation_layers.transform(edge_source_states, edge_type_idx)  # Shape [E, H]
 
             if normalize_by_num_incoming:
-                num_incoming_to_node_per_message = \
-                    tf.nn.embedding_lookup(params=type_to_num_incoming_edges[edge_type_idx, :],
-                                           ids=edge_targets)  # Shape [E, H]
-                messages = tf.expand_dims(1.0 / (num_incoming_to_node_per_message + SMALL_NUMBER), axis=-1) * messages
+                messages = \
+                    tf.expand_dims(graph_structure.get_edge_inverse_num_incoming_edges(edge_type_idx), axis=-1) \
+                    * messages  # Shape [E, H]
 
             messages_per_type.append(messages)
 
-        cur_messages = tf.concat(messages_per_type, axis=0)  # Shape [M, H]
-        aggregated_messages = \
-            message_aggregation_fn(data=cur_messages,
-                                   segment_ids=message_targets,
-                                   num_segments=num_nodes)  # Shape [V, H]
+        if use_sparse_matmul:
+            aggregated_messages = edge_type_to_message_transformation_layers.sum_over_types(messages_per_type)  # Shape [V, H]
+        elif aggregate_source_states_first:
+            aggregated_messages = \
+                aggregation_normalizer(edge_type_to_message_transformation_layers.sum_over_types(messages_per_type),
+                                       graph_structure.num_incoming_messages)  # Shape [V, H]
+        elif aggregation_normalizer is not None:
+            aggregated_messages = aggregation_normalizer(tf.add_n(messages_per_type),
+                                                         graph_structure.num_incoming_messages)  # Shape [V, H]
+        else:
+            aggregated_messages = \
+                graph_structure.aggregate_messages_per_type(messages_per_type,
+                                                            message_aggregation_function)  # Shape [V, H]
 
         new_node_states = activation_fn(aggregated_messages)  # Shape [V, H]
         cur_node_states = new_node_states
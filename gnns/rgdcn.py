@@ -2,7 +2,8 @@ from typing import List, Optional
 
 import tensorflow as tf
 
-from utils import get_activation, get_aggregation_function, SMALL_NUMBER
+from utils import get_activation, get_linear_aggregation_normalizer
+from .graph_structure import GraphStructure
 
 
 def sparse_rgdcn_layer(node_embeddings: tf.Tensor,
@@ -16,6 +17,7 @@ def sparse_rgdcn_layer(node_embeddings: tf.Tensor,
                        activation_function: Optional[str] = "tanh",
                        message_aggregation_function: str = "sum",
                        normalize_by_num_incoming: bool = True,
+                       graph_structure: Optional[GraphStructure] = None,
                        ) -> tf.Tensor:
     """
     Compute new graph states by message passing using dynamic convolutions for edge kernels.
@@ -79,19 +81,29 @@ def sparse_rgdcn_layer(node_embeddings: tf.Tensor,
         message_aggregation_function: Type of aggregation function used for messages.
         normalize_by_num_incoming: Flag indicating if messages should be scaled by 1/(number
             of incoming edges).
+        graph_structure: Optional GraphStructure for adjacency_lists, shared across layers.
+            If not provided, it is computed in this layer.
+
+    Note:
+        As the edge kernels W^t_{\ell,v,c} only depend on the target node, aggregation functions
+        that are linear in the messages (sum, mean, sqrt_n) are computed by first summing up the
+        source states per target node, and then applying the per-node kernels. This avoids
+        materialising per-edge kernels of shape [E, K, K]. Other aggregation functions (max)
+        use per-edge kernels.
 
     Returns:
         float32 tensor of shape [V, D]
     """
     num_nodes = tf.shape(node_embeddings, out_type=tf.int32)[0]
+    if graph_structure is None:
+        graph_structure = GraphStructure(adjacency_lists, num_nodes, type_to_num_incoming_edges)
 
     # === Prepare things we need across all timesteps:
     activation_fn = get_activation(activation_function)
-    message_aggregation_fn = get_aggregation_function(message_aggregation_function)
+    aggregation_normalizer = get_linear_aggregation_normalizer(message_aggregation_function)
     edge_type_to_channel_to_weight_computation_layers = []  # Layers to compute the dynamic computation weights
-    edge_type_to_message_targets = []  # List of tensors of message targets
 
-    for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
+    for edge_type_idx in range(graph_structure.num_edge_types):
         channel_to_weight_computation_layers = []
         for channel in range(num_channels):
             if channel == 0 or not(tie_channel_weights):
@@ -107,11 +119,6 @@ def sparse_rgdcn_layer(node_embeddings: tf.Tensor,
                     channel_to_weight_computation_layers[-1])
         edge_type_to_channel_to_weight_computation_layers.append(channel_to_weight_computation_layers)
 
-        edge_type_to_message_targets.append(adjacency_list_for_edge_type[:, 1])
-
-    # Let M be the number of messages (sum of all E):
-    message_targets = tf.concat(edge_type_to_message_targets, axis=0)  # Shape [M]
-
     cur_node_states = node_embeddings  # Shape [V, D]
     for _ in range(num_timesteps):
         node_states_chunked = tf.reshape(cur_node_states,
@@ -120,15 +127,12 @@ def sparse_rgdcn_layer(node_embeddings: tf.Tensor,
         new_node_states_chunked = []  # type: List[tf.Tensor]  # C tensors of shape [V, K]
         for channel_idx in range(num_channels):
             cur_channel_node_states = node_states_chunked[:, channel_idx, :]  # shape [V, K]
-            cur_channel_message_per_type = []  # list of tensors of messages of shape [E, K]
+            cur_channel_message_per_type = []  # list of tensors of messages of shape [E, K] (or [V, K] if aggregated)
 
             # Collect incoming messages per edge type
-            for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
-                edge_sources = adjacency_list_for_edge_type[:, 0]
-                edge_targets = adjacency_list_for_edge_type[:, 1]
+            for edge_type_idx in range(graph_structure.num_edge_types):
                 edge_source_states = \
-                    tf.nn.embedding_lookup(params=cur_channel_node_states,
-                                           ids=edge_sources)  # Shape [E, K]
+                    graph_structure.gather_from_edge_sources(cur_channel_node_states, edge_type_idx)  # Shape [E, K]
 
                 if use_full_state_for_channel_weights:
                     weight_computation_input = cur_node_states
@@ -139,24 +143,37 @@ def sparse_rgdcn_layer(node_embeddings: tf.Tensor,
                 weight_compute_layer = edge_type_to_channel_to_weight_computation_layers[edge_type_idx][channel_idx]
                 edge_weights = weight_compute_layer(weight_computation_input)  # Shape [V, K*K]
                 edge_weights = tf.reshape(edge_weights, shape=(-1, channel_dim, channel_dim))  # Shape [V, K, K]
-                edge_weights_for_targets = \
-                    tf.nn.embedding_lookup(params=edge_weights, ids=edge_targets)  # Shape [E, K, K]
 
-                # Matrix multiply between edge_source_states[v] and edge_weights_for_targets[v]:
-                messages = tf.einsum('vi,vij->vj', edge_source_states, edge_weights_for_targets)  # Shape [E, K]
-                if normalize_by_num_incoming:
-                    num_incoming_to_node_per_message = \
-                        tf.nn.embedding_lookup(params=type_to_num_incoming_edges[edge_type_idx, :],
-                                               ids=edge_targets)  # Shape [E]
-                    messages = tf.expand_dims(1.0 / (num_incoming_to_node_per_message + SMALL_NUMBER), axis=-1) * messages
+                if aggregation_normalizer is not None:
+                    # Sum up source states per target first, then apply the per-target weights:
+                    aggregated_source_states = \
+                        graph_structure.sum_per_target(edge_source_states, edge_type_idx)  # Shape [V, K]
+                    if normalize_by_num_incoming:
+                        aggregated_source_states = \
+                            tf.expand_dims(graph_structure.type_to_inverse_num_incoming_edges[edge_type_idx, :], axis=-1) \
+                            * aggregated_source_states
+                    messages = tf.einsum('vi,vij->vj', aggregated_source_states, edge_weights)  # Shape [V, K]
+                else:
+                    edge_weights_for_targets = \
+                        graph_structure.gather_from_edge_targets(edge_weights, edge_type_idx)  # Shape [E, K, K]
+
+                    # Matrix multiply between edge_source_states[v] and edge_weights_for_targets[v]:
+                    messages = tf.einsum('vi,vij->vj', edge_source_states, edge_weights_for_targets)  # Shape [E, K]
+                    if normalize_by_num_incoming:
+                        messages = \
+                            tf.expand_dims(graph_structure.get_edge_inverse_num_incoming_edges(edge_type_idx), axis=-1) \
+                            * messages  # Shape [E, K]
 
                 cur_channel_message_per_type.append(messages)
 
-            cur_channel_messages = tf.concat(cur_channel_message_per_type, axis=0)  # Shape [M, K]
-            cur_channel_aggregated_incoming_messages = \
-                message_aggregation_fn(data=cur_channel_messages,
-                                       segment_ids=message_targets,
-                                       num_segments=num_nodes)  # Shape [V, K]
+            if aggregation_normalizer is not None:
+                cur_channel_aggregated_incoming_messages = \
+                    aggregation_normalizer(tf.add_n(cur_channel_message_per_type),
+                                           graph_structure.num_incoming_messages)  # Shape [V, K]
+            else:
+                cur_channel_aggregated_incoming_messages = \
+                    graph_structure.aggregate_messages_per_type(cur_channel_message_per_type,
+                                                                message_aggregation_function)  # Shape [V, K]
             cur_channel_aggregated_incoming_messages = activation_fn(cur_channel_aggregated_incoming_messages)
 
             new_node_states_chunked.append(cur_channel_aggregated_incoming_messages)
@@ -1,7 +1,8 @@
 from typing import List, Optional
 import tensorflow as tf
 
-from utils import get_activation, get_aggregation_function, MLP
+from utils import get_activation, MLP
+from .graph_structure import GraphStructure
 
 
 def sparse_rgin_layer(
@@ -14,6 +15,7 @@ def sparse_rgin_layer(
         use_target_state_as_input: bool = False,
         num_edge_MLP_hidden_layers: Optional[int] = 1,
         num_aggr_MLP_hidden_layers: Optional[int] = None,
+        graph_structure: Optional[GraphStructure] = None,
         ) -> tf.Tensor:
     """
     Compute new graph states by neural message passing using MLPs for state updates
@@ -62,6 +64,8 @@ def sparse_rgin_layer(
         num_aggr_MLP_hidden_layers: Number of hidden layers of the MLPs used on the
             aggregation of messages from neighbouring nodes. If none, the aggregated messages
             are used directly.
+        graph_structure: Optional GraphStructure for adjacency_lists, shared across layers.
+            If not provided, it is computed in this layer.
 
     Returns:
         float32 tensor of shape [V, state_dim]
@@ -69,10 +73,11 @@ def sparse_rgin_layer(
     num_nodes = tf.shape(node_embeddings, out_type=tf.int32)[0]
     if state_dim is None:
         state_dim = tf.shape(node_embeddings, out_type=tf.int32)[1]
+    if graph_structure is None:
+        graph_structure = GraphStructure(adjacency_lists, num_nodes)
 
     # === Prepare things we need across all timesteps:
     activation_fn = get_activation(activation_function)
-    message_aggregation_fn = get_aggregation_function(message_aggregation_function)
 
     if num_aggr_MLP_hidden_layers is not None:
         aggregation_MLP = MLP(out_size=state_dim,
@@ -86,51 +91,47 @@ def sparse_rgin_layer(
         edge_type_to_edge_mlp = []  # type: Optional[List[MLP]]  # MLPs to compute the edge messages
     else:
         edge_type_to_edge_mlp = None
-    edge_type_to_message_targets = []  # List of tensors of message targets
-    for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
+    for edge_type_idx in range(graph_structure.num_edge_types):
         if edge_type_to_edge_mlp is not None and num_edge_MLP_hidden_layers is not None:
             edge_type_to_edge_mlp.append(
                 MLP(out_size=state_dim,
                     hidden_layers=num_edge_MLP_hidden_layers,
                     activation_fun=activation_fn,
                     name="Edge_%i_MLP" % edge_type_idx))
-        edge_type_to_message_targets.append(adjacency_list_for_edge_type[:, 1])
-
-    # Let M be the number of messages (sum of all E):
-    message_targets = tf.concat(edge_type_to_message_targets, axis=0)  # Shape [M]
 
     cur_node_states = node_embeddings
     for _ in range(num_timesteps):
         messages_per_type = []  # list of tensors of messages of shape [E, D]
         # Collect incoming messages per edge type
-        for edge_type_idx, adjacency_list_for_edge_type in enumerate(adjacency_lists):
-            edge_sources = adjacency_list_for_edge_type[:, 0]
-            edge_targets = adjacency_list_for_edge_type[:, 1]
-            edge_source_states = \
-                tf.nn.embedding_lookup(params=cur_node_states,
-                                       ids=edge_sources)  # Shape [E, D]
+        for edge_type_idx in range(graph_structure.num_edge_types):
+            edge_sources = graph_structure.edge_sources[edge_type_idx]
+            edge_targets = graph_structure.edge_targets[edge_type_idx]
+            if use_target_state_as_input and edge_type_to_edge_mlp is not None \
+                    and not graph_structure.is_self_loop_edge_type(edge_type_idx):
+                # Avoid materialising the [E, 2*D] edge MLP inputs by splitting the first MLP layer:
+                messages = edge_type_to_edge_mlp[edge_type_idx].call_with_split_input(
+                    input_parts=[cur_node_states, cur_node_states],
+                    part_indices=[edge_sources, edge_targets])  # Shape [E, D]
+                messages_per_type.append(activation_fn(messages))  # (Apply nonlinearity to Edge-MLP outputs as well)
+                continue
+
+            edge_source_states = graph_structure.gather_from_edge_sources(cur_node_states, edge_type_idx)  # Shape [E, D]
 
             edge_mlp_inputs = edge_source_states
             if use_target_state_as_input:
-                edge_target_states = \
-                    tf.nn.embedding_lookup(params=cur_node_states,
-                                           ids=edge_targets)  # Shape [E, D]
+                edge_target_states = graph_structure.gather_from_edge_targets(cur_node_states, edge_type_idx)  # Shape [E, D]
                 edge_mlp_inputs = tf.concat([edge_source_states, edge_target_states],
                                             axis=1)  # Shape [E, 2*D]
 
             if edge_type_to_edge_mlp is not None:
                 messages = edge_type_to_edge_mlp[edge_type_idx](edge_mlp_inputs)  # Shape [E, D]
+                messages = activation_fn(messages)  # Shape [E, D]  (Apply nonlinearity to Edge-MLP outputs as well)
             else:
                 messages = edge_mlp_inputs
             messages_per_type.append(messages)
 
-        all_messages = tf.concat(messages_per_type, axis=0)  # Shape [M, D]
-        if edge_type_to_edge_mlp is not None:
-            all_messages = activation_fn(all_messages)  # Shape [M, D]  (Apply nonlinearity to Edge-MLP outputs as well)
         aggregated_messages = \
-            message_aggregation_fn(data=all_messages,
-                                   segment_ids=message_targets,
-                                   num_segments=num_nodes)  # Shape [V, D]
+            graph_structure.aggregate_messages_per_type(messages_per_type, message_aggregation_function)  # Shape [V, D]
 
         new_node_states = aggregated_messages
         if aggregation_MLP is not None:
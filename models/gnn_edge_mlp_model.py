@@ -1,10 +1,10 @@
-from typing import Dict, Any, List
+from typing import Dict, Any
 
 import tensorflow as tf
 
 from .sparse_graph_model import Sparse_Graph_Model
 from tasks import Sparse_Graph_Task
-from gnns import sparse_gnn_edge_mlp_layer
+from gnns import sparse_gnn_edge_mlp_layer, GraphStructure
 
 
 class GNN_Edge_MLP_Model(Sparse_Graph_Model):
@@ -31,18 +31,18 @@ class GNN_Edge_MLP_Model(Sparse_Graph_Model):
 
     def _apply_gnn_layer(self,
                          node_representations: tf.Tensor,
-                         adjacency_lists: List[tf.Tensor],
-                         type_to_num_incoming_edges: tf.Tensor,
+                         graph_structure: GraphStructure,
                          num_timesteps: int,
                          ) -> tf.Tensor:
         return sparse_gnn_edge_mlp_layer(
             node_embeddings=node_representations,
-            adjacency_lists=adjacency_lists,
-            type_to_num_incoming_edges=type_to_num_incoming_edges,
+            adjacency_lists=graph_structure.adjacency_lists,
+            type_to_num_incoming_edges=graph_structure.type_to_num_incoming_edges,
             state_dim=self.params['hidden_size'],
             num_timesteps=num_timesteps,
             activation_function=self.params['graph_activation_function'],
             message_aggregation_function=self.params['message_aggregation_function'],
             use_target_state_as_input=self.params['use_target_state_as_input'],
             num_edge_hidden_layers=self.params['num_edge_hidden_layers'],
+            graph_structure=graph_structure,
         )
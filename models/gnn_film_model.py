@@ -1,10 +1,10 @@
-from typing import Dict, Any, List
+from typing import Dict, Any
 
 import tensorflow as tf
 
 from .sparse_graph_model import Sparse_Graph_Model
 from tasks import Sparse_Graph_Task
-from gnns import sparse_gnn_film_layer
+from gnns import sparse_gnn_film_layer, GraphStructure
 
 
 class GNN_FiLM_Model(Sparse_Graph_Model):
@@ -16,6 +16,7 @@ class GNN_FiLM_Model(Sparse_Graph_Model):
             "graph_activation_function": "ReLU",
             "message_aggregation_function": "sum",
             "normalize_messages_by_num_incoming": False,
+            "num_edge_type_weight_bases": None,  # If set, decompose per-edge-type weights into that many shared bases
         })
         return params
 
@@ -28,16 +29,17 @@ class GNN_FiLM_Model(Sparse_Graph_Model):
 
     def _apply_gnn_layer(self,
                          node_representations: tf.Tensor,
-                         adjacency_lists: List[tf.Tensor],
-                         type_to_num_incoming_edges: tf.Tensor,
+                         graph_structure: GraphStructure,
                          num_timesteps: int) -> tf.Tensor:
         return sparse_gnn_film_layer(
             node_embeddings=node_representations,
-            adjacency_lists=adjacency_lists,
-            type_to_num_incoming_edges=type_to_num_incoming_edges,
+            adjacency_lists=graph_structure.adjacency_lists,
+            type_to_num_incoming_edges=graph_structure.type_to_num_incoming_edges,
             state_dim=self.params['hidden_size'],
             num_timesteps=num_timesteps,
             activation_function=self.params['graph_activation_function'],
             message_aggregation_function=self.params['message_aggregation_function'],
             normalize_by_num_incoming=self.params["normalize_messages_by_num_incoming"],
+            num_weight_bases=self.params.get('num_edge_type_weight_bases', None),
+            graph_structure=graph_structure,
         )
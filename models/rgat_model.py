@@ -1,10 +1,10 @@
-from typing import Dict, Any, List
+from typing import Dict, Any
 
 import tensorflow as tf
 
 from .sparse_graph_model import Sparse_Graph_Model
 from tasks import Sparse_Graph_Task
-from gnns import sparse_rgat_layer
+from gnns import sparse_rgat_layer, GraphStructure
 
 
 class RGAT_Model(Sparse_Graph_Model):
@@ -18,6 +18,7 @@ class RGAT_Model(Sparse_Graph_Model):
             'graph_layer_input_dropout_keep_prob': 1.0,
             'graph_dense_between_every_num_gnn_layers': 10000,
             'graph_residual_connection_every_num_layers': 10000,
+            'num_edge_type_weight_bases': None,  # If set, decompose per-edge-type weights into that many shared bases
         })
         return params
 
@@ -30,14 +31,15 @@ class RGAT_Model(Sparse_Graph_Model):
 
     def _apply_gnn_layer(self,
                          node_representations: tf.Tensor,
-                         adjacency_lists: List[tf.Tensor],
-                         type_to_num_incoming_edges: tf.Tensor,
+                         graph_structure: GraphStructure,
                          num_timesteps: int) -> tf.Tensor:
         return sparse_rgat_layer(
             node_embeddings=node_representations,
-            adjacency_lists=adjacency_lists,
+            adjacency_lists=graph_structure.adjacency_lists,
             state_dim=self.params['hidden_size'],
             num_timesteps=num_timesteps,
             num_heads=self.params['num_heads'],
             activation_function=self.params['graph_activation_function'],
+            num_weight_bases=self.params.get('num_edge_type_weight_bases', None),
+            graph_structure=graph_structure,
         )
@@ -1,10 +1,10 @@
-from typing import Dict, Any, List
+from typing import Dict, Any
 
 import tensorflow as tf
 
 from .sparse_graph_model import Sparse_Graph_Model
 from tasks import Sparse_Graph_Task
-from gnns import sparse_rgcn_layer
+from gnns import sparse_rgcn_layer, GraphStructure
 
 
 class RGCN_Model(Sparse_Graph_Model):
@@ -15,9 +15,11 @@ class RGCN_Model(Sparse_Graph_Model):
             'hidden_size': 128,
             "graph_activation_function": "ReLU",
             "message_aggregation_function": "sum",
+            "message_passing_implementation": "gather_scatter",  # gather_scatter or sparse_matmul
             'graph_layer_input_dropout_keep_prob': 1.0,
             'graph_dense_between_every_num_gnn_layers': 10000,
             'graph_residual_connection_every_num_layers': 10000,
+            'num_edge_type_weight_bases': None,  # If set, decompose per-edge-type weights into that many shared bases
         })
         return params
 
@@ -30,15 +32,17 @@ class RGCN_Model(Sparse_Graph_Model):
 
     def _apply_gnn_layer(self,
                          node_representations: tf.Tensor,
-                         adjacency_lists: List[tf.Tensor],
-                         type_to_num_incoming_edges: tf.Tensor,
+                         graph_structure: GraphStructure,
                          num_timesteps: int) -> tf.Tensor:
         return sparse_rgcn_layer(
             node_embeddings=node_representations,
-            adjacency_lists=adjacency_lists,
-            type_to_num_incoming_edges=type_to_num_incoming_edges,
+            adjacency_lists=graph_structure.adjacency_lists,
+            type_to_num_incoming_edges=graph_structure.type_to_num_incoming_edges,
             state_dim=self.params['hidden_size'],
             num_timesteps=num_timesteps,
             activation_function=self.params['graph_activation_function'],
             message_aggregation_function=self.params['message_aggregation_function'],
+            message_passing_implementation=self.params.get('message_passing_implementation', "gather_scatter"),
+            num_weight_bases=self.params.get('num_edge_type_weight_bases', None),
+            graph_structure=graph_structure,
         )
@@ -1,10 +1,10 @@
-from typing import Dict, Any, List
+from typing import Dict, Any
 
 import tensorflow as tf
 
 from .sparse_graph_model import Sparse_Graph_Model
 from tasks import Sparse_Graph_Task
-from gnns import sparse_rgdcn_layer
+from gnns import sparse_rgdcn_layer, GraphStructure
 
 
 class RGDCN_Model(Sparse_Graph_Model):
@@ -33,13 +33,12 @@ class RGDCN_Model(Sparse_Graph_Model):
 
     def _apply_gnn_layer(self,
                          node_representations: tf.Tensor,
-                         adjacency_lists: List[tf.Tensor],
-                         type_to_num_incoming_edges: tf.Tensor,
+                         graph_structure: GraphStructure,
                          num_timesteps: int) -> tf.Tensor:
         return sparse_rgdcn_layer(
             node_embeddings=node_representations,
-            adjacency_lists=adjacency_lists,
-            type_to_num_incoming_edges=type_to_num_incoming_edges,
+            adjacency_lists=graph_structure.adjacency_lists,
+            type_to_num_incoming_edges=graph_structure.type_to_num_incoming_edges,
             num_channels=self.params['num_channels'],
             channel_dim=self.params['channel_dim'],
             num_timesteps=num_timesteps,
@@ -47,4 +46,5 @@ class RGDCN_Model(Sparse_Graph_Model):
             tie_channel_weights=self.params['tie_channel_weights'],
             activation_function=self.params['graph_activation_function'],
             message_aggregation_function=self.params['message_aggregation_function'],
+            graph_structure=graph_structure,
         )
@@ -1,10 +1,10 @@
-from typing import Dict, Any, List
+from typing import Dict, Any
 
 import tensorflow as tf
 
 from .sparse_graph_model import Sparse_Graph_Model
 from tasks import Sparse_Graph_Task
-from gnns import sparse_rgin_layer
+from gnns import sparse_rgin_layer, GraphStructure
 
 
 class RGIN_Model(Sparse_Graph_Model):
@@ -32,13 +32,12 @@ class RGIN_Model(Sparse_Graph_Model):
 
     def _apply_gnn_layer(self,
                          node_representations: tf.Tensor,
-                         adjacency_lists: List[tf.Tensor],
-                         type_to_num_incoming_edges: tf.Tensor,
+                         graph_structure: GraphStructure,
                          num_timesteps: int,
                          ) -> tf.Tensor:
         return sparse_rgin_layer(
             node_embeddings=node_representations,
-            adjacency_lists=adjacency_lists,
+            adjacency_lists=graph_structure.adjacency_lists,
             state_dim=self.params['hidden_size'],
             num_timesteps=num_timesteps,
             activation_function=self.params['graph_activation_function'],
@@ -46,4 +45,5 @@ class RGIN_Model(Sparse_Graph_Model):
             use_target_state_as_input=self.params['use_target_state_as_input'],
             num_edge_MLP_hidden_layers=self.params['graph_num_edge_MLP_hidden_layers'],
             num_aggr_MLP_hidden_layers=self.params['graph_num_aggr_MLP_hidden_layers'],
+            graph_structure=graph_structure,
         )
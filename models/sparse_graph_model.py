@@ -10,6 +10,7 @@ import numpy as np
 from dpu_utils.utils import ThreadedIterator, RichPath
 
 from tasks import Sparse_Graph_Task, DataFold
+from gnns import GraphStructure
 from utils import get_activation
 
 
@@ -32,6 +33,8 @@ class Sparse_Graph_Model(ABC):
             'graph_model_activation_function': 'tanh',
             'graph_residual_connection_every_num_layers': 2,
             'graph_inter_layer_norm': False,
+            'graph_sort_messages_by_target': False,
+            'graph_accumulate_messages_per_type': False,
 
             'max_epochs': 10000,
             'patience': 25,
@@ -174,6 +177,19 @@ class Sparse_Graph_Model(ABC):
         else:
             self.__ops['projected_node_features'] = self.__ops['initial_node_features']
 
+        # Structure of the batch is the same in all GNN layers, so compute derived information once:
+        self.__ops['graph_structure'] = \
+            GraphStructure(adjacency_lists=self.__ops['adjacency_lists'],
+                           num_nodes=tf.shape(self.__ops['projected_node_features'], out_type=tf.int32)[0],
+                           type_to_num_incoming_edges=self.__ops['type_to_num_incoming_edges'],
+                           sort_messages_by_target=self.params.get('graph_sort_messages_by_target', False),
+                           accumulate_messages_per_type=self.params.get('graph_accumulate_messages_per_type', False),
+                           self_loop_edge_type_idx=self.task.self_loop_edge_type_idx,
+                           reverse_edge_types=self.task.reverse_edge_types,
+                           global_node_edge_sources=self.__ops.get('global_node_edge_sources'),
+                           graph_nodes_list=self.__ops.get('graph_nodes_list'),
+                           global_node_ids=self.__ops.get('global_node_ids'))
+
         cur_node_representations = self.__ops['projected_node_features']
         last_residual_representations = tf.zeros_like(cur_node_representations)
         for layer_idx in range(self.params['graph_num_layers']):
@@ -193,8 +209,7 @@ class Sparse_Graph_Model(ABC):
                 cur_node_representations = \
                     self._apply_gnn_layer(
                         cur_node_representations,
-                        self.__ops['adjacency_lists'],
-                        self.__ops['type_to_num_incoming_edges'],
+                        self.__ops['graph_structure'],
                         self.params['graph_num_timesteps_per_layer'])
                 if self.params['graph_inter_layer_norm']:
                     cur_node_representations = tf.contrib.layers.layer_norm(cur_node_representations)
@@ -211,20 +226,19 @@ class Sparse_Graph_Model(ABC):
     @abstractmethod
     def _apply_gnn_layer(self,
                          node_representations: tf.Tensor,
-                         adjacency_lists: List[tf.Tensor],
-                         type_to_num_incoming_edges: tf.Tensor,
+                         graph_structure: GraphStructure,
                          num_timesteps: int) -> tf.Tensor:
         """
         Run a GNN layer on a graph.
 
         Arguments:
             node_features: float32 tensor of shape [V, D], where V is the number of nodes.
-            adjacency_lists: list of L int32 tensors of shape [E, 2], where L is the number
-                of edge types and E the number of edges of that type.
+            graph_structure: GraphStructure of the batch, shared by all GNN layers. Its
+                adjacency_lists are a list of L int32 tensors of shape [E, 2], where L is
+                the number of edge types and E the number of edges of that type.
                 Hence, adjacency_lists[l][e,:] == [u, v] means that u has an edge of type l
                 to v.
-            type_to_num_incoming_edges: int32 tensor of shape [L, V], where L is the number
-                of edge types.
+                Its type_to_num_incoming_edges are a float32 tensor of shape [L, V], where
                 type_to_num_incoming_edges[l, v] = k indicates that node v has k incoming
                 edges of type l.
             num_timesteps: Number of propagation steps in to run in this GNN layer.
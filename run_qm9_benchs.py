@@ -4,10 +4,13 @@ Usage:
     run_qm9_benchs.py [options] LOG_TARGET_DIR
 
 Options:
-    -h --help         Show this screen.
-    --num-runs NUM    Number of runs to perform for each configuration. [default: 5]
-    --debug           Turn on debugger.
+    -h --help             Show this screen.
+    --num-runs NUM        Number of runs to perform for each configuration. [default: 5]
+    --data-cache-dir DIR  Directory in which processed data is cached, to be shared by all runs.
+                          Defaults to a subdirectory of LOG_TARGET_DIR.
+    --debug               Turn on debugger.
 """
+import json
 import os
 import subprocess
 import re
@@ -28,6 +31,7 @@ def run(args):
     os.makedirs(target_dir, exist_ok=True)
     print("Starting QM9 experiments, will write logfiles for runs into %s." % target_dir)
     num_seeds = int(args.get('--num-runs'))
+    data_cache_dir = args.get('--data-cache-dir') or os.path.join(target_dir, "data_cache")
     results = {}
     for model in MODEL_TYPES:
         results[model] = [{"test_errors": [], "times": []} for _ in TASKS]
@@ -43,7 +47,8 @@ def run(args):
                                            "--model-param-overrides",
                                            "{\"random_seed\": %i}" % seed,
                                            "--task-param-overrides",
-                                           "{\"task_ids\": [%i]}" % task_id,
+                                           json.dumps({"task_ids": [task_id],
+                                                       "data_cache_dir": data_cache_dir}),
                                            ],
                                           stdout=log_fh,
                                           stderr=log_fh)
@@ -20,6 +20,7 @@ if args.params is None:
         "dse": False,
         "nexttoken": False,
         "hybrid_label_mode": False,
+        "implicit_supernode_edges": False,
         "label_length": -1
 }
 else:
@@ -163,13 +164,19 @@ if args.labelmode == "supernode":
         asserts = [i for i in range(len(labels)) if "__VERIFIER_assert" in labels[i] and i in leaves]
         if len(asserts) < 1:
             raise RuntimeError(f"{args.ast} has no assert statement")
-        [target.append((a, super_index)) for a in asserts]
+        slot_edge_sources = asserts
     elif transformations["slot_root"]:
-        target.append((0, super_index))    
+        slot_edge_sources = [0]
     else:
         # Add an edge between every node and the super node
-        for i in range(0, super_index):
-            target.append((i, super_index))
+        slot_edge_sources = list(range(0, super_index))
+
+    global_node_edges = dict()
+    if transformations.get("implicit_supernode_edges", False):
+        # Only mark which nodes connect to the super node; the edges are created in the model.
+        global_node_edges["Supernode" if transformations["dse"] else "Child"] = slot_edge_sources
+    else:
+        [target.append((i, super_index)) for i in slot_edge_sources]
 
     if transformations['label_length'] > -1:
         for i in range(super_index):
@@ -182,6 +189,8 @@ if args.labelmode == "supernode":
            "SlotDummyNode": super_index,
            "SymbolCandidates": symbolcandidates
     }
+    if len(global_node_edges) > 0:
+        obj["ContextGraph"]["GlobalNodeEdges"] = global_node_edges
     
 else:
     if transformations['label_length'] > -1:
@@ -13,6 +13,7 @@ args = p.parse_args()
 if args.params is None:
     params = {
         "assert": True,
+        "implicit_supernode_edges": False,
         "label_length": -1
     }
 else:
@@ -345,17 +346,19 @@ if not symbolcandidates[0]["IsCorrect"]:
 # Add edges between supernode
 if params['assert']:
     # Kill if assert is not in this graph.
-    has_assert = False
-    for i, l in enumerate(labels):
-        if 'assert' in l.lower():
-            edges.add((i, super_index))
-            has_assert = True
-    if not has_assert:
+    slot_edge_sources = [i for i, l in enumerate(labels) if 'assert' in l.lower()]
+    if len(slot_edge_sources) == 0:
         logging.debug('No assert statements could be found in this program. Killing now.')
         raise RuntimeError('No assert statements present.')
 else:
-    for i in range(0, super_index):
-        edges.add((i, super_index))
+    slot_edge_sources = list(range(0, super_index))
+
+global_node_edges = dict()
+if params.get('implicit_supernode_edges', False):
+    # Only mark which nodes connect to the super node; the edges are created in the model.
+    global_node_edges["Child"] = slot_edge_sources
+else:
+    edges.update((i, super_index) for i in slot_edge_sources)
 
 if params['label_length'] > -1:
     for i in range(super_index):
@@ -367,6 +370,8 @@ obj = {"ContextGraph" : {"Edges": {"Child" : sorted(list(edges))},
        "SlotDummyNode": super_index,
        "SymbolCandidates": symbolcandidates
 }
+if len(global_node_edges) > 0:
+    obj["ContextGraph"]["GlobalNodeEdges"] = global_node_edges
 
 with open(args.output, 'w') as f:
     json.dump([obj], f)
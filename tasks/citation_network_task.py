@@ -1,5 +1,5 @@
 from collections import namedtuple
-from typing import Any, Dict, List, Iterable, Iterator
+from typing import Any, Dict, List, Iterable, Iterator, Optional
 
 import numpy as np
 import tensorflow as tf
@@ -55,6 +55,10 @@ class Citation_Network_Task(Sparse_Graph_Task):
     def num_edge_types(self) -> int:
         return self.__num_edge_types
 
+    @property
+    def self_loop_edge_type_idx(self) -> Optional[int]:
+        return 0
+
     @property
     def initial_node_feature_size(self) -> int:
         return self.__initial_node_feature_size
@@ -89,7 +93,6 @@ class Citation_Network_Task(Sparse_Graph_Task):
 
     def __preprocess_data(self, adj_list: Dict[int, List[int]], features, labels, mask) -> CitationData:
         flat_adj_list = []
-        self_loop_adj_list = []
         num_incoming_edges = np.zeros(shape=[len(adj_list)], dtype=np.int32)
         for node, neighbours in adj_list.items():
             for neighbour in neighbours:
@@ -97,12 +100,11 @@ class Citation_Network_Task(Sparse_Graph_Task):
                 flat_adj_list.append((neighbour, node))
                 num_incoming_edges[neighbour] += 1
                 num_incoming_edges[node] += 1
-            self_loop_adj_list.append((node, node))
 
-        # Prepend the self-loop information:
+        # Prepend the self-loop information (edges are computed by the model, see self_loop_edge_type_idx):
         num_incoming_edges = np.stack([np.ones_like(num_incoming_edges, dtype=np.int32),
                                        num_incoming_edges])  # Shape [2, V]
-        return CitationData(adj_lists=[self_loop_adj_list, flat_adj_list],
+        return CitationData(adj_lists=[np.zeros(shape=(0, 2), dtype=np.int32), flat_adj_list],
                             num_incoming_edges=num_incoming_edges,
                             features=features,
                             labels=labels,
@@ -162,19 +164,19 @@ class Citation_Network_Task(Sparse_Graph_Task):
 
         feed_dict = {
             model_placeholders['initial_node_features']: data.features,
-            model_placeholders['adjacency_lists'][0]: data.adj_lists[0],
-            model_placeholders['adjacency_lists'][1]: data.adj_lists[1],
-            model_placeholders['type_to_num_incoming_edges']: data.num_incoming_edges,
             model_placeholders['num_graphs']: 1,
             model_placeholders['labels']: data.labels,
             model_placeholders['mask']: data.mask,
             model_placeholders['out_layer_dropout_keep_prob']: out_layer_dropout_keep_prob,
         }
+        graph = self._make_batch_assembler()
+        graph.add_graph(data.features.shape[0], data.adj_lists, data.num_incoming_edges)
+        num_edges_per_type = self._add_graph_structure_to_feed_dict(feed_dict, model_placeholders, graph)
 
         yield MinibatchData(feed_dict=feed_dict,
                             num_graphs=1,
                             num_nodes=data.features.shape[0],
-                            num_edges=sum(len(adj_list) for adj_list in data.adj_lists))
+                            num_edges=int(np.sum(num_edges_per_type)))
 
     def early_stopping_metric(self, task_metric_results: List[Dict[str, np.ndarray]], num_graphs: int) -> float:
         # Early stopping based on average loss:
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+from typing import Any, Dict, Iterator, List, Sequence
+
+import numpy as np
+
+
+class PackedGraphDataset(object):
+    """
+    Read-only sequence of graph samples, stored as a few flat arrays for the whole
+    dataset plus per-graph offset tables, instead of as many small per-graph objects.
+    Accessing a graph creates a sample of the original type whose arrays are views
+    (i.e., slices) into the flat arrays.
+
+    Sample fields are stored as follows:
+    * adjacency_lists (if present): all edges of all graphs in one int32 array of shape
+      [E, 2], grouped by graph and then by edge type, with offsets for each (graph, type)
+      pair.
+    * type_to_node_to_num_incoming_edges: per-graph [L, V] arrays, concatenated along
+      the node dimension.
+    * Fields listed in graph_value_fields: one row per graph.
+    * Dictionary-valued fields (from int keys to arrays): like other variable-sized
+      fields, separately for each key.
+    * All other fields: per-graph arrays of varying length, concatenated along their
+      first dimension, with offsets for each graph.
+
+    Datasets can be saved to a directory and loaded again, optionally memory-mapped,
+    so that the data can be shared between several processes.
+    """
+    ADJACENCY_LISTS_FIELD = 'adjacency_lists'
+    NUM_INCOMING_EDGES_FIELD = 'type_to_node_to_num_incoming_edges'
+
+    def __init__(self,
+                 sample_type: Any,
+                 num_graphs: int,
+                 num_edge_types: int,
+                 graph_value_fields: Sequence[str],
+                 dict_field_keys: Dict[str, List[int]],
+                 arrays: Dict[str, np.ndarray],
+                 ):
+        """
+        Use PackedGraphDataset.pack or PackedGraphDataset.load to create instances.
+        """
+        self.__sample_type = sample_type
+        self.__num_graphs = num_graphs
+        self.__num_edge_types = num_edge_types
+        self.__graph_value_fields = set(graph_value_fields)
+        self.__dict_field_keys = dict_field_keys
+        self.__arrays = arrays
+
+    @staticmethod
+    def pack(graphs: Sequence[Any], graph_value_fields: Sequence[str] = ()) -> 'PackedGraphDataset':
+        """
+        Arguments:
+            graphs: Non-empty sequence of graph samples, all of the same NamedTuple type.
+            graph_value_fields: Names of fields that have the same shape for all graphs.
+
+        Returns:
+            PackedGraphDataset holding the same data as graphs.
+        """
+        if len(graphs) == 0:
+            raise ValueError("Cannot pack an empty list of graphs!")
+        sample_type = type(graphs[0])
+        arrays = {}  # type: Dict[str, np.ndarray]
+
+        def pack_ragged_values(name: str, values: List[np.ndarray]) -> None:
+            offsets = np.zeros(shape=(len(values) + 1,), dtype=np.int64)
+            np.cumsum([len(graph_values) for graph_values in values], out=offsets[1:])
+            arrays[name] = np.concatenate(values, axis=0)
+            arrays[name + '.offsets'] = offsets
+
+        num_edge_types = 0
+        if PackedGraphDataset.ADJACENCY_LISTS_FIELD in sample_type._fields:
+            # The edges of graph g and type l are at offsets [g * L + l, g * L + l + 1]:
+            num_edge_types = len(graphs[0].adjacency_lists)
+            pack_ragged_values(PackedGraphDataset.ADJACENCY_LISTS_FIELD,
+                               [np.asarray(adjacency_list, dtype=np.int32).reshape((-1, 2))
+                                for graph in graphs
+                                for adjacency_list in graph.adjacency_lists])
+
+        dict_field_keys = {}  # type: Dict[str, List[int]]
+        for field in sample_type._fields:
+            if field == PackedGraphDataset.ADJACENCY_LISTS_FIELD:
+                continue
+            field_values = [getattr(graph, field) for graph in graphs]
+            if field in graph_value_fields:
+                arrays[field] = np.array(field_values)
+            elif isinstance(field_values[0], dict):
+                keys = sorted({key for graph_values in field_values for key in graph_values.keys()})
+                dict_field_keys[field] = keys
+                for key in keys:
+                    key_values = [graph_values.get(key) for graph_values in field_values]
+                    key_dtype = next(values for values in key_values if values is not None).dtype
+                    pack_ragged_values('%s.%i' % (field, key),
+                                       [values if values is not None else np.zeros((0,), dtype=key_dtype)
+                                        for values in key_values])
+            elif field == PackedGraphDataset.NUM_INCOMING_EDGES_FIELD:
+                # Store as [V, L] to be able to concatenate along the first dimension:
+                pack_ragged_values(field, [np.transpose(graph_values) for graph_values in field_values])
+            else:
+                pack_ragged_values(field, [np.asarray(graph_values) for graph_values in field_values])
+
+        return PackedGraphDataset(sample_type, len(graphs), num_edge_types, graph_value_fields, dict_field_keys, arrays)
+
+    def get_content_hash(self) -> str:
+        """
+        Returns:
+            Hex digest of a hash over all data of the dataset (but not its sample type),
+            which can be used to identify stored copies of the dataset.
+        """
+        content_hash = hashlib.sha256()
+        content_hash.update(json.dumps(self.__get_metadata(), sort_keys=True).encode('utf-8'))
+        for name in sorted(self.__arrays.keys()):
+            array = np.ascontiguousarray(self.__arrays[name])
+            content_hash.update(json.dumps([name, array.dtype.str, array.shape]).encode('utf-8'))
+            content_hash.update(memoryview(array).cast('B'))
+        return content_hash.hexdigest()
+
+    def __get_metadata(self) -> Dict[str, Any]:
+        return {'num_graphs': self.__num_graphs,
+                'num_edge_types': self.__num_edge_types,
+                'graph_value_fields': sorted(self.__graph_value_fields),
+                'dict_field_keys': self.__dict_field_keys,
+                'array_names': sorted(self.__arrays.keys()),
+                }
+
+    def save(self, path: str) -> None:
+        """
+        Store the dataset in directory path, with one .npy file per array.
+        """
+        os.makedirs(path, exist_ok=True)
+        for (name, array) in self.__arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+        with open(os.path.join(path, 'metadata.json'), 'w') as f:
+            json.dump(self.__get_metadata(), f)
+
+    @staticmethod
+    def load(path: str, sample_type: Any, use_memmap: bool = False) -> 'PackedGraphDataset':
+        """
+        Load a dataset stored by save.
+
+        Arguments:
+            path: Directory the dataset was saved to.
+            sample_type: NamedTuple type of the samples to create.
+            use_memmap: If set, arrays are memory-mapped (read-only) instead of read into
+                memory, so that their memory can be shared between processes.
+        """
+        with open(os.path.join(path, 'metadata.json')) as f:
+            metadata = json.load(f)
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if use_memmap else None)
+                  for name in metadata['array_names']}
+        return PackedGraphDataset(sample_type,
+                                  metadata['num_graphs'],
+                                  metadata['num_edge_types'],
+                                  metadata['graph_value_fields'],
+                                  metadata['dict_field_keys'],
+                                  arrays)
+
+    def __len__(self) -> int:
+        return self.__num_graphs
+
+    def __iter__(self) -> Iterator[Any]:
+        for graph_idx in range(len(self)):
+            yield self[graph_idx]
+
+    def __get_ragged_values(self, name: str, graph_idx: int) -> np.ndarray:
+        offsets = self.__arrays[name + '.offsets']
+        return self.__arrays[name][offsets[graph_idx]:offsets[graph_idx + 1]]
+
+    def __getitem__(self, graph_idx: int) -> Any:
+        if not 0 <= graph_idx < len(self):
+            raise IndexError("Graph index %i out of range." % graph_idx)
+        fields = {}  # type: Dict[str, Any]
+        for field in self.__sample_type._fields:
+            if field == PackedGraphDataset.ADJACENCY_LISTS_FIELD:
+                edges, edge_offsets = self.__arrays[field], self.__arrays[field + '.offsets']
+                first_edge_offset_idx = graph_idx * self.__num_edge_types
+                fields[field] = [edges[edge_offsets[offset_idx]:edge_offsets[offset_idx + 1]]
+                                 for offset_idx in range(first_edge_offset_idx,
+                                                         first_edge_offset_idx + self.__num_edge_types)]
+            elif field in self.__graph_value_fields:
+                fields[field] = self.__arrays[field][graph_idx]
+            elif field in self.__dict_field_keys:
+                fields[field] = {}
+                for key in self.__dict_field_keys[field]:
+                    key_values = self.__get_ragged_values('%s.%i' % (field, key), graph_idx)
+                    if len(key_values) > 0:
+                        fields[field][key] = key_values
+            elif field == PackedGraphDataset.NUM_INCOMING_EDGES_FIELD:
+                fields[field] = np.transpose(self.__get_ragged_values(field, graph_idx))
+            else:
+                fields[field] = self.__get_ragged_values(field, graph_idx)
+        return self.__sample_type(**fields)
@@ -1,11 +1,11 @@
 from collections import namedtuple
-from typing import Any, Dict, Iterator, List, Iterable
+from typing import Any, Dict, Iterator, List, Iterable, Optional
 
 import tensorflow as tf
 import numpy as np
 from dpu_utils.utils import RichPath
 
-from .sparse_graph_task import Sparse_Graph_Task, DataFold, MinibatchData
+from .sparse_graph_task import Sparse_Graph_Task, DataFold, MinibatchData, BatchAssembler
 from utils import micro_f1
 
 
@@ -60,6 +60,16 @@ class PPI_Task(Sparse_Graph_Task):
     def num_edge_types(self) -> int:
         return self.__num_edge_types
 
+    @property
+    def self_loop_edge_type_idx(self) -> Optional[int]:
+        return 1 if self.params['add_self_loop_edges'] else None
+
+    @property
+    def reverse_edge_types(self) -> Dict[int, int]:
+        if self.params['tie_fwd_bkwd_edges']:
+            return {}
+        return {self.__num_edge_types - 1: 0}  # Backwards type is always the last, see __load_data
+
     @property
     def initial_node_feature_size(self) -> int:
         return self.__initial_node_feature_size
@@ -67,11 +77,13 @@ class PPI_Task(Sparse_Graph_Task):
     # -------------------- Data Loading --------------------
     def load_data(self, path: RichPath) -> None:
         # Data in format as downloaded from https://s3.us-east-2.amazonaws.com/dgl.ai/dataset/ppi.zip
-        self._loaded_data[DataFold.TRAIN] = self.__load_data(path, DataFold.TRAIN)
-        self._loaded_data[DataFold.VALIDATION] = self.__load_data(path, DataFold.VALIDATION)
+        self._loaded_data[DataFold.TRAIN] = \
+            self._pack_graphs(self.__load_data(path, DataFold.TRAIN), DataFold.TRAIN)
+        self._loaded_data[DataFold.VALIDATION] = \
+            self._pack_graphs(self.__load_data(path, DataFold.VALIDATION), DataFold.VALIDATION)
 
     def load_eval_data_from_path(self, path: RichPath) -> Iterable[Any]:
-        return self.__load_data(path, DataFold.TEST)
+        return self._pack_graphs(self.__load_data(path, DataFold.TEST), DataFold.TEST)
 
     def __load_data(self, data_dir: RichPath, data_fold: DataFold) -> List[GraphSample]:
         if data_fold == DataFold.TRAIN:
@@ -92,72 +104,64 @@ class PPI_Task(Sparse_Graph_Task):
         self.__num_labels = node_to_labels.shape[-1]
 
         # We read in all the data in two steps:
-        #  (1) Read features, labels and insert self-loop edges (edge type 0).
-        #      Implicitly, this gives us the number of nodes per graph.
-        #  (2) Read all edges, and shift them so that each graph starts with node 0.
+        #  (1) Group nodes (with their features and labels) by graph. Graphs are ordered by
+        #      their first node, and nodes keep their order within graphs.
+        #      Self-loop edges (edge type 1) are not materialised, but computed by the model.
+        #  (2) Group all edges by the graph of their source, and shift them so that each
+        #      graph starts with node 0.
 
         fwd_edge_type = 0
         self.__num_edge_types = 1
         if self.params['add_self_loop_edges']:
             self_loop_edge_type = self.__num_edge_types
+            assert self_loop_edge_type == self.self_loop_edge_type_idx
             self.__num_edge_types += 1
         if not self.params['tie_fwd_bkwd_edges']:
-            bkwd_edge_type = self.__num_edge_types
+            # Backwards edges are created by the model, see reverse_edge_types:
             self.__num_edge_types += 1
 
-        graph_id_to_graph_data = {}  # type: Dict[int, GraphSample]
-        graph_id_to_node_offset = {}
         num_total_nodes = node_to_features.shape[0]
-        for node_id in range(num_total_nodes):
-            graph_id = node_to_graph_id[node_id]
-            # In case we are entering a new graph, note its ID, so that we can normalise everything to start at 0
-            if graph_id not in graph_id_to_graph_data:
-                graph_id_to_graph_data[graph_id] = \
-                    GraphSample(adjacency_lists=[[] for _ in range(self.__num_edge_types)],
-                                type_to_node_to_num_incoming_edges=[[] for _ in range(self.__num_edge_types)],
-                                node_features=[],
-                                node_labels=[])
-                graph_id_to_node_offset[graph_id] = node_id
-            cur_graph_data = graph_id_to_graph_data[graph_id]
-            cur_graph_data.node_features.append(node_to_features[node_id])
-            cur_graph_data.node_labels.append(node_to_labels[node_id])
-            shifted_node_id = node_id - graph_id_to_node_offset[graph_id]
-            if self.params['add_self_loop_edges']:
-                cur_graph_data.adjacency_lists[self_loop_edge_type].append((shifted_node_id, shifted_node_id))
-                cur_graph_data.type_to_node_to_num_incoming_edges[self_loop_edge_type].append(1)
-
-        # Prepare reading of the edges by setting counters to 0:
-        for graph_data in graph_id_to_graph_data.values():
-            num_graph_nodes = len(graph_data.node_features)
-            graph_data.type_to_node_to_num_incoming_edges[fwd_edge_type] = np.zeros([num_graph_nodes], np.int32)
-            if not self.params['tie_fwd_bkwd_edges']:
-                graph_data.type_to_node_to_num_incoming_edges[bkwd_edge_type] = np.zeros([num_graph_nodes], np.int32)
-
-        for edge_info in graph_json_data['links']:
-            src_node, tgt_node = edge_info['source'], edge_info['target']
-            # First, shift node IDs so that each graph starts at node 0:
-            graph_id = node_to_graph_id[src_node]
-            graph_node_offset = graph_id_to_node_offset[graph_id]
-            src_node, tgt_node = src_node - graph_node_offset, tgt_node - graph_node_offset
-
-            cur_graph_data = graph_id_to_graph_data[graph_id]
-            cur_graph_data.adjacency_lists[fwd_edge_type].append((src_node, tgt_node))
-            cur_graph_data.type_to_node_to_num_incoming_edges[fwd_edge_type][tgt_node] += 1
-            if not self.params['tie_fwd_bkwd_edges']:
-                cur_graph_data.adjacency_lists[bkwd_edge_type].append((tgt_node, src_node))
-                cur_graph_data.type_to_node_to_num_incoming_edges[bkwd_edge_type][src_node] += 1
+        (_, graph_id_first_nodes, node_to_graph_id_idx) = \
+            np.unique(np.asarray(node_to_graph_id).reshape(-1), return_index=True, return_inverse=True)
+        num_graphs = len(graph_id_first_nodes)
+        graph_id_idx_to_graph_idx = np.empty(shape=(num_graphs,), dtype=np.int64)
+        graph_id_idx_to_graph_idx[np.argsort(graph_id_first_nodes)] = np.arange(num_graphs)
+        node_to_graph_idx = graph_id_idx_to_graph_idx[node_to_graph_id_idx.reshape(-1)]
+
+        node_order = np.argsort(node_to_graph_idx, kind='stable')
+        graph_node_offsets = np.zeros(shape=(num_graphs + 1,), dtype=np.int64)
+        np.cumsum(np.bincount(node_to_graph_idx, minlength=num_graphs), out=graph_node_offsets[1:])
+        node_to_graph_node_id = np.empty(shape=(num_total_nodes,), dtype=np.int64)
+        node_to_graph_node_id[node_order] = np.arange(num_total_nodes) - graph_node_offsets[node_to_graph_idx[node_order]]
+        grouped_node_features = node_to_features[node_order]
+        grouped_node_labels = node_to_labels[node_order]
+
+        links = graph_json_data['links']
+        edge_srcs = np.fromiter((edge_info['source'] for edge_info in links), dtype=np.int64, count=len(links))
+        edge_tgts = np.fromiter((edge_info['target'] for edge_info in links), dtype=np.int64, count=len(links))
+        edge_to_graph_idx = node_to_graph_idx[edge_srcs]
+        edge_order = np.argsort(edge_to_graph_idx, kind='stable')
+        grouped_edges = np.stack([node_to_graph_node_id[edge_srcs[edge_order]],
+                                  node_to_graph_node_id[edge_tgts[edge_order]]],
+                                 axis=1).astype(np.int32)  # Shape [E, 2]
+        graph_edge_offsets = np.searchsorted(edge_to_graph_idx[edge_order], np.arange(num_graphs + 1))
 
         final_graphs = []
-        for graph_data in graph_id_to_graph_data.values():
-            # numpy-ize:
-            adj_lists = []
-            for edge_type_idx in range(self.__num_edge_types):
-                adj_lists.append(np.array(graph_data.adjacency_lists[edge_type_idx]))
+        for graph_idx in range(num_graphs):
+            (node_start, node_end) = (graph_node_offsets[graph_idx], graph_node_offsets[graph_idx + 1])
+            num_graph_nodes = node_end - node_start
+            graph_edges = grouped_edges[graph_edge_offsets[graph_idx]:graph_edge_offsets[graph_idx + 1]]
+            adj_lists = [np.zeros(shape=(0, 2), dtype=np.int32) for _ in range(self.__num_edge_types)]
+            adj_lists[fwd_edge_type] = graph_edges
+            type_to_num_incoming_edges = np.zeros(shape=(self.__num_edge_types, num_graph_nodes), dtype=np.int32)
+            type_to_num_incoming_edges[fwd_edge_type] = np.bincount(graph_edges[:, 1], minlength=num_graph_nodes)
+            if self.params['add_self_loop_edges']:
+                type_to_num_incoming_edges[self_loop_edge_type] = 1
             final_graphs.append(
                 GraphSample(adjacency_lists=adj_lists,
-                            type_to_node_to_num_incoming_edges=np.array(graph_data.type_to_node_to_num_incoming_edges),
-                            node_features=np.array(graph_data.node_features),
-                            node_labels=np.array(graph_data.node_labels)))
+                            type_to_node_to_num_incoming_edges=type_to_num_incoming_edges,
+                            node_features=grouped_node_features[node_start:node_end],
+                            node_labels=grouped_node_labels[node_start:node_end]))
 
         return final_graphs
 
@@ -201,59 +205,45 @@ class PPI_Task(Sparse_Graph_Task):
                                 max_nodes_per_batch: int) \
             -> Iterator[MinibatchData]:
         if data_fold == DataFold.TRAIN:
-            np.random.shuffle(data)
+            graph_order = np.random.permutation(len(data))
             out_layer_dropout_keep_prob = self.params['out_layer_dropout_keep_prob']
         else:
+            graph_order = np.arange(len(data))
             out_layer_dropout_keep_prob = 1.0
 
-        # Pack until we cannot fit more graphs in the batch
-        num_graphs = 0
-        while num_graphs < len(data):
-            num_graphs_in_batch = 0
-            batch_node_features = []  # type: List[np.ndarray]
-            batch_node_labels = []
-            batch_adjacency_lists = [[] for _ in range(self.num_edge_types)]  # type: List[List[np.ndarray]]
-            batch_type_to_num_incoming_edges = []
-            batch_graph_nodes_list = []
-            node_offset = 0
-
-            while num_graphs < len(data) and node_offset + len(data[num_graphs].node_features) < max_nodes_per_batch:
-                cur_graph = data[num_graphs]
-                num_nodes_in_graph = len(data[num_graphs].node_features)
-                batch_node_features.extend(cur_graph.node_features)
-                batch_graph_nodes_list.append(np.full(shape=[num_nodes_in_graph],
-                                                      fill_value=num_graphs_in_batch,
-                                                      dtype=np.int32))
-                for i in range(self.num_edge_types):
-                    batch_adjacency_lists[i].append(cur_graph.adjacency_lists[i] + node_offset)
-                batch_type_to_num_incoming_edges.append(cur_graph.type_to_node_to_num_incoming_edges)
-                batch_node_labels.append(cur_graph.node_labels)
-                num_graphs += 1
-                num_graphs_in_batch += 1
-                node_offset += num_nodes_in_graph
-
+        def finalise_batch_data(batch: BatchAssembler) -> MinibatchData:
             batch_feed_dict = {
-                model_placeholders['initial_node_features']: np.array(batch_node_features),
-                model_placeholders['type_to_num_incoming_edges']: np.concatenate(batch_type_to_num_incoming_edges, axis=1),
-                model_placeholders['graph_nodes_list']: np.concatenate(batch_graph_nodes_list),
-                model_placeholders['target_labels']: np.concatenate(batch_node_labels, axis=0),
+                model_placeholders['initial_node_features']: batch.get_values('node_features', dtype=np.float32),
+                model_placeholders['graph_nodes_list']: batch.get_graph_nodes_list(),
+                model_placeholders['target_labels']: batch.get_values('node_labels', dtype=np.float32),
                 model_placeholders['out_layer_dropout_keep_prob']: out_layer_dropout_keep_prob,
             }
 
             # Merge adjacency lists:
-            num_edges = 0
-            for i in range(self.num_edge_types):
-                if len(batch_adjacency_lists[i]) > 0:
-                    adj_list = np.concatenate(batch_adjacency_lists[i])
-                else:
-                    adj_list = np.zeros((0, 2), dtype=np.int32)
-                num_edges += adj_list.shape[0]
-                batch_feed_dict[model_placeholders['adjacency_lists'][i]] = adj_list
-
-            yield MinibatchData(feed_dict=batch_feed_dict,
-                                num_graphs=num_graphs_in_batch,
-                                num_nodes=node_offset,
-                                num_edges=num_edges)
+            num_edges_per_type = self._add_graph_structure_to_feed_dict(batch_feed_dict, model_placeholders, batch)
+
+            return MinibatchData(feed_dict=batch_feed_dict,
+                                 num_graphs=batch.num_graphs,
+                                 num_nodes=batch.num_nodes,
+                                 num_edges=int(np.sum(num_edges_per_type)))
+
+        # Pack until we cannot fit more graphs in the batch
+        cur_batch = self._make_batch_assembler()
+        for graph_idx in graph_order:
+            cur_graph = data[graph_idx]
+            num_nodes_in_graph = len(cur_graph.node_features)
+            if cur_batch.num_graphs > 0 and cur_batch.num_nodes + num_nodes_in_graph >= max_nodes_per_batch:
+                yield finalise_batch_data(cur_batch)
+                cur_batch = self._make_batch_assembler()
+            cur_batch.add_graph(num_nodes_in_graph,
+                                cur_graph.adjacency_lists,
+                                cur_graph.type_to_node_to_num_incoming_edges)
+            cur_batch.add_values('node_features', cur_graph.node_features)
+            cur_batch.add_values('node_labels', cur_graph.node_labels)
+
+        # Final batch, yield only if non-empty:
+        if cur_batch.num_graphs > 0:
+            yield finalise_batch_data(cur_batch)
 
     def early_stopping_metric(self, task_metric_results: List[Dict[str, np.ndarray]], num_graphs: int) -> float:
         # Early stopping based on average loss:
@@ -1,11 +1,17 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
 from collections import namedtuple
-from typing import Any, Dict, Tuple, List, Iterable
+from typing import Any, Dict, Tuple, List, Iterable, Optional, Sequence
 
 import tensorflow as tf
 import numpy as np
 from dpu_utils.utils import RichPath
 
-from .sparse_graph_task import Sparse_Graph_Task, DataFold, MinibatchData
+from .sparse_graph_task import Sparse_Graph_Task, DataFold, MinibatchData, BatchAssembler
+from .packed_graph_dataset import PackedGraphDataset
 from utils import MLP
 
 
@@ -36,6 +42,10 @@ class QM9_Task(Sparse_Graph_Task):
             'use_graph': True,
             'activation_function': "tanh",
             'out_layer_dropout_keep_prob': 1.0,
+
+            # If set, processed graphs are cached in this directory, keyed by the contents of
+            # the data files and the parameters influencing preprocessing:
+            'data_cache_dir': None,
         })
         return params
 
@@ -69,82 +79,143 @@ class QM9_Task(Sparse_Graph_Task):
     def num_edge_types(self) -> int:
         return self.__num_edge_types
 
+    @property
+    def self_loop_edge_type_idx(self) -> Optional[int]:
+        return 0 if self.params['add_self_loop_edges'] else None
+
+    @property
+    def reverse_edge_types(self) -> Dict[int, int]:
+        if self.params['tie_fwd_bkwd_edges']:
+            return {}
+        num_fwd_edge_types = self.num_edge_types // 2
+        return {num_fwd_edge_types + edge_type: edge_type for edge_type in range(num_fwd_edge_types)}
+
     @property
     def initial_node_feature_size(self) -> int:
         return self.__annotation_size
 
     # -------------------- Data Loading --------------------
     def load_data(self, path: RichPath) -> None:
-        self._loaded_data[DataFold.TRAIN] = self.__load_data(path.join("train.jsonl.gz"))
-        self._loaded_data[DataFold.VALIDATION] = self.__load_data(path.join("valid.jsonl.gz"))
+        self._loaded_data[DataFold.TRAIN] = \
+            self._pack_graphs(self.__load_data(path.join("train.jsonl.gz")), DataFold.TRAIN,
+                              graph_value_fields=['target_values'])
+        self._loaded_data[DataFold.VALIDATION] = \
+            self._pack_graphs(self.__load_data(path.join("valid.jsonl.gz")), DataFold.VALIDATION,
+                              graph_value_fields=['target_values'])
 
     def load_eval_data_from_path(self, path: RichPath) -> Iterable[Any]:
         if path.path == self.default_data_path():
             path = path.join("test.jsonl.gz")
-        return self.__load_data(path)
-
-    def __load_data(self, data_file: RichPath) -> List[GraphSample]:
-        print(" Loading QM9 data from %s." % (data_file,))
-        data = list(data_file.read_by_file_suffix())  # list() needed for .jsonl case, where .read*() is just a generator
-
-        # Get some common data out:
+        return self._pack_graphs(self.__load_data(path), DataFold.TEST, graph_value_fields=['target_values'])
+
+    def __load_data(self, data_file: RichPath) -> Sequence[GraphSample]:
+        cache_dir = self.params.get('data_cache_dir')
+        if cache_dir is None:
+            print(" Loading QM9 data from %s." % (data_file,))
+            raw_data = list(data_file.read_by_file_suffix())  # list() needed for .jsonl case, where .read*() is just a generator
+            self.__update_data_sizes(self.__get_raw_data_sizes(raw_data))
+            return self.__process_raw_graphs(raw_data)
+
+        # The numbers of edge types and node features are known before the (cached) graphs
+        # are loaded, as graphs need to be split into the number of edge types of the task:
+        file_cache_key = self.__get_cache_key(data_file)
+        data_sizes_file = os.path.join(cache_dir, self.name(), file_cache_key + '.json')
+        raw_data = None
+        if os.path.exists(data_sizes_file):
+            with open(data_sizes_file) as f:
+                data_sizes = json.load(f)
+        else:
+            print(" Loading QM9 data from %s." % (data_file,))
+            raw_data = list(data_file.read_by_file_suffix())
+            data_sizes = self.__get_raw_data_sizes(raw_data)
+            os.makedirs(os.path.dirname(data_sizes_file), exist_ok=True)
+            (tmp_fd, tmp_data_sizes_file) = tempfile.mkstemp(dir=os.path.dirname(data_sizes_file))
+            with os.fdopen(tmp_fd, 'w') as f:
+                json.dump(data_sizes, f)
+            os.replace(tmp_data_sizes_file, data_sizes_file)
+        self.__update_data_sizes(data_sizes)
+
+        graphs_cache_dir = os.path.join(cache_dir, self.name(), '%s-%i' % (file_cache_key, self.num_edge_types))
+        if not os.path.exists(graphs_cache_dir):
+            if raw_data is None:
+                print(" Loading QM9 data from %s." % (data_file,))
+                raw_data = list(data_file.read_by_file_suffix())
+            # Write to a temporary directory first, so that concurrent runs never see partial results:
+            tmp_graphs_cache_dir = tempfile.mkdtemp(dir=os.path.dirname(graphs_cache_dir))
+            PackedGraphDataset.pack(self.__process_raw_graphs(raw_data), ['target_values']).save(tmp_graphs_cache_dir)
+            try:
+                os.rename(tmp_graphs_cache_dir, graphs_cache_dir)
+            except OSError:  # Another process cached the same file in the meantime
+                shutil.rmtree(tmp_graphs_cache_dir, ignore_errors=True)
+
+        print(" Loading cached QM9 data for %s from %s." % (data_file, graphs_cache_dir))
+        return PackedGraphDataset.load(graphs_cache_dir, GraphSample, use_memmap=True)
+
+    def __get_cache_key(self, data_file: RichPath) -> str:
+        cache_key = hashlib.sha256(data_file.read_as_binary())
+        cache_key.update(json.dumps({'add_self_loop_edges': self.params['add_self_loop_edges'],
+                                     'tie_fwd_bkwd_edges': self.params['tie_fwd_bkwd_edges'],
+                                     'task_ids': self.params['task_ids'],
+                                     'fields': GraphSample._fields,
+                                     }, sort_keys=True).encode('utf-8'))
+        return cache_key.hexdigest()
+
+    def __get_raw_data_sizes(self, raw_data: List[Dict[str, Any]]) -> Dict[str, int]:
         num_fwd_edge_types = 0
-        for g in data:
+        for g in raw_data:
             num_fwd_edge_types = max(num_fwd_edge_types, max([e[1] for e in g['graph']]))
         if self.params['add_self_loop_edges']:
             num_fwd_edge_types += 1
-        self.__num_edge_types = max(self.num_edge_types,
-                                    num_fwd_edge_types * (1 if self.params['tie_fwd_bkwd_edges'] else 2))
-        self.__annotation_size = max(self.__annotation_size, len(data[0]["node_features"][0]))
-        return self.__process_raw_graphs(data)
+        return {'num_edge_types': num_fwd_edge_types * (1 if self.params['tie_fwd_bkwd_edges'] else 2),
+                'annotation_size': len(raw_data[0]["node_features"][0]),
+                }
+
+    def __update_data_sizes(self, data_sizes: Dict[str, int]) -> None:
+        self.__num_edge_types = max(self.num_edge_types, data_sizes['num_edge_types'])
+        self.__annotation_size = max(self.__annotation_size, data_sizes['annotation_size'])
 
     def __process_raw_graphs(self, raw_data: Iterable[Any]) -> List[GraphSample]:
         processed_graphs = []
         for d in raw_data:
+            node_features = np.array(d["node_features"], dtype=np.float32)
             (type_to_adjacency_list, type_to_num_incoming_edges) = \
-                self.__graph_to_adjacency_lists(d['graph'], num_nodes=len(d["node_features"]))
+                self.__graph_to_adjacency_lists(d['graph'], num_nodes=node_features.shape[0])
             processed_graphs.append(
                 GraphSample(adjacency_lists=type_to_adjacency_list,
                             type_to_node_to_num_incoming_edges=type_to_num_incoming_edges,
-                            node_features=d["node_features"],
-                            target_values=[d["targets"][task_id][0] for task_id in self.params['task_ids']],
+                            node_features=node_features,
+                            target_values=np.array([d["targets"][task_id][0] for task_id in self.params['task_ids']],
+                                                   dtype=np.float32),
                             ))
         return processed_graphs
 
     def __graph_to_adjacency_lists(self, graph: Iterable[Tuple[int, int, int]], num_nodes: int) \
             -> Tuple[List[np.ndarray], np.ndarray]:
-        type_to_adj_list = [[] for _ in range(self.num_edge_types)]  # type: List[List[Tuple[int, int]]]
-        type_to_num_incoming_edges = np.zeros(shape=(self.num_edge_types, num_nodes,))
-        for src, e, dest in graph:
-            if self.params['add_self_loop_edges']:
-                fwd_edge_type = e  # 0 will be the self-loop type
-            else:
-                fwd_edge_type = e - 1  # Make edges start from 0
-            type_to_adj_list[fwd_edge_type].append((src, dest))
-            type_to_num_incoming_edges[fwd_edge_type, dest] += 1
-            if self.params['tie_fwd_bkwd_edges']:
-                type_to_adj_list[fwd_edge_type].append((dest, src))
-                type_to_num_incoming_edges[fwd_edge_type, src] += 1
-
-        if self.params['add_self_loop_edges']:
-            # Add self-loop edges (idx 0, which isn't used in the data):
-            for node in range(num_nodes):
-                type_to_num_incoming_edges[0, node] = 1
-                type_to_adj_list[0].append((node, node))
-
-        type_to_adj_list = [np.array(sorted(adj_list), dtype=np.int32) if len(adj_list) > 0 else np.zeros(shape=(0, 2), dtype=np.int32)
-                            for adj_list in type_to_adj_list]
-
-        # Add backward edges as an additional edge type that goes backwards:
-        if not (self.params['tie_fwd_bkwd_edges']):
-            type_to_adj_list = type_to_adj_list[:self.num_edge_types // 2]  # We allocated too much earlier...
-            for (edge_type, adj_list) in enumerate(type_to_adj_list):
-                bwd_edge_type = self.num_edge_types // 2 + edge_type
-                type_to_adj_list.append(np.array(sorted((y, x) for (x, y) in adj_list), dtype=np.int32))
-                for (x, y) in adj_list:
-                    type_to_num_incoming_edges[bwd_edge_type][y] += 1
-
-        return type_to_adj_list, type_to_num_incoming_edges
+        edges = np.array(graph, dtype=np.int32).reshape((-1, 3))
+        (srcs, fwd_edge_types, dests) = (edges[:, 0], edges[:, 1], edges[:, 2])
+        if not self.params['add_self_loop_edges']:
+            fwd_edge_types = fwd_edge_types - 1  # Make edges start from 0; otherwise, 0 is the self-loop type
+        if self.params['tie_fwd_bkwd_edges']:
+            (srcs, fwd_edge_types, dests) = (np.concatenate([srcs, dests]),
+                                             np.concatenate([fwd_edge_types, fwd_edge_types]),
+                                             np.concatenate([dests, srcs]))
+
+        # Self-loop edges (idx 0, which isn't used in the data) are not materialised, but
+        # computed directly by the model (see self_loop_edge_type_idx).
+
+        # Group edges by type, sorted by source and then target within each type:
+        edge_order = np.lexsort((dests, srcs, fwd_edge_types))
+        adjacency_list = np.stack([srcs[edge_order], dests[edge_order]], axis=1)
+        num_edges_per_type = np.bincount(fwd_edge_types, minlength=self.num_edge_types)
+        type_to_adj_list = np.split(adjacency_list, np.cumsum(num_edges_per_type)[:-1])
+        type_to_num_incoming_edges = \
+            np.bincount(fwd_edge_types * num_nodes + dests,
+                        minlength=self.num_edge_types * num_nodes).reshape((self.num_edge_types, num_nodes))
+
+        # Backward edges (an additional edge type that goes backwards, if tie_fwd_bkwd_edges
+        # is not set) are created by the model, see reverse_edge_types.
+
+        return type_to_adj_list, type_to_num_incoming_edges.astype(np.float32)
 
     # -------------------- Model Construction --------------------
     def make_task_output_model(self,
@@ -204,61 +275,45 @@ class QM9_Task(Sparse_Graph_Task):
                                 max_nodes_per_batch: int) \
             -> Iterable[MinibatchData]:
         if data_fold == DataFold.TRAIN:
-            np.random.shuffle(data)
+            graph_order = np.random.permutation(len(data))
             out_layer_dropout_keep_prob = self.params['out_layer_dropout_keep_prob']
         else:
+            graph_order = np.arange(len(data))
             out_layer_dropout_keep_prob = 1.0
 
-        # Pack until we cannot fit more graphs in the batch
-        num_graphs = 0
-        while num_graphs < len(data):
-            num_graphs_in_batch = 0
-            batch_node_features = []  # type: List[np.ndarray]
-            batch_target_task_values = []
-            batch_adjacency_lists = [[] for _ in range(self.num_edge_types)]  # type: List[List[np.ndarray]]
-            batch_type_to_num_incoming_edges = []
-            batch_graph_nodes_list = []
-            node_offset = 0
-
-            while num_graphs < len(data) and node_offset + len(data[num_graphs].node_features) < max_nodes_per_batch:
-                cur_graph = data[num_graphs]
-                num_nodes_in_graph = len(cur_graph.node_features)
-                batch_node_features.extend(cur_graph.node_features)
-                batch_graph_nodes_list.append(np.full(shape=[num_nodes_in_graph],
-                                                      fill_value=num_graphs_in_batch,
-                                                      dtype=np.int32))
-                for i in range(self.num_edge_types):
-                    batch_adjacency_lists[i].append(cur_graph.adjacency_lists[i] + node_offset)
-
-                # Turn counters for incoming edges into np array:
-                batch_type_to_num_incoming_edges.append(cur_graph.type_to_node_to_num_incoming_edges)
-                batch_target_task_values.append(cur_graph.target_values)
-                num_graphs += 1
-                num_graphs_in_batch += 1
-                node_offset += num_nodes_in_graph
-
+        def finalise_batch_data(batch: BatchAssembler) -> MinibatchData:
             batch_feed_dict = {
-                model_placeholders['initial_node_features']: np.array(batch_node_features),
-                model_placeholders['type_to_num_incoming_edges']: np.concatenate(batch_type_to_num_incoming_edges, axis=1),
-                model_placeholders['graph_nodes_list']: np.concatenate(batch_graph_nodes_list),
-                model_placeholders['target_values']: np.transpose(batch_target_task_values, axes=[1, 0]),
+                model_placeholders['initial_node_features']: batch.get_values('node_features', dtype=np.float32),
+                model_placeholders['graph_nodes_list']: batch.get_graph_nodes_list(),
+                model_placeholders['target_values']: np.transpose(batch.get_values('target_values', dtype=np.float32)),
                 model_placeholders['out_layer_dropout_keep_prob']: out_layer_dropout_keep_prob,
             }
 
             # Merge adjacency lists:
-            num_edges = 0
-            for i in range(self.num_edge_types):
-                if len(batch_adjacency_lists[i]) > 0:
-                    adj_list = np.concatenate(batch_adjacency_lists[i])
-                else:
-                    adj_list = np.zeros((0, 2), dtype=np.int32)
-                num_edges += adj_list.shape[0]
-                batch_feed_dict[model_placeholders['adjacency_lists'][i]] = adj_list
-
-            yield MinibatchData(feed_dict=batch_feed_dict,
-                                num_graphs=num_graphs_in_batch,
-                                num_nodes=node_offset,
-                                num_edges=num_edges)
+            num_edges_per_type = self._add_graph_structure_to_feed_dict(batch_feed_dict, model_placeholders, batch)
+
+            return MinibatchData(feed_dict=batch_feed_dict,
+                                 num_graphs=batch.num_graphs,
+                                 num_nodes=batch.num_nodes,
+                                 num_edges=int(np.sum(num_edges_per_type)))
+
+        # Pack until we cannot fit more graphs in the batch
+        cur_batch = self._make_batch_assembler()
+        for graph_idx in graph_order:
+            cur_graph = data[graph_idx]
+            num_nodes_in_graph = len(cur_graph.node_features)
+            if cur_batch.num_graphs > 0 and cur_batch.num_nodes + num_nodes_in_graph >= max_nodes_per_batch:
+                yield finalise_batch_data(cur_batch)
+                cur_batch = self._make_batch_assembler()
+            cur_batch.add_graph(num_nodes_in_graph,
+                                cur_graph.adjacency_lists,
+                                cur_graph.type_to_node_to_num_incoming_edges)
+            cur_batch.add_values('node_features', cur_graph.node_features)
+            cur_batch.add_graph_value('target_values', cur_graph.target_values)
+
+        # Final batch, yield only if non-empty:
+        if cur_batch.num_graphs > 0:
+            yield finalise_batch_data(cur_batch)
 
     def early_stopping_metric(self, task_metric_results: List[Dict[str, np.ndarray]], num_graphs: int) -> float:
         # Early stopping based on average loss:
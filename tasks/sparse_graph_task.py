@@ -1,11 +1,18 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
 from abc import ABC, abstractmethod
 from enum import Enum
-from typing import Any, Dict, Iterable, List, NamedTuple, Iterator, Optional
+from typing import Any, Dict, Iterable, List, NamedTuple, Iterator, Optional, Sequence, Set, Tuple
 
 import tensorflow as tf
 import numpy as np
 from dpu_utils.utils import RichPath
 
+from .packed_graph_dataset import PackedGraphDataset
+
 
 class DataFold(Enum):
     TRAIN = 0
@@ -20,6 +27,172 @@ class MinibatchData(NamedTuple):
     num_edges: int
 
 
+class BatchAssembler(object):
+    """
+    Collects graphs for a minibatch and merges them into one large graph of disconnected
+    components. Adding a graph only stores references to its arrays; when the merged
+    arrays are requested, their sizes are computed first and all per-graph arrays are
+    written (and shifted by their node offset) into a single preallocated output array.
+
+    We use the following abbreviations in shape descriptions:
+    * G: number of graphs in the batch
+    * V: number of nodes in the batch
+    * L: number of different edge types
+    * E: number of edges in the batch
+    """
+    def __init__(self, num_edge_types: int, skipped_edge_types: Iterable[int] = ()):
+        """
+        Arguments:
+            num_edge_types: Number L of edge types of the added graphs.
+            skipped_edge_types: Edge types whose adjacency lists are ignored, e.g., because
+                they are created in the model.
+        """
+        self.__num_edge_types = num_edge_types
+        self.__used_edge_types = [edge_type_idx for edge_type_idx in range(num_edge_types)
+                                  if edge_type_idx not in set(skipped_edge_types)]
+        self.__graph_num_nodes = []  # type: List[int]
+        self.__graph_adjacency_lists = []  # type: List[Sequence[np.ndarray]]
+        self.__graph_type_to_num_incoming_edges = []  # type: List[Optional[np.ndarray]]
+        self.__name_to_values = {}  # type: Dict[str, List[Tuple[np.ndarray, int]]]
+        self.__name_to_num_values = {}  # type: Dict[str, int]
+        self.__num_nodes = 0
+
+    @property
+    def num_graphs(self) -> int:
+        return len(self.__graph_num_nodes)
+
+    @property
+    def num_nodes(self) -> int:
+        return self.__num_nodes
+
+    def num_values(self, name: str) -> int:
+        """
+        Returns:
+            Number of rows added to the values called name so far.
+        """
+        return self.__name_to_num_values.get(name, 0)
+
+    def add_graph(self,
+                  num_nodes: int,
+                  adjacency_lists: Sequence[np.ndarray],
+                  type_to_num_incoming_edges: Optional[np.ndarray] = None,
+                  ) -> int:
+        """
+        Add the structure of a graph to the batch.
+
+        Arguments:
+            num_nodes: Number of nodes of the graph.
+            adjacency_lists: L int arrays of shape [E, 2], the edges of the graph per type.
+            type_to_num_incoming_edges: Optional array of shape [L, V], the number of
+                incoming edges of each node of the graph per type.
+
+        Returns:
+            Offset of the nodes of the graph in the batch, i.e., the amount that node ids
+            of the graph need to be shifted by.
+        """
+        node_offset = self.__num_nodes
+        self.__graph_num_nodes.append(num_nodes)
+        self.__graph_adjacency_lists.append(adjacency_lists)
+        self.__graph_type_to_num_incoming_edges.append(type_to_num_incoming_edges)
+        self.__num_nodes += num_nodes
+        return node_offset
+
+    def add_values(self, name: str, values: np.ndarray, offset: int = 0) -> None:
+        """
+        Add values to be concatenated along the first dimension, e.g., one row per node.
+
+        Arguments:
+            name: Name of the merged values.
+            values: Array of values, or a scalar (treated as a single row).
+            offset: Amount to add to the values, e.g., the node offset for node ids.
+        """
+        values = np.asarray(values)
+        if values.ndim == 0:
+            values = values.reshape((1,))
+        self.__name_to_values.setdefault(name, []).append((values, offset))
+        self.__name_to_num_values[name] = self.num_values(name) + values.shape[0]
+
+    def add_graph_value(self, name: str, value: np.ndarray, offset: int = 0) -> None:
+        """
+        Add a per-graph value, to be stacked into an array with one row per graph.
+        """
+        self.add_values(name, np.asarray(value)[np.newaxis], offset)
+
+    def get_values(self, name: str, dtype: Optional[np.dtype] = None) -> np.ndarray:
+        """
+        Returns:
+            Array with all values added under name, concatenated along the first dimension.
+            If no values were added, an empty array of shape [0].
+        """
+        values_and_offsets = self.__name_to_values.get(name, [])
+        if len(values_and_offsets) == 0:
+            return np.zeros((0,), dtype=dtype or np.int32)
+        first_values = values_and_offsets[0][0]
+        result = np.empty(shape=(self.num_values(name),) + first_values.shape[1:],
+                          dtype=dtype or first_values.dtype)
+        write_offset = 0
+        for (values, offset) in values_and_offsets:
+            num_rows = values.shape[0]
+            if offset == 0:
+                result[write_offset:write_offset + num_rows] = values
+            else:
+                np.add(values, offset, out=result[write_offset:write_offset + num_rows],
+                       dtype=result.dtype, casting='unsafe')
+            write_offset += num_rows
+        return result
+
+    def get_graph_nodes_list(self) -> np.ndarray:
+        """
+        Returns:
+            int32 array of shape [V], mapping each node to the index of its graph.
+        """
+        return np.repeat(np.arange(self.num_graphs, dtype=np.int32), self.__graph_num_nodes)
+
+    def get_edges(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns:
+            Pair of an int32 array of shape [E, 2] holding all edges of the batch, sorted
+            by edge type, and an int32 array of shape [L + 1] holding the offsets of each
+            edge type in the former, i.e., the edges of type l are
+            edges[edge_type_offsets[l]:edge_type_offsets[l + 1]].
+        """
+        num_edges_per_type = np.zeros(shape=(self.__num_edge_types,), dtype=np.int32)
+        for adjacency_lists in self.__graph_adjacency_lists:
+            for edge_type_idx in self.__used_edge_types:
+                num_edges_per_type[edge_type_idx] += len(adjacency_lists[edge_type_idx])
+        edge_type_offsets = np.zeros(shape=(self.__num_edge_types + 1,), dtype=np.int32)
+        np.cumsum(num_edges_per_type, out=edge_type_offsets[1:])
+
+        edges = np.empty(shape=(edge_type_offsets[-1], 2), dtype=np.int32)
+        for edge_type_idx in self.__used_edge_types:
+            write_offset = edge_type_offsets[edge_type_idx]
+            node_offset = 0
+            for (num_nodes, adjacency_lists) in zip(self.__graph_num_nodes, self.__graph_adjacency_lists):
+                adjacency_list = adjacency_lists[edge_type_idx]
+                num_edges = len(adjacency_list)
+                if num_edges > 0:
+                    np.add(adjacency_list, node_offset, out=edges[write_offset:write_offset + num_edges],
+                           dtype=np.int32, casting='unsafe')
+                write_offset += num_edges
+                node_offset += num_nodes
+        return edges, edge_type_offsets
+
+    def get_type_to_num_incoming_edges(self) -> np.ndarray:
+        """
+        Returns:
+            float32 array of shape [L', V], the number of incoming edges of each node per
+            type, for the L' edge types that are not skipped (in ascending order). Requires
+            that type_to_num_incoming_edges was passed for all graphs.
+        """
+        result = np.empty(shape=(len(self.__used_edge_types), self.__num_nodes), dtype=np.float32)
+        node_offset = 0
+        for (num_nodes, type_to_num_incoming_edges) in zip(self.__graph_num_nodes,
+                                                           self.__graph_type_to_num_incoming_edges):
+            result[:, node_offset:node_offset + num_nodes] = type_to_num_incoming_edges[self.__used_edge_types]
+            node_offset += num_nodes
+        return result
+
+
 class Sparse_Graph_Task(ABC):
     """
     Abstract superclass of all graph tasks, defining the interface used by the
@@ -27,7 +200,15 @@ class Sparse_Graph_Task(ABC):
     """
     @classmethod
     def default_params(cls):
-        return {}
+        return {
+            # If set, feed all edges as one [E, 2] tensor sorted by type (plus offsets for the
+            # types), and compute the numbers of incoming edges in the model:
+            'compact_graph_input': False,
+            # If set, store loaded graphs in a PackedGraphDataset (optionally memory-mapped from
+            # files in the given directory, which can be shared by runs on the same data):
+            'pack_graphs': False,
+            'packed_graphs_memmap_dir': None,
+        }
 
     @staticmethod
     @abstractmethod
@@ -67,6 +248,26 @@ class Sparse_Graph_Task(ABC):
         """
         raise NotImplementedError()
 
+    @property
+    def self_loop_edge_type_idx(self) -> Optional[int]:
+        """
+        Returns:
+            Index of the edge type connecting each node to itself, if used. The model
+            evaluates this edge type directly on the node states, so its adjacency list
+            and its row of type_to_num_incoming_edges do not need to be filled.
+        """
+        return None
+
+    @property
+    def reverse_edge_types(self) -> Dict[int, int]:
+        """
+        Returns:
+            Map from edge types to the edge type they are the reverse of. The model creates
+            these edges by flipping the edges of the original type, so their adjacency lists
+            and rows of type_to_num_incoming_edges do not need to be filled.
+        """
+        return {}
+
     @property
     @abstractmethod
     def initial_node_feature_size(self) -> int:
@@ -80,6 +281,52 @@ class Sparse_Graph_Task(ABC):
     def has_test_data(self) -> bool:
         return DataFold.TEST in self._loaded_data
 
+    def _pack_graphs(self,
+                     graphs: Sequence[Any],
+                     data_fold: DataFold,
+                     graph_value_fields: Sequence[str] = (),
+                     ) -> Sequence[Any]:
+        """
+        Turn loaded graphs into a PackedGraphDataset, if pack_graphs is set (and they are
+        not packed already, e.g., because they were loaded from a cache).
+        If packed_graphs_memmap_dir is set, the dataset is stored in a subdirectory keyed by
+        its contents and the edge type layout of the task, and memory-mapped from there.
+        Existing subdirectories are never rewritten, so that concurrent runs can share them.
+
+        Arguments:
+            graphs: List of graph samples, all of the same NamedTuple type.
+            data_fold: Fold the graphs belong to.
+            graph_value_fields: Names of fields that have the same shape for all graphs.
+
+        Returns:
+            Sequence of graph samples.
+        """
+        if not self.params.get('pack_graphs') or isinstance(graphs, PackedGraphDataset) or len(graphs) == 0:
+            return graphs
+        packed_graphs = PackedGraphDataset.pack(graphs, graph_value_fields)
+        memmap_dir = self.params.get('packed_graphs_memmap_dir')
+        if memmap_dir is not None:
+            cache_key = hashlib.sha256(packed_graphs.get_content_hash().encode('utf-8'))
+            cache_key.update(json.dumps({'sample_fields': type(graphs[0])._fields,
+                                         'num_edge_types': self.num_edge_types,
+                                         'self_loop_edge_type_idx': self.self_loop_edge_type_idx,
+                                         'reverse_edge_types': sorted(self.reverse_edge_types.items()),
+                                         }, sort_keys=True).encode('utf-8'))
+            task_memmap_dir = os.path.join(memmap_dir, self.name())
+            packed_graphs_dir = \
+                os.path.join(task_memmap_dir, '%s-%s' % (data_fold.name.lower(), cache_key.hexdigest()))
+            if not os.path.exists(packed_graphs_dir):
+                # Write to a temporary directory first, so that concurrent runs never see partial results:
+                os.makedirs(task_memmap_dir, exist_ok=True)
+                tmp_packed_graphs_dir = tempfile.mkdtemp(dir=task_memmap_dir)
+                packed_graphs.save(tmp_packed_graphs_dir)
+                try:
+                    os.rename(tmp_packed_graphs_dir, packed_graphs_dir)
+                except OSError:  # Another process stored the same data in the meantime
+                    shutil.rmtree(tmp_packed_graphs_dir, ignore_errors=True)
+            packed_graphs = PackedGraphDataset.load(packed_graphs_dir, type(graphs[0]), use_memmap=True)
+        return packed_graphs
+
     @abstractmethod
     def load_data(self, path: Optional[RichPath]) -> None:
         """
@@ -138,15 +385,132 @@ class Sparse_Graph_Task(ABC):
         """
         placeholders['initial_node_features'] = \
             tf.placeholder(dtype=tf.float32, shape=[None, self.initial_node_feature_size], name='initial_node_features')
+
+        model_ops['initial_node_features'] = placeholders['initial_node_features']
+        model_ops['adjacency_lists'] = self._make_adjacency_lists_input(placeholders)
+        model_ops['type_to_num_incoming_edges'] = \
+            self._make_num_incoming_edges_input(placeholders,
+                                                model_ops['adjacency_lists'],
+                                                num_nodes=tf.shape(model_ops['initial_node_features'], out_type=tf.int32)[0])
+
+    def _make_adjacency_lists_input(self, placeholders: Dict[str, tf.Tensor]) -> List[tf.Tensor]:
+        """
+        Create placeholders for the edges of the graph, fed by _add_graph_structure_to_feed_dict.
+        Edge types created by the model (see _get_generated_edge_types) are not fed.
+
+        Returns:
+            List of L int32 tensors of shape [E, 2], where L is the number of edge types
+            and E the number of edges of that type (empty for types created by the model).
+        """
+        if self.params.get('compact_graph_input'):
+            placeholders['edges'] = \
+                tf.placeholder(dtype=tf.int32, shape=[None, 2], name='edges')
+            placeholders['edge_type_offsets'] = \
+                tf.placeholder(dtype=tf.int32, shape=[self.num_edge_types + 1], name='edge_type_offsets')
+            return [placeholders['edges'][placeholders['edge_type_offsets'][e]:placeholders['edge_type_offsets'][e + 1]]
+                    for e in range(self.num_edge_types)]
+
+        generated_edge_types = self._get_generated_edge_types()
         placeholders['adjacency_lists'] = \
-            [tf.placeholder(dtype=tf.int32, shape=[None, 2], name='adjacency_e%s' % e)
+            {e: tf.placeholder(dtype=tf.int32, shape=[None, 2], name='adjacency_e%s' % e)
+             for e in range(self.num_edge_types)
+             if e not in generated_edge_types}
+        return [placeholders['adjacency_lists'].get(e, tf.zeros(shape=[0, 2], dtype=tf.int32))
                 for e in range(self.num_edge_types)]
+
+    def _make_num_incoming_edges_input(self,
+                                       placeholders: Dict[str, tf.Tensor],
+                                       adjacency_lists: List[tf.Tensor],
+                                       num_nodes: tf.Tensor,
+                                       ) -> tf.Tensor:
+        """
+        Create a placeholder for the number of incoming edges per type, fed by
+        _add_graph_structure_to_feed_dict, or compute it from adjacency_lists if
+        compact_graph_input is set.
+
+        Returns:
+            float32 tensor of shape [L, V].
+        """
+        if self.params.get('compact_graph_input'):
+            return self._compute_num_incoming_edges(adjacency_lists, num_nodes)
+
+        # Only fed for the edge types that are not created by the model; rows of the other types
+        # are zero, and get replaced when the model creates their edges:
+        generated_edge_types = self._get_generated_edge_types()
+        fed_edge_types = [e for e in range(self.num_edge_types) if e not in generated_edge_types]
         placeholders['type_to_num_incoming_edges'] = \
-            tf.placeholder(dtype=tf.float32, shape=[self.num_edge_types, None], name='type_to_num_incoming_edges')
+            tf.placeholder(dtype=tf.float32, shape=[len(fed_edge_types), None], name='type_to_num_incoming_edges')
+        if len(fed_edge_types) == self.num_edge_types:
+            return placeholders['type_to_num_incoming_edges']
+        return tf.scatter_nd(indices=[[e] for e in fed_edge_types],
+                             updates=placeholders['type_to_num_incoming_edges'],
+                             shape=tf.stack([self.num_edge_types, num_nodes]))  # Shape [L, V]
+
+    def _get_generated_edge_types(self) -> Set[int]:
+        """
+        Returns:
+            The edge types that are created by the model (self_loop_edge_type_idx and
+            reverse_edge_types), and so are neither stored nor fed.
+        """
+        generated_edge_types = set(self.reverse_edge_types.keys())
+        if self.self_loop_edge_type_idx is not None:
+            generated_edge_types.add(self.self_loop_edge_type_idx)
+        return generated_edge_types
 
-        model_ops['initial_node_features'] = placeholders['initial_node_features']
-        model_ops['adjacency_lists'] = placeholders['adjacency_lists']
-        model_ops['type_to_num_incoming_edges'] = placeholders['type_to_num_incoming_edges']
+    def _make_batch_assembler(self) -> BatchAssembler:
+        """
+        Returns:
+            A fresh BatchAssembler for minibatches of this task, ignoring the edge types
+            that are created by the model (see _get_generated_edge_types).
+        """
+        return BatchAssembler(self.num_edge_types, skipped_edge_types=self._get_generated_edge_types())
+
+    @staticmethod
+    def _compute_num_incoming_edges(adjacency_lists: List[tf.Tensor], num_nodes: tf.Tensor) -> tf.Tensor:
+        """
+        Returns:
+            float32 tensor of shape [L, V], the number of incoming edges of each node per
+            edge type in adjacency_lists.
+        """
+        with tf.name_scope("num_incoming_edges"):
+            return tf.stack([tf.unsorted_segment_sum(data=tf.ones_like(adjacency_list[:, 1], dtype=tf.float32),
+                                                     segment_ids=adjacency_list[:, 1],
+                                                     num_segments=num_nodes)
+                             for adjacency_list in adjacency_lists],
+                            axis=0)  # Shape [L, V]
+
+    def _add_graph_structure_to_feed_dict(self,
+                                          feed_dict: Dict[tf.Tensor, Any],
+                                          model_placeholders: Dict[str, tf.Tensor],
+                                          batch: BatchAssembler,
+                                          ) -> np.ndarray:
+        """
+        Add the merged graph structure of a batch (created by _make_batch_assembler) to a
+        feed dict.
+
+        Arguments:
+            feed_dict: Feed dict to extend.
+            model_placeholders: The placeholders of the model.
+            batch: BatchAssembler holding the graphs of the batch. Numbers of incoming
+                edges are only required if they are fed to the model (i.e., if
+                compact_graph_input is not set and they are not computed by the task).
+
+        Returns:
+            int array of shape [L], the number of fed edges per edge type.
+        """
+        edges, edge_type_offsets = batch.get_edges()
+
+        if self.params.get('compact_graph_input'):
+            feed_dict[model_placeholders['edges']] = edges
+            feed_dict[model_placeholders['edge_type_offsets']] = edge_type_offsets
+        else:
+            for (edge_type_idx, adjacency_list_placeholder) in model_placeholders['adjacency_lists'].items():
+                feed_dict[adjacency_list_placeholder] = \
+                    edges[edge_type_offsets[edge_type_idx]:edge_type_offsets[edge_type_idx + 1]]
+            if 'type_to_num_incoming_edges' in model_placeholders:
+                feed_dict[model_placeholders['type_to_num_incoming_edges']] = batch.get_type_to_num_incoming_edges()
+
+        return np.diff(edge_type_offsets)
 
     @abstractmethod
     def make_task_output_model(self,
@@ -1,14 +1,23 @@
+import hashlib
+import json
+import os
+import queue
 import re
-from collections import defaultdict
+import shutil
+import tempfile
+import traceback
+from collections import defaultdict, OrderedDict
+from functools import lru_cache
 from multiprocessing import Process, Queue, cpu_count
-from typing import Any, Dict, Iterable, List, NamedTuple, Set, Iterator
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Iterator, Tuple
 
 import tensorflow as tf
 import numpy as np
 from dpu_utils.utils import RichPath
 from dpu_utils.codeutils import split_identifier_into_parts, get_language_keywords
 
-from .sparse_graph_task import Sparse_Graph_Task, DataFold, MinibatchData
+from .sparse_graph_task import Sparse_Graph_Task, DataFold, MinibatchData, BatchAssembler
+from .packed_graph_dataset import PackedGraphDataset
 from utils import BIG_NUMBER
 
 
@@ -29,14 +38,115 @@ PROGRAM_GRAPH_EDGES_TYPES_VOCAB = {edge_type_name: idx
 
 
 class GraphSample(NamedTuple):
-    adjacency_lists: List[np.ndarray]
-    type_to_node_to_num_incoming_edges: np.ndarray
+    # All edges of the graph, grouped by their type (indexed by PROGRAM_GRAPH_EDGES_TYPES_VOCAB),
+    # using the node id dtype of the graph (see _get_node_id_dtype). Shape [E, 2]:
+    edges: np.ndarray
+    # The edges of type l are edges[edge_type_offsets[l]:edge_type_offsets[l + 1]]. Shape [L + 1]:
+    edge_type_offsets: np.ndarray
+    global_node_edge_sources: Dict[int, np.ndarray]
     unique_labels_as_characters: np.ndarray
     node_labels_to_unique_labels: np.ndarray
     slot_node_id: int
     variable_candidate_nodes: np.ndarray
     variable_candidate_nodes_mask: np.ndarray
 
+    def get_edges_of_type(self, edge_type_vocab_idx: int) -> np.ndarray:
+        return self.edges[self.edge_type_offsets[edge_type_vocab_idx]:self.edge_type_offsets[edge_type_vocab_idx + 1]]
+
+# Fields of GraphSample that have the same shape for all samples (see PackedGraphDataset):
+GRAPH_SAMPLE_GRAPH_VALUE_FIELDS = ['edge_type_offsets', 'slot_node_id', 'variable_candidate_nodes',
+                                   'variable_candidate_nodes_mask']
+
+
+def _get_node_id_dtype(num_nodes: int) -> np.dtype:
+    """
+    Returns:
+        Smallest unsigned integer dtype that can hold the node ids of a graph with
+        num_nodes nodes.
+    """
+    return np.dtype(np.uint16) if num_nodes <= 2 ** 16 else np.dtype(np.uint32)
+
+
+# Maximal number of node labels whose subtokens are memoized (per process):
+LABEL_SUBTOKENS_CACHE_SIZE = 2 ** 18
+# Maximal number of (node label, length) pairs whose padded label is memoized (per process):
+PADDED_LABEL_CACHE_SIZE = 2 ** 18
+_ALPHANUMERIC_CHAR_RE = re.compile('[a-zA-Z0-9]')
+
+
+@lru_cache(maxsize=LABEL_SUBTOKENS_CACHE_SIZE)
+def _get_label_subtokens(node_label: str) -> Tuple[str, ...]:
+    """
+    Returns:
+        The subtokens of node_label that contain at least one alphanumeric character.
+        Labels repeat heavily across samples, so results are memoized. The cache is not
+        shared between processes: data loading workers only inherit the entries the parent
+        process has at the time they are forked, and then fill their own copies.
+    """
+    return tuple(subtoken for subtoken in split_identifier_into_parts(node_label)
+                 if _ALPHANUMERIC_CHAR_RE.search(subtoken))
+
+
+@lru_cache(maxsize=PADDED_LABEL_CACHE_SIZE)
+def _get_padded_label(node_label: str, num_chars: int) -> str:
+    """
+    Returns:
+        Lower-cased node_label, truncated or padded with NUL characters to num_chars characters.
+    """
+    return node_label[:num_chars].lower()[:num_chars].ljust(num_chars, '\0')
+
+
+def _make_char_code_to_alphabet_idx() -> np.ndarray:
+    """
+    Returns:
+        uint8 array of shape [256], mapping character codes to their ALPHABET_DICT entry.
+        NUL (used for padding) is mapped to PAD, and 255 (which larger codes are clipped
+        to) to UNK.
+    """
+    char_code_to_alphabet_idx = np.full(shape=(256,), fill_value=ALPHABET_DICT["UNK"], dtype=np.uint8)
+    for char in ALPHABET:
+        char_code_to_alphabet_idx[ord(char)] = ALPHABET_DICT[char]
+    char_code_to_alphabet_idx[0] = ALPHABET_DICT["PAD"]
+    return char_code_to_alphabet_idx
+
+
+_CHAR_CODE_TO_ALPHABET_IDX = _make_char_code_to_alphabet_idx()
+
+
+def _encode_node_labels(node_labels: List[str], num_chars: int) -> np.ndarray:
+    """
+    Returns:
+        uint8 array of shape [len(node_labels), num_chars], the ALPHABET_DICT indices of
+        the (lower-cased) characters of each label, padded with PAD.
+    """
+    padded_labels = "".join(_get_padded_label(node_label, num_chars) for node_label in node_labels)
+    # UTF-32 gives us exactly one code point per character:
+    char_codes = np.frombuffer(padded_labels.encode('utf-32-le'), dtype=np.uint32)
+    char_codes = np.minimum(char_codes, 255)
+    return _CHAR_CODE_TO_ALPHABET_IDX[char_codes].reshape((len(node_labels), num_chars))
+
+
+def _deduplicate_rows(rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Arguments:
+        rows: Array of shape [N, C].
+
+    Returns:
+        Pair of the unique rows of shape [U, C] and an int array of shape [N], mapping
+        each row to the index of its copy in the unique rows.
+    """
+    rows = np.ascontiguousarray(rows)
+    # View each row as one opaque value, which is much faster than np.unique(..., axis=0):
+    packed_rows = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).reshape((-1,))
+    _, unique_row_idxs, row_to_unique_row = np.unique(packed_rows, return_index=True, return_inverse=True)
+    return rows[unique_row_idxs], row_to_unique_row.reshape((-1,))
+
+
+def _format_label_subtokens_cache_stats(num_hits: int, num_misses: int) -> str:
+    return "%i hits, %i misses (hit rate %.1f%%)" \
+        % (num_hits, num_misses, 100.0 * num_hits / max(1, num_hits + num_misses))
+
+
 """
 Austin: iterates through node labels in the graph and detects alphanumeric strings that are not part
 of the language vocabulary.
@@ -60,9 +170,8 @@ def _add_per_subtoken_nodes(unsplittable_node_names: Set[str], graph_dict: Dict[
         if node_label in unsplittable_node_names:
             continue
 
-        for subtoken in split_identifier_into_parts(node_label):
-            if re.search('[a-zA-Z0-9]', subtoken):
-                subtoken_to_using_nodes[subtoken].add(node_id)
+        for subtoken in _get_label_subtokens(node_label):
+            subtoken_to_using_nodes[subtoken].add(node_id)
 
     subtoken_node_id = max_used_node_id
     new_edges = []
@@ -78,51 +187,47 @@ def _add_per_subtoken_nodes(unsplittable_node_names: Set[str], graph_dict: Dict[
 def _load_single_sample(raw_sample: Dict[str, Any],
                         unsplittable_node_names: Set[str],
                         graph_node_label_max_num_chars: int,
-                        max_variable_candidates: int = 5,
-                        add_self_loop_edges: bool = False):
+                        max_variable_candidates: int = 5):
     _add_per_subtoken_nodes(unsplittable_node_names, raw_sample['ContextGraph']) # adds uses subtoken edges
     num_nodes = len(raw_sample['ContextGraph']['NodeLabels'])
+    node_id_dtype = _get_node_id_dtype(num_nodes)
 
-    node_label_chars = np.zeros(shape=(num_nodes, graph_node_label_max_num_chars),
-                                dtype=np.uint8)
+    node_labels = [""] * num_nodes
     for (node, label) in raw_sample['ContextGraph']['NodeLabels'].items():
-        for (char_idx, label_char) in enumerate(label[:graph_node_label_max_num_chars].lower()):
-            node_label_chars[int(node), char_idx] = ALPHABET_DICT.get(label_char, 1)
+        node_labels[int(node)] = label
+    node_label_chars = _encode_node_labels(node_labels, graph_node_label_max_num_chars)
     # Returns the sorted unique rows, and the associated indices
     node_label_chars_unique, node_label_chars_indices = np.unique(node_label_chars,
                                                                   axis=0,
                                                                   return_inverse=True)
 
-    # Split edges according to edge_type and count their numbers:
+    # Store all edges in one array, grouped by edge type. Only forward edges are stored,
+    # backwards edges are created by the model (see VarMisuse_Task.reverse_edge_types),
+    # and numbers of incoming edges are computed by the model as well:
     num_edge_types = len(PROGRAM_GRAPH_EDGES_TYPES_VOCAB)
-    # constructs adjacency placeholders
-    adjacency_lists = [np.zeros((0, 2), dtype=np.int32) for _ in range(num_edge_types)]
-    num_incoming_edges_per_type = np.zeros((num_edge_types, num_nodes), dtype=np.uint16)
-    raw_edges = raw_sample['ContextGraph']['Edges']
-
-    # Controls adding back in backwards edges
-    for e_type, e_type_edges in raw_edges.items():
-        if len(e_type_edges) > 0:
-            e_type_bkwd = e_type + BACKWARD_EDGE_TYPE_NAME_SUFFIX
+    type_to_edges = {PROGRAM_GRAPH_EDGES_TYPES_VOCAB[e_type]: e_type_edges
+                     for (e_type, e_type_edges) in raw_sample['ContextGraph']['Edges'].items()
+                     if len(e_type_edges) > 0}
+    num_edges_per_type = np.zeros(shape=(num_edge_types,), dtype=np.int32)
+    for (e_type_idx, e_type_edges) in type_to_edges.items():
+        num_edges_per_type[e_type_idx] = len(e_type_edges)
+    edge_type_offsets = np.zeros(shape=(num_edge_types + 1,), dtype=np.int32)
+    np.cumsum(num_edges_per_type, out=edge_type_offsets[1:])
+    edges = np.empty(shape=(edge_type_offsets[-1], 2), dtype=node_id_dtype)
+    for (e_type_idx, e_type_edges) in type_to_edges.items():
+        edges[edge_type_offsets[e_type_idx]:edge_type_offsets[e_type_idx + 1]] = e_type_edges
+
+    # Edges between nodes and the global node (the slot) are only stored by their sources,
+    # as the edges themselves are created in the model (see make_task_input_model):
+    slot_node_id = raw_sample['SlotDummyNode']
+    global_node_edge_sources = {}  # type: Dict[int, np.ndarray]
+    for e_type, e_type_sources in raw_sample['ContextGraph'].get('GlobalNodeEdges', {}).items():
+        if len(e_type_sources) > 0:
             e_type_idx = PROGRAM_GRAPH_EDGES_TYPES_VOCAB[e_type]
-            e_type_bkwd_idx = PROGRAM_GRAPH_EDGES_TYPES_VOCAB[e_type_bkwd]
-
-            fwd_edges = np.array(e_type_edges, dtype=np.int32)
-            bkwd_edges = np.flip(fwd_edges, axis=1)
-
-            adjacency_lists[e_type_idx] = fwd_edges
-            adjacency_lists[e_type_bkwd_idx] = bkwd_edges
-            num_incoming_edges_per_type[e_type_idx, :] = \
-                np.bincount(adjacency_lists[e_type_idx][:, 1], minlength=num_nodes)
-            num_incoming_edges_per_type[e_type_bkwd_idx, :] = \
-                np.bincount(adjacency_lists[e_type_bkwd_idx][:, 1], minlength=num_nodes)
+            global_node_edge_sources[e_type_idx] = np.array(e_type_sources, dtype=node_id_dtype)
 
-    if add_self_loop_edges:
-        self_loop_edge_type_idx = PROGRAM_GRAPH_EDGES_TYPES_VOCAB[SELF_LOOP_EDGE_NAME]
-        adjacency_lists[self_loop_edge_type_idx] = \
-            np.stack([np.arange(num_nodes), np.arange(num_nodes)], axis=1)
-        num_incoming_edges_per_type[self_loop_edge_type_idx, :] = \
-            np.ones(shape=(num_nodes,))
+    # Self-loop edges (if used) are not materialised, but computed directly by the model
+    # (see VarMisuse_Task.self_loop_edge_type_idx).
 
     # VarMisuse-specific things: Reorder symbol candidates so that correct one is first.
     correct_candidate_id = None
@@ -139,90 +244,412 @@ def _load_single_sample(raw_sample: Dict[str, Any],
     candidate_node_ids_mask = [True] * len(candidate_node_ids) + [False] * num_scope_padding
     candidate_node_ids = candidate_node_ids + [0] * num_scope_padding
 
-    return GraphSample(adjacency_lists=adjacency_lists,
-                       type_to_node_to_num_incoming_edges=num_incoming_edges_per_type,
+    return GraphSample(edges=edges,
+                       edge_type_offsets=edge_type_offsets,
+                       global_node_edge_sources=global_node_edge_sources,
                        unique_labels_as_characters=node_label_chars_unique,
-                       node_labels_to_unique_labels=node_label_chars_indices,
-                       slot_node_id=raw_sample['SlotDummyNode'],
-                       variable_candidate_nodes=np.array(candidate_node_ids),
+                       # There are at most as many unique labels as nodes:
+                       node_labels_to_unique_labels=node_label_chars_indices.reshape(-1).astype(node_id_dtype),
+                       slot_node_id=slot_node_id,
+                       variable_candidate_nodes=np.array(candidate_node_ids, dtype=node_id_dtype),
                        variable_candidate_nodes_mask=np.array(candidate_node_ids_mask),
                        )
 
 
+def _get_cache_dir_for_file(cache_dir: str,
+                            path: RichPath,
+                            graph_node_label_max_num_chars: int,
+                            max_variable_candidates: int,
+                            ) -> str:
+    """
+    Returns:
+        Directory in which the processed samples of the file at path are cached. It
+        depends on the contents of the file and all parameters influencing the samples.
+    """
+    cache_key = hashlib.sha256(path.read_as_binary())
+    cache_key.update(json.dumps({'graph_node_label_max_num_chars': graph_node_label_max_num_chars,
+                                 'max_variable_candidates': max_variable_candidates,
+                                 'edge_types': sorted(PROGRAM_GRAPH_EDGES_TYPES_VOCAB.items()),
+                                 'fields': GraphSample._fields,
+                                 }, sort_keys=True).encode('utf-8'))
+    return os.path.join(cache_dir, cache_key.hexdigest())
+
+
+def _cache_file(path: RichPath,
+                unsplittable_node_names: Set[str],
+                graph_node_label_max_num_chars: int,
+                max_variable_candidates: int,
+                cache_dir: str,
+                ) -> Optional[str]:
+    """
+    Make sure that the processed samples of the file at path are cached.
+
+    Returns:
+        Directory holding the cached samples as a PackedGraphDataset, or None if the
+        file contains no samples.
+    """
+    file_cache_dir = _get_cache_dir_for_file(cache_dir, path, graph_node_label_max_num_chars, max_variable_candidates)
+    if os.path.exists(file_cache_dir):
+        return file_cache_dir
+
+    samples = [_load_single_sample(raw_sample,
+                                   unsplittable_node_names,
+                                   graph_node_label_max_num_chars,
+                                   max_variable_candidates,
+                                   )
+               for raw_sample in path.read_by_file_suffix()]
+    if len(samples) == 0:
+        return None
+
+    # Write to a temporary directory first, so that concurrent runs never see partial results:
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_cache_dir = tempfile.mkdtemp(dir=cache_dir)
+    PackedGraphDataset.pack(samples, GRAPH_SAMPLE_GRAPH_VALUE_FIELDS).save(tmp_cache_dir)
+    try:
+        os.rename(tmp_cache_dir, file_cache_dir)
+    except OSError:  # Another process cached the same file in the meantime
+        shutil.rmtree(tmp_cache_dir, ignore_errors=True)
+    return file_cache_dir
+
+
+def _load_file(path: RichPath,
+               unsplittable_node_names: Set[str],
+               graph_node_label_max_num_chars: int,
+               max_variable_candidates: int,
+               cache_dir: Optional[str] = None,
+               ) -> Iterable[GraphSample]:
+    if cache_dir is not None:
+        file_cache_dir = _cache_file(path,
+                                     unsplittable_node_names,
+                                     graph_node_label_max_num_chars,
+                                     max_variable_candidates,
+                                     cache_dir)
+        if file_cache_dir is not None:
+            yield from PackedGraphDataset.load(file_cache_dir, GraphSample)
+        return
+
+    for raw_sample in path.read_by_file_suffix():
+        yield _load_single_sample(raw_sample,
+                                  unsplittable_node_names,
+                                  graph_node_label_max_num_chars,
+                                  max_variable_candidates,
+                                  )
+
+
 def _data_loading_worker(path_queue: Queue,
                          result_queue: Queue,
                          unsplittable_node_names: Set[str],
                          graph_node_label_max_num_chars: int,
                          max_variable_candidates: int,
-                         add_self_loop_edges: bool,
+                         cache_dir: Optional[str],
+                         chunk_dir: Optional[str],
+                         chunk_size: int,
                          ) -> None:
-    while True:
-        next_path = path_queue.get()
-        if next_path is None:  # Our signal that all files have been processed
-            path_queue.put(None)  # Signal to the other workers
-            result_queue.put(None)  # Signal to the controller that we are done
-            break
-
-        # Read the file and push examples out as soon as we get them:
-        for raw_sample in next_path.read_by_file_suffix():
-            result_queue.put(_load_single_sample(raw_sample,
+    """
+    Process files from path_queue until receiving None. Results are put into result_queue
+    as tuples (file_idx, chunk_idx, chunk, is_last_chunk_of_file, cache_stats), where
+    chunk is either the directory of a cached PackedGraphDataset of a whole file (if
+    cache_dir is set), the directory of a temporary PackedGraphDataset of up to chunk_size
+    samples (saved in chunk_dir otherwise), or None (for files without samples), and
+    cache_stats are the worker's process id and the numbers of hits and misses of its
+    label subtoken cache so far.
+    Only the location of the data is sent between processes, so that its arrays are never
+    pickled and pushed through the result queue.
+    If processing fails, (-1, 0, error_message, True, cache_stats) is put into result_queue.
+    """
+    def put_result(file_idx: int, chunk_idx: int, chunk: Any, is_last_chunk: bool) -> None:
+        cache_info = _get_label_subtokens.cache_info()
+        result_queue.put((file_idx, chunk_idx, chunk, is_last_chunk, (os.getpid(), cache_info.hits, cache_info.misses)))
+
+    def save_chunk(chunk: List[GraphSample]) -> str:
+        chunk_path = tempfile.mkdtemp(dir=chunk_dir)
+        PackedGraphDataset.pack(chunk, GRAPH_SAMPLE_GRAPH_VALUE_FIELDS).save(chunk_path)
+        return chunk_path
+
+    try:
+        while True:
+            work_item = path_queue.get()
+            if work_item is None:  # Our signal that all files have been processed
+                break
+            (file_idx, path) = work_item
+
+            if cache_dir is not None:
+                # The cached arrays are memory-mapped by the consumer, so we only need to pass the location:
+                file_cache_dir = _cache_file(path,
+                                             unsplittable_node_names,
+                                             graph_node_label_max_num_chars,
+                                             max_variable_candidates,
+                                             cache_dir)
+                put_result(file_idx, 0, file_cache_dir, True)
+                continue
+
+            # Read the file and push chunks of examples out as soon as we get them:
+            chunk_idx, chunk = 0, []  # type: int, List[GraphSample]
+            for raw_sample in path.read_by_file_suffix():
+                chunk.append(_load_single_sample(raw_sample,
                                                  unsplittable_node_names,
                                                  graph_node_label_max_num_chars,
                                                  max_variable_candidates,
-                                                 add_self_loop_edges,
                                                  ))
+                if len(chunk) >= chunk_size:
+                    put_result(file_idx, chunk_idx, save_chunk(chunk), False)
+                    chunk_idx, chunk = chunk_idx + 1, []
+            put_result(file_idx, chunk_idx, save_chunk(chunk) if len(chunk) > 0 else None, True)
+    except Exception:
+        put_result(-1, 0, traceback.format_exc(), True)
 
 
 def _load_data(paths: List[RichPath],
                unsplittable_node_names: Set[str],
                graph_node_label_max_num_chars: int,
                max_variable_candidates: int,
-               add_self_loop_edges: bool,
+               cache_dir: Optional[str] = None,
                no_parallel: bool = False,
+               deterministic_order: bool = False,
+               chunk_size: int = 64,
                ) -> Iterable[GraphSample]:
+    """
+    Load samples from the given files, by default using one worker process per CPU.
+
+    Arguments:
+        paths: Files to load samples from.
+        unsplittable_node_names: Node labels that should not be split into subtokens.
+        graph_node_label_max_num_chars: Number of characters of node labels to keep.
+        max_variable_candidates: Number of variable candidates per sample.
+        cache_dir: Optional directory to cache processed samples in.
+        no_parallel: If set, load samples in this process.
+        deterministic_order: If set, samples are produced in the order of paths (and
+            their order in the files), independent of the speed of the workers.
+        chunk_size: Number of samples sent from a worker to the consumer at once.
+
+    Returns:
+        Iterator over samples.
+    """
     if no_parallel:
+        initial_cache_info = _get_label_subtokens.cache_info()
         for path in paths:
-            for raw_sample in path.read_by_file_suffix():
-                yield _load_single_sample(raw_sample,
-                                          unsplittable_node_names,
-                                          graph_node_label_max_num_chars,
-                                          max_variable_candidates,
-                                          add_self_loop_edges,
-                                          )
-
-    path_queue = Queue(maxsize=len(paths) + 1)
-    result_queue = Queue()
-
-    # Set up list of work to do:
-    for path in paths:
-        path_queue.put(path)
-    path_queue.put(None)  # Signal for the end of the queue
+            yield from _load_file(path,
+                                  unsplittable_node_names,
+                                  graph_node_label_max_num_chars,
+                                  max_variable_candidates,
+                                  cache_dir)
+        cache_info = _get_label_subtokens.cache_info()
+        num_cache_hits = cache_info.hits - initial_cache_info.hits
+        num_cache_misses = cache_info.misses - initial_cache_info.misses
+        if num_cache_hits + num_cache_misses > 0:
+            print("  Label subtoken cache: %s." % _format_label_subtokens_cache_stats(num_cache_hits, num_cache_misses))
+        return
+
+    if len(paths) == 0:
+        return
+
+    # All queues are bounded (path queues by only handing out a few files beyond the ones
+    # we are still waiting for), to limit memory use if the consumer is slow.
+    # For deterministic_order, files are assigned to workers round-robin, and each worker has
+    # its own small result queue. We then read the results of each file from the queue of its
+    # worker in order, while the other workers block once their queue is full. Hence, no
+    # results arriving out of order need to be buffered here.
+    num_workers = min(cpu_count(), len(paths))
+    max_num_files_in_flight = 2 * num_workers
+    # Without a cache, workers hand over their chunks in a temporary directory that we delete
+    # each chunk from as soon as we have read it:
+    chunk_dir = tempfile.mkdtemp(prefix="varmisuse_chunks_") if cache_dir is None else None
+    if deterministic_order:
+        path_queues = [Queue() for _ in range(num_workers)]
+        result_queues = [Queue(maxsize=2) for _ in range(num_workers)]
+    else:
+        path_queues = [Queue()]
+        result_queues = [Queue(maxsize=2 * num_workers)]
 
     # Set up workers:
     workers = []
-    for _ in range(cpu_count()):
+    for worker_idx in range(num_workers):
         workers.append(Process(target=_data_loading_worker,
-                               args=(path_queue,
-                                     result_queue,
+                               args=(path_queues[worker_idx % len(path_queues)],
+                                     result_queues[worker_idx % len(result_queues)],
                                      unsplittable_node_names,
                                      graph_node_label_max_num_chars,
                                      max_variable_candidates,
-                                     add_self_loop_edges,
+                                     cache_dir,
+                                     chunk_dir,
+                                     chunk_size,
                                      )))
         workers[-1].start()
 
-    # Consume the data:
-    num_workers_terminated = 0
-    while num_workers_terminated < len(workers):
-        parsed_sample = result_queue.get()
-        if parsed_sample is None:
-            num_workers_terminated += 1  # Worker signaled that it's done
-        else:
-            yield parsed_sample
+    worker_to_cache_stats = {}  # type: Dict[int, Tuple[int, int]]
+
+    def get_next_result(result_queue: Queue) -> Tuple[int, int, Any, bool]:
+        while True:
+            try:
+                result = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if any(not worker.is_alive() and worker.exitcode != 0 for worker in workers):
+                    raise RuntimeError("A VarMisuse data loading worker died unexpectedly.")
+                continue
+            (worker_pid, num_cache_hits, num_cache_misses) = result[4]
+            worker_to_cache_stats[worker_pid] = (num_cache_hits, num_cache_misses)
+            if result[0] < 0:
+                raise RuntimeError("VarMisuse data loading failed:\n%s" % result[2])
+            return result[:4]
+
+    def chunk_to_samples(chunk: Optional[str]) -> Iterable[GraphSample]:
+        if chunk is None:
+            return []
+        if chunk_dir is None:
+            return PackedGraphDataset.load(chunk, GraphSample, use_memmap=True)
+        samples = PackedGraphDataset.load(chunk, GraphSample, use_memmap=False)
+        shutil.rmtree(chunk)
+        return samples
+
+    try:
+        num_dispatched_files, num_finished_files = 0, 0
+        while num_finished_files < len(paths):
+            while num_dispatched_files < len(paths) \
+                    and num_dispatched_files - num_finished_files < max_num_files_in_flight:
+                path_queues[num_dispatched_files % len(path_queues)].put(
+                    (num_dispatched_files, paths[num_dispatched_files]))
+                num_dispatched_files += 1
+                if num_dispatched_files == len(paths):
+                    for worker_idx in range(num_workers):
+                        path_queues[worker_idx % len(path_queues)].put(None)  # Signal for the end of the queue
+
+            # Workers produce the chunks of each file in order, so for deterministic_order, the
+            # next result of the worker of the next file is always the next chunk we need:
+            (file_idx, _, chunk, is_last_chunk) = \
+                get_next_result(result_queues[num_finished_files % len(result_queues)])
+            assert not deterministic_order or file_idx == num_finished_files
+            yield from chunk_to_samples(chunk)
+            num_finished_files += 1 if is_last_chunk else 0
+
+        num_cache_hits = sum(num_hits for (num_hits, _) in worker_to_cache_stats.values())
+        num_cache_misses = sum(num_misses for (_, num_misses) in worker_to_cache_stats.values())
+        if num_cache_hits + num_cache_misses > 0:
+            print("  Label subtoken cache: %s." % _format_label_subtokens_cache_stats(num_cache_hits, num_cache_misses))
+    finally:
+        # Clean up the workers (which are still running if the consumer stopped early or something failed):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        if chunk_dir is not None:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+
+
+def _get_graph_sample_num_bytes(sample: GraphSample) -> int:
+    return sample.edges.nbytes \
+        + sample.edge_type_offsets.nbytes \
+        + sum(sources.nbytes for sources in sample.global_node_edge_sources.values()) \
+        + sample.unique_labels_as_characters.nbytes \
+        + sample.node_labels_to_unique_labels.nbytes \
+        + sample.variable_candidate_nodes.nbytes \
+        + sample.variable_candidate_nodes_mask.nbytes
+
+
+class StreamedGraphSamples(object):
+    """
+    Re-iterable collection of the samples in a list of data files, which are read again
+    on every iteration instead of being held in memory.
+    If shuffling is requested, the order of the files is shuffled, and samples are drawn
+    randomly from a buffer of bounded memory size that is filled from the files.
+    """
+    def __init__(self,
+                 paths: List[RichPath],
+                 load_samples: Callable[[List[RichPath]], Iterable[GraphSample]],
+                 shuffle: bool = False,
+                 shuffle_buffer_size_mb: float = 1024,
+                 ):
+        """
+        Arguments:
+            paths: Data files to read samples from.
+            load_samples: Function producing the samples from a list of data files.
+            shuffle: Flag indicating if the samples should be shuffled.
+            shuffle_buffer_size_mb: Maximal size of the samples held in the shuffle buffer.
+        """
+        self.__paths = paths
+        self.__load_samples = load_samples
+        self.__shuffle = shuffle
+        self.__shuffle_buffer_size_bytes = shuffle_buffer_size_mb * 1024 * 1024
+
+    def __iter__(self) -> Iterator[GraphSample]:
+        if not self.__shuffle:
+            yield from self.__load_samples(self.__paths)
+            return
+
+        paths = list(self.__paths)
+        np.random.shuffle(paths)
+        buffer = []  # type: List[Tuple[GraphSample, int]]
+        buffer_size_bytes = 0
+        for sample in self.__load_samples(paths):
+            sample_size_bytes = _get_graph_sample_num_bytes(sample)
+            buffer.append((sample, sample_size_bytes))
+            buffer_size_bytes += sample_size_bytes
+            while buffer_size_bytes > self.__shuffle_buffer_size_bytes:
+                # Remove a random sample from the buffer, by replacing it with the last one:
+                sample_idx = np.random.randint(len(buffer))
+                (buffer[sample_idx], buffer[-1]) = (buffer[-1], buffer[sample_idx])
+                (sample, sample_size_bytes) = buffer.pop()
+                buffer_size_bytes -= sample_size_bytes
+                yield sample
+
+        np.random.shuffle(buffer)
+        for (sample, _) in buffer:
+            yield sample
+
+
+class LabelEmbeddingCache(object):
+    """
+    Assigns node labels (represented by their characters) to slots in a fixed-size table
+    of label embeddings held by the model, evicting the least recently used labels when
+    the table is full. This allows to only compute embeddings for labels that are not in
+    the table yet.
+    As the table is updated while running the model, batches need to be run in the order
+    in which their slots were assigned.
+    """
+    def __init__(self, size: int):
+        self.__size = size
+        self.__label_to_slot = OrderedDict()  # type: OrderedDict
 
-    # Clean up the workers:
-    for worker in workers:
-        worker.join()
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    def assign_slots(self, unique_labels_as_characters: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Arguments:
+            unique_labels_as_characters: uint8 array of shape [U, C], the (distinct) labels
+                of a batch.
+
+        Returns:
+            Pair of an int32 array of shape [U], the slot of each label in the table, and an
+            int32 array of shape [M], the indices of the labels whose embeddings are not in
+            the table yet (and hence need to be computed and stored in their slots).
+        """
+        num_labels = unique_labels_as_characters.shape[0]
+        if num_labels > self.__size:
+            raise ValueError("Batch has %i distinct labels, but the label embedding cache only holds %i!"
+                             % (num_labels, self.__size))
+
+        label_slots = np.empty(shape=(num_labels,), dtype=np.int32)
+        missing_label_idxs = []
+        label_keys = [label_chars.tobytes() for label_chars in unique_labels_as_characters]
+        for (label_idx, label_key) in enumerate(label_keys):
+            slot = self.__label_to_slot.get(label_key)
+            if slot is None:
+                missing_label_idxs.append(label_idx)
+            else:
+                self.__label_to_slot.move_to_end(label_key)
+                label_slots[label_idx] = slot
+
+        # All labels used in this batch are now at the end, so we never evict one of them:
+        for label_idx in missing_label_idxs:
+            if len(self.__label_to_slot) < self.__size:
+                slot = len(self.__label_to_slot)
+            else:
+                (_, slot) = self.__label_to_slot.popitem(last=False)
+            self.__label_to_slot[label_keys[label_idx]] = slot
+            label_slots[label_idx] = slot
+
+        return label_slots, np.array(missing_label_idxs, dtype=np.int32)
 
 
 class VarMisuse_Task(Sparse_Graph_Task):
@@ -238,7 +665,22 @@ class VarMisuse_Task(Sparse_Graph_Task):
             'max-margin_loss_margin': 0.2,
             'out_layer_dropout_rate': 0.2,
             'add_self_loop_edges': False,
+            'global_node_edge_types': ["Supernode", "Child"],  # Types that may connect nodes to the slot implicitly
             # 'max_num_data_files': 3,
+            # If set, processed samples are cached in this directory, keyed by the contents of
+            # the data files and the parameters influencing preprocessing:
+            'data_cache_dir': None,
+            # If set, samples are loaded in the order of the data files, independent of the speed of
+            # the loading processes:
+            'deterministic_data_loading': False,
+            'data_loading_chunk_size': 64,
+            # If set, training and validation data is not held in memory, but read again in every
+            # epoch. Training samples are shuffled in a buffer of the given size:
+            'streaming_data': False,
+            'streaming_shuffle_buffer_size_mb': 1024,
+            # If > 0, embeddings of up to this many node labels are cached in the model and only
+            # computed for new labels. Only valid if the weights do not change, i.e., not for training:
+            'label_embedding_cache_size': 0,
         })
         return params
 
@@ -259,16 +701,68 @@ class VarMisuse_Task(Sparse_Graph_Task):
                 PROGRAM_GRAPH_EDGES_TYPES_VOCAB[SELF_LOOP_EDGE_NAME] = \
                     len(PROGRAM_GRAPH_EDGES_TYPES_VOCAB)
 
+        # Edge types used by the model, a subset of PROGRAM_GRAPH_EDGES_TYPES_VOCAB. Until we
+        # load data (or restore a model), we use all of them:
+        self.__edge_types_from_metadata = False
+        self.__label_embedding_cache = None  # type: Optional[LabelEmbeddingCache]
+        self.__set_edge_types(sorted(PROGRAM_GRAPH_EDGES_TYPES_VOCAB.keys(), key=PROGRAM_GRAPH_EDGES_TYPES_VOCAB.get))
+
     def get_metadata(self) -> Dict[str, Any]:
         metadata = super().get_metadata()
+        metadata['edge_types'] = self.__edge_types
         return metadata
 
     def restore_from_metadata(self, metadata: Dict[str, Any]) -> None:
         super().restore_from_metadata(metadata)
+        # Models stored before the vocabulary was determined from the data use all edge types:
+        if 'edge_types' in metadata:
+            self.__set_edge_types(metadata['edge_types'])
+            self.__edge_types_from_metadata = True
+
+    def __set_edge_types(self, edge_types: List[str]) -> None:
+        self.__edge_types = list(edge_types)
+        self.__edge_type_to_idx = {e_type: idx for (idx, e_type) in enumerate(self.__edge_types)}
+        # Map from edge type indices used in the model to indices in the loaded GraphSamples:
+        self.__edge_type_vocab_idxs = np.array([PROGRAM_GRAPH_EDGES_TYPES_VOCAB[e_type] for e_type in self.__edge_types],
+                                               dtype=np.int32)
+
+    def __set_edge_types_from_data(self, data: Iterable[GraphSample]) -> None:
+        vocab_idx_to_edge_type = {idx: e_type for (e_type, idx) in PROGRAM_GRAPH_EDGES_TYPES_VOCAB.items()}
+        used_vocab_idxs = set()  # type: Set[int]
+        for graph_sample in data:
+            used_vocab_idxs.update(np.flatnonzero(np.diff(graph_sample.edge_type_offsets)).tolist())
+            used_vocab_idxs.update(graph_sample.global_node_edge_sources.keys())
+
+        used_edge_types = {vocab_idx_to_edge_type[vocab_idx] for vocab_idx in used_vocab_idxs}
+        # Backwards edges are not stored in the data, but created from their forward edges:
+        used_edge_types.update([e_type + BACKWARD_EDGE_TYPE_NAME_SUFFIX for e_type in used_edge_types
+                                if e_type + BACKWARD_EDGE_TYPE_NAME_SUFFIX in PROGRAM_GRAPH_EDGES_TYPES_VOCAB])
+        if self.params.get('add_self_loop_edges'):
+            used_edge_types.add(SELF_LOOP_EDGE_NAME)
+        self.__set_edge_types(sorted(used_edge_types, key=PROGRAM_GRAPH_EDGES_TYPES_VOCAB.get))
+        print(" Using %i edge types: %s" % (len(self.__edge_types), ", ".join(self.__edge_types)))
 
     @property
     def num_edge_types(self) -> int:
-        return len(PROGRAM_GRAPH_EDGES_TYPES_VOCAB)
+        return len(self.__edge_types)
+
+    @property
+    def self_loop_edge_type_idx(self) -> Optional[int]:
+        if self.params.get('add_self_loop_edges'):
+            return self.__edge_type_to_idx[SELF_LOOP_EDGE_NAME]
+        return None
+
+    @property
+    def reverse_edge_types(self) -> Dict[int, int]:
+        return {e_type_idx: self.__edge_type_to_idx[e_type[:-len(BACKWARD_EDGE_TYPE_NAME_SUFFIX)]]
+                for (e_type, e_type_idx) in self.__edge_type_to_idx.items()
+                if e_type.endswith(BACKWARD_EDGE_TYPE_NAME_SUFFIX)}
+
+    @property
+    def global_node_edge_types(self) -> List[str]:
+        # Models trained before implicit global node edges existed have these edges materialised
+        # in their data, and their params do not have this entry:
+        return self.params.get('global_node_edge_types', [])
 
     @property
     def initial_node_feature_size(self) -> int:
@@ -276,6 +770,18 @@ class VarMisuse_Task(Sparse_Graph_Task):
 
     # -------------------- Data Loading --------------------
     def load_data(self, path: RichPath) -> None:
+        if self.params.get('streaming_data'):
+            # Data is read in every epoch (and hence, the set of used edge types is not known
+            # upfront, and we keep using all of them):
+            self._loaded_data[DataFold.TRAIN] = \
+                StreamedGraphSamples(self.__get_data_files(path.join("graphs-train")),
+                                     self.__load_files,
+                                     shuffle=True,
+                                     shuffle_buffer_size_mb=self.params['streaming_shuffle_buffer_size_mb'])
+            self._loaded_data[DataFold.VALIDATION] = \
+                StreamedGraphSamples(self.__get_data_files(path.join("graphs-valid")), self.__load_files)
+            return
+
         # Note that as __load_data produces a generator, we explicitly force loading
         # (and caching) here:
         self._loaded_data[DataFold.TRAIN] = \
@@ -283,28 +789,45 @@ class VarMisuse_Task(Sparse_Graph_Task):
         self._loaded_data[DataFold.VALIDATION] = \
             list(self.__load_data(path.join("graphs-valid"), DataFold.VALIDATION))
 
+        # Only create the model for edge types that actually appear in the data (unless we are
+        # continuing to use a stored model):
+        if not self.__edge_types_from_metadata:
+            self.__set_edge_types_from_data(self._loaded_data[DataFold.TRAIN] + self._loaded_data[DataFold.VALIDATION])
+
+        for data_fold in (DataFold.TRAIN, DataFold.VALIDATION):
+            self._loaded_data[data_fold] = \
+                self._pack_graphs(self._loaded_data[data_fold], data_fold,
+                                  graph_value_fields=GRAPH_SAMPLE_GRAPH_VALUE_FIELDS)
+
     def load_eval_data_from_path(self, path: RichPath) -> Iterable[Any]:
         if path.path == self.default_data_path():
             path = path.join("graphs-test")
         return iter(self.__load_data(path, DataFold.TEST))
 
     def __load_data(self, data_dir: RichPath, data_fold: DataFold) -> Iterator[GraphSample]:
+        return self.__load_files(self.__get_data_files(data_dir))
+
+    def __get_data_files(self, data_dir: RichPath) -> List[RichPath]:
         all_data_files = data_dir.iterate_filtered_files_in_dir("*.gz")
 
         max_num_files = self.params.get('max_num_data_files', None)
         if max_num_files is not None:
             all_data_files = sorted(all_data_files)[:max_num_files]
         else:
-            all_data_files = list(all_data_files)
+            all_data_files = sorted(all_data_files)
         print(" Loading VarMisuse data from %s [%i data files]." % (data_dir, len(all_data_files)))
+        return all_data_files
 
+    def __load_files(self, data_files: List[RichPath]) -> Iterator[GraphSample]:
         # this is used for
         unsplittable_keywords = get_language_keywords('csharp')
-        return _load_data(all_data_files,
+        return _load_data(data_files,
                           unsplittable_keywords,
                           self.params['graph_node_label_max_num_chars'],
                           self.params['max_variable_candidates'],
-                          self.params['add_self_loop_edges'])
+                          cache_dir=self.params.get('data_cache_dir'),
+                          deterministic_order=self.params.get('deterministic_data_loading', False),
+                          chunk_size=self.params.get('data_loading_chunk_size', 64))
 
     # -------------------- Model Construction --------------------
     def make_task_input_model(self,
@@ -313,59 +836,87 @@ class VarMisuse_Task(Sparse_Graph_Task):
                               ) -> None:
         node_label_char_length = self.params['graph_node_label_max_num_chars']
         placeholders['unique_labels_as_characters'] = \
-            tf.placeholder(dtype=tf.int32, shape=[None, node_label_char_length], name='unique_labels_as_characters')
+            tf.placeholder(dtype=tf.uint8, shape=[None, node_label_char_length], name='unique_labels_as_characters')
         placeholders['node_labels_to_unique_labels'] = \
             tf.placeholder(dtype=tf.int32, shape=[None], name='node_labels_to_unique_labels')
-        placeholders['adjacency_lists'] = \
-            [tf.placeholder(dtype=tf.int32, shape=[None, 2], name='adjacency_e%s' % e)
-                for e in range(self.num_edge_types)]
-        placeholders['type_to_num_incoming_edges'] = \
-            tf.placeholder(dtype=tf.float32, shape=[self.num_edge_types, None], name='type_to_num_incoming_edges')
-
+        placeholders['graph_nodes_list'] = \
+            tf.placeholder(dtype=tf.int32, shape=[None], name='graph_nodes_list')
+        placeholders['slot_node_ids'] = \
+            tf.placeholder(dtype=tf.int32, shape=[None], name='slot_node_ids')
+        placeholders['global_node_edge_sources'] = \
+            [tf.placeholder(dtype=tf.int32, shape=[None], name='global_node_edge_sources_%s' % e_type)
+             for e_type in self.global_node_edge_types]
+
+        unique_label_representations = \
+            self.__get_label_charcnn_embeddings(placeholders['unique_labels_as_characters'])  # Shape [U, D]
+        if self.params.get('label_embedding_cache_size', 0) > 0:
+            self.__label_embedding_cache = LabelEmbeddingCache(self.params['label_embedding_cache_size'])
+            unique_label_representations = \
+                self.__add_label_embedding_cache(placeholders, unique_label_representations)
         model_ops['initial_node_features'] = \
-            self.__get_node_label_charcnn_embeddings(placeholders['unique_labels_as_characters'],
-                                                     placeholders['node_labels_to_unique_labels'])
-        model_ops['adjacency_lists'] = placeholders['adjacency_lists']
-        model_ops['type_to_num_incoming_edges'] = placeholders['type_to_num_incoming_edges']
-
-    def __get_node_label_charcnn_embeddings(self,
-                                            unique_labels_as_characters: tf.Tensor,
-                                            node_labels_to_unique_labels: tf.Tensor,
-                                            ) -> tf.Tensor:
+            tf.gather(params=unique_label_representations,
+                      indices=placeholders['node_labels_to_unique_labels'])  # Shape [V, D]
+        model_ops['adjacency_lists'] = self._make_adjacency_lists_input(placeholders)
+        # Numbers of incoming edges are not stored in the data, but always computed here:
+        model_ops['type_to_num_incoming_edges'] = \
+            self._compute_num_incoming_edges(model_ops['adjacency_lists'],
+                                             num_nodes=tf.shape(placeholders['graph_nodes_list'], out_type=tf.int32)[0])
+        # Edges to the slot node are only fed as the list of their sources, and handled by the GraphStructure:
+        model_ops['global_node_edge_sources'] = \
+            {self.__edge_type_to_idx[e_type]: e_type_sources
+             for (e_type, e_type_sources) in zip(self.global_node_edge_types, placeholders['global_node_edge_sources'])
+             if e_type in self.__edge_type_to_idx}
+        model_ops['graph_nodes_list'] = placeholders['graph_nodes_list']
+        model_ops['global_node_ids'] = placeholders['slot_node_ids']
+
+    def __get_label_charcnn_embeddings(self, unique_labels_as_characters: tf.Tensor) -> tf.Tensor:
         """
         Compute representation of node labels using a 2-layer character CNN.
 
         Args:
-            unique_labels_as_characters: int32 tensor of shape [U, C]
+            unique_labels_as_characters: uint8 tensor of shape [U, C]
                 representing the unique (node) labels occurring in a
                 batch, where U is the number of such labels and C the
                 maximal number of characters.
-            node_labels_to_unique_labels: int32 tensor of shape [V],
-                mapping each node in the batch to one of the unique
-                labels.
 
         Returns:
-            float32 tensor of shape [V, D] representing embedded node
-            label information about each node.
+            float32 tensor of shape [U, D] representing embedded
+            label information about each unique label.
         """
         label_embedding_size = self.params['graph_node_label_representation_size']  # D
         # U ~ num unique labels
         # C ~ num characters (self.params['graph_node_label_max_num_chars'])
         # A ~ num characters in alphabet
-        unique_label_chars_one_hot = tf.one_hot(indices=unique_labels_as_characters,
-                                                depth=len(ALPHABET),
-                                                axis=-1)  # Shape: [U, C, A]
 
         # Choose kernel sizes such that there is a single value at the end:
         char_conv_l1_kernel_size = 5 # updated: original was 5
         char_conv_l2_kernel_size = \
             self.params['graph_node_label_max_num_chars'] - 2 * (char_conv_l1_kernel_size - 1)
 
-        char_conv_l1 = \
+        # The first convolution layer would run on one-hot encoded characters of shape [U, C, A].
+        # Instead, we only use it to hold the weights (with unchanged names and shapes, so that
+        # stored models can still be loaded), and look up the kernel slice of each character:
+        #   conv(one_hot(x))[u, t, :] = \sum_j kernel[j, x[u, t + j], :] + bias
+        char_conv_l1_layer = \
             tf.keras.layers.Conv1D(filters=16,
                                    kernel_size=char_conv_l1_kernel_size,
                                    activation=tf.nn.leaky_relu,
-                                   )(unique_label_chars_one_hot)  # Shape: [U, C - (char_conv_l1_kernel_size - 1), 16]
+                                   )
+        with tf.name_scope(char_conv_l1_layer.name):
+            char_conv_l1_layer.build(tf.TensorShape([None, self.params['graph_node_label_max_num_chars'], len(ALPHABET)]))
+        # The one-hot encoding maps the ids >= A (ALPHABET_DICT uses ids up to A + 1) to all-zero
+        # vectors, so these get all-zero kernel slices:
+        char_conv_l1_kernel = \
+            tf.pad(char_conv_l1_layer.kernel,
+                   paddings=[[0, 0], [0, len(ALPHABET_DICT) - len(ALPHABET)], [0, 0]])  # Shape: [char_conv_l1_kernel_size, A + 2, 16]
+        unique_label_chars = tf.cast(unique_labels_as_characters, dtype=tf.int32)  # Shape: [U, C]
+        num_char_conv_l1_windows = self.params['graph_node_label_max_num_chars'] - (char_conv_l1_kernel_size - 1)
+        char_conv_l1_kernel_slices = \
+            [tf.gather(params=char_conv_l1_kernel[kernel_offset],
+                       indices=unique_label_chars[:, kernel_offset:kernel_offset + num_char_conv_l1_windows])
+             for kernel_offset in range(char_conv_l1_kernel_size)]  # List of tensors of shape [U, C - (char_conv_l1_kernel_size - 1), 16]
+        char_conv_l1 = char_conv_l1_layer.activation(
+            tf.add_n(char_conv_l1_kernel_slices) + char_conv_l1_layer.bias)  # Shape: [U, C - (char_conv_l1_kernel_size - 1), 16]
         char_pool_l1 = \
             tf.keras.layers.MaxPool1D(pool_size=char_conv_l1_kernel_size,
                                       strides=1,
@@ -376,16 +927,49 @@ class VarMisuse_Task(Sparse_Graph_Task):
                                    activation=tf.nn.leaky_relu,
                                    )(char_pool_l1)                # Shape: [U, 1, D]
         unique_label_representations = tf.squeeze(char_conv_l2, axis=1)  # Shape: [U, D]
-        node_label_representations = tf.gather(params=unique_label_representations,
-                                               indices=node_labels_to_unique_labels)
-        return node_label_representations
+        return unique_label_representations
+
+    def __add_label_embedding_cache(self,
+                                    placeholders: Dict[str, tf.Tensor],
+                                    computed_label_representations: tf.Tensor,
+                                    ) -> tf.Tensor:
+        """
+        Store computed label representations in the label embedding table, and look up the
+        representations of all labels of the batch in it (see LabelEmbeddingCache).
+
+        Args:
+            placeholders: Dictionary of placeholders, to be extended with the slots of
+                labels in the table.
+            computed_label_representations: float32 tensor of shape [M, D], the
+                representations of the labels that were not in the table yet.
+
+        Returns:
+            float32 tensor of shape [U, D], the representations of all unique labels
+            of the batch.
+        """
+        placeholders['label_embedding_cache_slots'] = \
+            tf.placeholder(dtype=tf.int32, shape=[None], name='label_embedding_cache_slots')
+        placeholders['computed_label_embedding_cache_slots'] = \
+            tf.placeholder(dtype=tf.int32, shape=[None], name='computed_label_embedding_cache_slots')
+        with tf.variable_scope("label_embedding_cache"):
+            label_embedding_table = \
+                tf.get_variable(name='label_embeddings',
+                                shape=[self.__label_embedding_cache.size,
+                                       self.params['graph_node_label_representation_size']],
+                                dtype=tf.float32,
+                                initializer=tf.zeros_initializer,
+                                trainable=False)
+            updated_label_embedding_table = \
+                tf.scatter_update(label_embedding_table,
+                                  placeholders['computed_label_embedding_cache_slots'],
+                                  computed_label_representations)
+            return tf.gather(params=updated_label_embedding_table,
+                             indices=placeholders['label_embedding_cache_slots'])  # Shape [U, D]
 
     def make_task_output_model(self,
                                placeholders: Dict[str, tf.Tensor],
                                model_ops: Dict[str, tf.Tensor],
                                ) -> None:
-        placeholders['slot_node_ids'] = \
-            tf.placeholder(dtype=tf.int32, shape=[None], name='slot_node_ids')
         placeholders['candidate_node_ids'] = \
             tf.placeholder(dtype=tf.int32, shape=[None, None], name='candidate_node_ids')
         placeholders['candidate_node_ids_mask'] = \
@@ -468,88 +1052,110 @@ class VarMisuse_Task(Sparse_Graph_Task):
                                 model_placeholders: Dict[str, tf.Tensor],
                                 max_nodes_per_batch: int) \
             -> Iterable[MinibatchData]:
-        if data_fold == DataFold.TRAIN:
-            np.random.shuffle(data)
+        if data_fold == DataFold.TRAIN and self.__label_embedding_cache is not None:
+            raise ValueError("The label embedding cache cannot be used for training, as it assumes fixed weights!")
 
-        if isinstance(data, Iterator):
-            data_iter = data
+        if isinstance(data, (Iterator, StreamedGraphSamples)):
+            # Streamed data is already shuffled while it is read:
+            data_iter = iter(data)
+        elif data_fold == DataFold.TRAIN:
+            data_iter = (data[graph_idx] for graph_idx in np.random.permutation(len(data)))
         else:
             data_iter = iter(data)
 
-        def init_raw_batch_data_holder() -> Dict[str, Any]:
-            return {
-                'adj_lists': [[] for _ in range(self.num_edge_types)],
-                'type_to_num_in_edges': [],
-                'uniq_labels_as_chars': [],
-                'node_labels_to_uniq_labels': [],
-                'slot_node_ids': [],
-                'candidate_node_ids': [],
-                'candidate_node_ids_mask': [],
-                'num_graphs': 0,
-                'node_offset': 0,
-                'unique_label_offset': 0,
-            }
-
-        def finalise_batch_data(raw_batch_data: Dict[str, Any]) -> MinibatchData:
+        reversed_edge_types = set(self.reverse_edge_types.values())
+        # GraphSamples are indexed by PROGRAM_GRAPH_EDGES_TYPES_VOCAB, which includes types the model does not use:
+        edge_type_vocab_idxs = self.__edge_type_vocab_idxs
+        unused_vocab_idxs = sorted(set(PROGRAM_GRAPH_EDGES_TYPES_VOCAB.values()) - set(edge_type_vocab_idxs))
+        vocab_idx_to_edge_type = {idx: e_type for (e_type, idx) in PROGRAM_GRAPH_EDGES_TYPES_VOCAB.items()}
+        global_node_edge_type_idxs = [PROGRAM_GRAPH_EDGES_TYPES_VOCAB[e_type]
+                                      for e_type in self.global_node_edge_types]
+
+        def finalise_batch_data(batch: BatchAssembler) -> MinibatchData:
+            # Labels are only unique per graph, so deduplicate them again over the whole batch:
+            (unique_labels_as_chars, graph_unique_labels_to_unique_labels) = \
+                _deduplicate_rows(batch.get_values('uniq_labels_as_chars'))
+            node_labels_to_unique_labels = \
+                graph_unique_labels_to_unique_labels[batch.get_values('node_labels_to_uniq_labels', dtype=np.int32)]
             batch_feed_dict = {
-                model_placeholders['unique_labels_as_characters']: np.concatenate(raw_batch_data['uniq_labels_as_chars'], axis=0),
-                model_placeholders['node_labels_to_unique_labels']: np.concatenate(raw_batch_data['node_labels_to_uniq_labels'], axis=0),
-                model_placeholders['type_to_num_incoming_edges']: np.concatenate(raw_batch_data['type_to_num_in_edges'], axis=1),
-                model_placeholders['slot_node_ids']: raw_batch_data['slot_node_ids'],
-                model_placeholders['candidate_node_ids']: raw_batch_data['candidate_node_ids'],
-                model_placeholders['candidate_node_ids_mask']: raw_batch_data['candidate_node_ids_mask'],
+                model_placeholders['node_labels_to_unique_labels']: node_labels_to_unique_labels.astype(np.int32),
+                model_placeholders['graph_nodes_list']: batch.get_graph_nodes_list(),
+                model_placeholders['slot_node_ids']: batch.get_values('slot_node_ids', dtype=np.int32),
+                model_placeholders['candidate_node_ids']: batch.get_values('candidate_node_ids', dtype=np.int32),
+                model_placeholders['candidate_node_ids_mask']: batch.get_values('candidate_node_ids_mask', dtype=np.float32),
             }
 
+            if self.__label_embedding_cache is None:
+                batch_feed_dict[model_placeholders['unique_labels_as_characters']] = unique_labels_as_chars
+            else:
+                # Only compute embeddings of labels that are not in the cache yet:
+                (label_slots, missing_label_idxs) = self.__label_embedding_cache.assign_slots(unique_labels_as_chars)
+                batch_feed_dict[model_placeholders['unique_labels_as_characters']] = \
+                    unique_labels_as_chars[missing_label_idxs]
+                batch_feed_dict[model_placeholders['label_embedding_cache_slots']] = label_slots
+                batch_feed_dict[model_placeholders['computed_label_embedding_cache_slots']] = \
+                    label_slots[missing_label_idxs]
+
             if data_fold == DataFold.TRAIN:
                 model_placeholders['out_layer_dropout_rate'] = self.params['out_layer_dropout_rate']
 
-            # Merge adjacency lists:
-            num_edges = 0
-            for i in range(self.num_edge_types):
-                if len(raw_batch_data['adj_lists'][i]) > 0:
-                    adj_list = np.concatenate(raw_batch_data['adj_lists'][i])
-                else:
-                    adj_list = np.zeros((0, 2), dtype=np.int32)
-                num_edges += adj_list.shape[0]
-                batch_feed_dict[model_placeholders['adjacency_lists'][i]] = adj_list
+            # Merge adjacency lists (backwards edges are created in the model):
+            num_edges_per_type = self._add_graph_structure_to_feed_dict(batch_feed_dict, model_placeholders, batch)
+            num_edges = sum(num_type_edges * (2 if i in reversed_edge_types else 1)
+                            for (i, num_type_edges) in enumerate(num_edges_per_type))
+
+            for (i, e_type) in enumerate(self.global_node_edge_types):
+                global_node_edge_sources = batch.get_values('global_node_edge_sources_%s' % e_type, dtype=np.int32)
+                num_edges += 2 * global_node_edge_sources.shape[0]  # Forward and backward edges
+                batch_feed_dict[model_placeholders['global_node_edge_sources'][i]] = global_node_edge_sources
 
             return MinibatchData(feed_dict=batch_feed_dict,
-                                 num_graphs=raw_batch_data['num_graphs'],
-                                 num_nodes=raw_batch_data['node_offset'],
+                                 num_graphs=batch.num_graphs,
+                                 num_nodes=batch.num_nodes,
                                  num_edges=num_edges)
 
         try:
-            cur_batch_data = init_raw_batch_data_holder()
+            cur_batch = self._make_batch_assembler()
             while True:
                 cur_graph = next(data_iter)
+                num_nodes_in_graph = len(cur_graph.node_labels_to_unique_labels)
                 # We pack until we cannot fit more graphs in the batch, yield, and continue:
-                if cur_batch_data['node_offset'] + len(cur_graph.node_labels_to_unique_labels) >= max_nodes_per_batch:
-                    yield finalise_batch_data(cur_batch_data)
-                    cur_batch_data = init_raw_batch_data_holder()
+                if cur_batch.num_nodes + num_nodes_in_graph >= max_nodes_per_batch:
+                    yield finalise_batch_data(cur_batch)
+                    cur_batch = self._make_batch_assembler()
 
                 # Graph structure:
-                for i in range(self.num_edge_types):
-                    cur_batch_data['adj_lists'][i].append(cur_graph.adjacency_lists[i] + cur_batch_data['node_offset'])
-                cur_batch_data['type_to_num_in_edges'].append(cur_graph.type_to_node_to_num_incoming_edges)
+                for vocab_idx in unused_vocab_idxs:
+                    if cur_graph.edge_type_offsets[vocab_idx + 1] > cur_graph.edge_type_offsets[vocab_idx] \
+                            or vocab_idx in cur_graph.global_node_edge_sources:
+                        raise ValueError("Data contains edges of type %s, which is not used by the model!"
+                                         % vocab_idx_to_edge_type[vocab_idx])
+                for e_type_idx in cur_graph.global_node_edge_sources.keys():
+                    if e_type_idx not in global_node_edge_type_idxs:
+                        raise ValueError("Data contains implicit global node edges of type %i, which is not in global_node_edge_types!"
+                                         % e_type_idx)
+                node_offset = \
+                    cur_batch.add_graph(num_nodes_in_graph,
+                                        [cur_graph.get_edges_of_type(vocab_idx) for vocab_idx in edge_type_vocab_idxs])
+                for (e_type, e_type_idx) in zip(self.global_node_edge_types, global_node_edge_type_idxs):
+                    e_type_sources = cur_graph.global_node_edge_sources.get(e_type_idx)
+                    if e_type_sources is not None:
+                        cur_batch.add_values('global_node_edge_sources_%s' % e_type, e_type_sources, offset=node_offset)
 
                 # Node labels:
-                cur_batch_data['uniq_labels_as_chars'].append(cur_graph.unique_labels_as_characters)
-                cur_batch_data['node_labels_to_uniq_labels'].append(
-                    cur_graph.node_labels_to_unique_labels + cur_batch_data['unique_label_offset'])
-                cur_batch_data['unique_label_offset'] += cur_graph.unique_labels_as_characters.shape[0]
+                cur_batch.add_values('node_labels_to_uniq_labels',
+                                     cur_graph.node_labels_to_unique_labels,
+                                     offset=cur_batch.num_values('uniq_labels_as_chars'))
+                cur_batch.add_values('uniq_labels_as_chars', cur_graph.unique_labels_as_characters)
 
                 # VarMisuse task bits:
-                cur_batch_data['slot_node_ids'].append(cur_graph.slot_node_id + cur_batch_data['node_offset'])
-                cur_batch_data['candidate_node_ids'].append(cur_graph.variable_candidate_nodes + cur_batch_data['node_offset'])
-                cur_batch_data['candidate_node_ids_mask'].append(cur_graph.variable_candidate_nodes_mask)
-
-                # Finally, update the offset we use to shift things during batch construction:
-                cur_batch_data['num_graphs'] += 1
-                cur_batch_data['node_offset'] += len(cur_graph.node_labels_to_unique_labels)
+                cur_batch.add_values('slot_node_ids', cur_graph.slot_node_id, offset=node_offset)
+                cur_batch.add_graph_value('candidate_node_ids', cur_graph.variable_candidate_nodes, offset=node_offset)
+                cur_batch.add_graph_value('candidate_node_ids_mask', cur_graph.variable_candidate_nodes_mask)
         except StopIteration:
             # Final batch, yield only if non-empty:
-            if cur_batch_data['num_graphs'] > 0:
-                yield finalise_batch_data(cur_batch_data)
+            if cur_batch.num_graphs > 0:
+                yield finalise_batch_data(cur_batch)
 
     def early_stopping_metric(self, task_metric_results: List[Dict[str, np.ndarray]], num_graphs: int) -> float:
         # Early stopping based on accuracy; as we are trying to minimize, negate it:
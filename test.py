@@ -10,6 +10,7 @@ Options:
     -h --help                       Show this screen.
     --result-dir DIR                Directory to store logfiles and trained models. [default: trained_models]
     --azure-info PATH               Azure authentication information file (JSON). [default: azure_auth.json]
+    --label-embedding-cache-size N  Cache embeddings of up to N node labels (VarMisuse only). [default: 0]
     --quiet                         Show less output.
     --debug                         Turn on debugger.
 """
@@ -22,8 +23,12 @@ from dpu_utils.utils import run_and_debug, RichPath
 from utils.model_utils import restore
 
 
-def test(model_path: str, test_data_path: Optional[RichPath], result_dir: str, quiet: bool = False, run_id: str = None):
-    model = restore(model_path, result_dir, run_id)
+def test(model_path: str, test_data_path: Optional[RichPath], result_dir: str, quiet: bool = False, run_id: str = None,
+         label_embedding_cache_size: int = 0):
+    task_param_overrides = {}
+    if label_embedding_cache_size > 0:
+        task_param_overrides['label_embedding_cache_size'] = label_embedding_cache_size
+    model = restore(model_path, result_dir, run_id, task_param_overrides=task_param_overrides)
     model.params['max_nodes_in_batch'] = 2 * model.params['max_nodes_in_batch']  # We can process larger batches if we don't do training
     test_data_path = test_data_path or RichPath.create(model.task.default_data_path())
     model.log_line(" Using the following task params: %s" % json.dumps(model.task.params))
@@ -38,7 +43,8 @@ def run(args):
     if test_data_path is not None:
         test_data_path = RichPath.create(test_data_path, azure_info_path)
     result_dir = args.get('--result-dir', 'trained_models')
-    test(model_path, test_data_path, result_dir, quiet=args.get('--quiet'))
+    test(model_path, test_data_path, result_dir, quiet=args.get('--quiet'),
+         label_embedding_cache_size=int(args.get('--label-embedding-cache-size') or 0))
 
 
 if __name__ == "__main__":
@@ -1 +1,2 @@
-from .utils import SMALL_NUMBER, BIG_NUMBER, get_gated_unit, get_aggregation_function, get_activation, MLP, micro_f1
+from .utils import SMALL_NUMBER, BIG_NUMBER, get_gated_unit, get_aggregation_function, get_linear_aggregation_normalizer, \
+    sum_linear_messages_per_target, get_activation, MLP, EdgeTypeLinearLayers, micro_f1
@@ -1,6 +1,6 @@
 import os
 import time
-from typing import Tuple, Type, Dict, Any
+from typing import Tuple, Type, Dict, Any, Optional
 
 import pickle
 
@@ -55,7 +55,11 @@ def name_to_model_class(name: str) -> Tuple[Type[Sparse_Graph_Model], Dict[str,
     raise ValueError("Unknown model type '%s'" % name)
 
 
-def restore(saved_model_path: str, result_dir: str, run_id: str = None) -> Sparse_Graph_Model:
+def restore(saved_model_path: str,
+            result_dir: str,
+            run_id: str = None,
+            task_param_overrides: Optional[Dict[str, Any]] = None,
+            ) -> Sparse_Graph_Model:
     print("Loading model from file %s." % saved_model_path)
     with open(saved_model_path, 'rb') as in_file:
         data_to_load = pickle.load(in_file)
@@ -68,6 +72,8 @@ def restore(saved_model_path: str, result_dir: str, run_id: str = None) -> Spars
 
     task = task_cls(data_to_load['task_params'])
     task.restore_from_metadata(data_to_load['task_metadata'])
+    if task_param_overrides is not None:
+        task.params.update(task_param_overrides)
 
     model = model_cls(data_to_load['model_params'], task, run_id, result_dir)
     model.load_weights(data_to_load['weights'])
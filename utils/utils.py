@@ -33,6 +33,95 @@ def get_aggregation_function(aggregation_fun: Optional[str]):
         raise ValueError("Unknown aggregation function '%s'!" % aggregation_fun)
 
 
+def get_linear_aggregation_normalizer(aggregation_fun: Optional[str]) \
+        -> Optional[Callable[[tf.Tensor, tf.Tensor], tf.Tensor]]:
+    """
+    Aggregation functions such as sum and mean are linear in the messages, and can hence
+    be computed from per-node sums of messages and the per-node number of messages. This
+    allows to aggregate messages before applying (linear) transformations to them.
+
+    Arguments:
+        aggregation_fun: Name of the aggregation function, as in get_aggregation_function.
+
+    Returns:
+        None if the aggregation function is not linear (e.g., max). Otherwise, a function
+        mapping a float32 tensor of shape [V, D] of per-node message sums and a float32
+        tensor of shape [V] of per-node message counts to the aggregated messages.
+    """
+    if aggregation_fun in ['sum', 'unsorted_segment_sum']:
+        return lambda message_sums, num_messages: message_sums
+    if aggregation_fun in ['mean', 'unsorted_segment_mean']:
+        return lambda message_sums, num_messages: \
+            message_sums / tf.expand_dims(tf.maximum(num_messages, 1.0), axis=-1)
+    if aggregation_fun in ['sqrt_n', 'unsorted_segment_sqrt_n']:
+        return lambda message_sums, num_messages: \
+            message_sums / tf.expand_dims(tf.sqrt(tf.maximum(num_messages, 1.0)), axis=-1)
+    if aggregation_fun in ['max', 'unsorted_segment_max']:
+        return None
+    else:
+        raise ValueError("Unknown aggregation function '%s'!" % aggregation_fun)
+
+
+def sum_linear_messages_per_target(node_states: tf.Tensor,
+                                   edge_sources: tf.Tensor,
+                                   edge_targets: tf.Tensor,
+                                   num_nodes: tf.Tensor,
+                                   message_transformation: Callable[[tf.Tensor], tf.Tensor],
+                                   target_scaling_factors: Optional[tf.Tensor] = None,
+                                   ) -> tf.Tensor:
+    """
+    Compute \sum_{(u, v) \in E} c_v * (W * h_u) for all nodes v, where W is a linear map.
+    As W is linear, this is the same as c_v * W * (\sum_{(u, v) \in E} h_u), and we choose
+    per batch which is cheaper: if there are more edges than nodes, we sum up the source
+    states per target node first (by a sparse matrix product, without gathering them per
+    edge) and apply W once per node; otherwise, we gather the source states per edge, apply
+    W once per edge and sum up the results.
+
+    Arguments:
+        node_states: float32 tensor of shape [V, D], the states h of all nodes.
+        edge_sources: int32 tensor of shape [E], the source node of each edge.
+        edge_targets: int32 tensor of shape [E], the target node of each edge.
+        num_nodes: int32 scalar, the number of nodes V.
+        message_transformation: Linear function (without bias) mapping [N, D] to [N, H].
+        target_scaling_factors: Optional float32 tensor of shape [V], holding the factors c_v.
+
+    Returns:
+        float32 tensor of shape [V, H]
+    """
+    num_edges = tf.shape(edge_targets, out_type=tf.int32)[0]
+    aggregate_first = tf.greater(num_edges, num_nodes)
+
+    def sum_source_states_per_node():
+        num_nodes_int64 = tf.cast(num_nodes, dtype=tf.int64)
+        adjacency_matrix = \
+            tf.SparseTensor(indices=tf.cast(tf.stack([edge_targets, edge_sources], axis=1), dtype=tf.int64),
+                            values=tf.ones_like(edge_targets, dtype=tf.float32),
+                            dense_shape=tf.stack([num_nodes_int64, num_nodes_int64]))  # Shape [V, V]
+        return tf.sparse.sparse_dense_matmul(adjacency_matrix, node_states)  # Shape [V, D]
+
+    def gather_source_states_per_edge():
+        return tf.gather(params=node_states, indices=edge_sources)  # Shape [E, D]
+
+    transformation_inputs = \
+        tf.cond(aggregate_first, sum_source_states_per_node, gather_source_states_per_edge)  # Shape [V, D] or [E, D]
+    transformed_states = message_transformation(transformation_inputs)  # Shape [V, H] or [E, H]
+
+    def sum_transformed_per_node():
+        if target_scaling_factors is None:
+            return transformed_states
+        return tf.expand_dims(target_scaling_factors, axis=-1) * transformed_states
+
+    def sum_transformed_per_edge():
+        messages = transformed_states
+        if target_scaling_factors is not None:
+            messages = tf.expand_dims(tf.gather(params=target_scaling_factors, indices=edge_targets), axis=-1) * messages
+        return tf.unsorted_segment_sum(data=messages,
+                                       segment_ids=edge_targets,
+                                       num_segments=num_nodes)
+
+    return tf.cond(aggregate_first, sum_transformed_per_node, sum_transformed_per_edge)  # Shape [V, H]
+
+
 def get_activation(activation_fun: Optional[str]):
     if activation_fun is None:
         return None
@@ -124,3 +213,169 @@ class MLP(object):
                 activations = tf.nn.dropout(activations, rate=self.__dropout_rate)
                 activations = layer(activations)
             return self.__layers[-1](activations)
+
+    def call_with_split_input(self, input_parts: List[tf.Tensor], part_indices: List[tf.Tensor]) -> tf.Tensor:
+        """
+        Apply the MLP to tf.concat([tf.gather(input_parts[i], part_indices[i]) | i], axis=-1),
+        without necessarily materialising this concatenation.
+        For this, we split the kernel of the first layer into slices W_i, one per input part,
+        as W * [x_1 || x_2] = W_1 * x_1 + W_2 * x_2. If the input parts have fewer rows than
+        the indices (e.g., input parts are per-node states and indices are per-edge), we apply
+        W_i to each input part before gathering, and otherwise gather and concatenate first.
+        If dropout is applied to the MLP input, we always fall back to the concatenation.
+
+        Arguments:
+            input_parts: List of float32 tensors of shape [N_i, D_i].
+            part_indices: List of int32 tensors of shape [E], selecting rows from the
+                corresponding input part.
+
+        Returns:
+            float32 tensor of shape [E, out_size]
+        """
+        first_layer = self.__layers[0]
+        has_input_dropout = len(self.__layers) > 1 \
+            and (isinstance(self.__dropout_rate, tf.Tensor) or self.__dropout_rate > 0.0)
+        if has_input_dropout:
+            return self(tf.concat([tf.gather(params=input_part, indices=indices)
+                                   for (input_part, indices) in zip(input_parts, part_indices)],
+                                  axis=-1))
+
+        part_dims = [input_part.shape[-1].value for input_part in input_parts]
+        with tf.variable_scope(self.__name):
+            # Make sure that the first layer exists, with the kernel for the concatenated input:
+            if not first_layer.built:
+                first_layer(tf.zeros(shape=[0, sum(part_dims)]))
+
+            part_kernels = []  # type: List[tf.Tensor]
+            part_offset = 0
+            for part_dim in part_dims:
+                part_kernels.append(first_layer.kernel[part_offset:part_offset + part_dim, :])  # Shape [D_i, H]
+                part_offset += part_dim
+
+            def transform_then_gather():
+                return tf.add_n([tf.gather(params=tf.matmul(input_part, part_kernel), indices=indices)
+                                 for (input_part, part_kernel, indices) in zip(input_parts, part_kernels, part_indices)])
+
+            def gather_then_transform():
+                return tf.matmul(tf.concat([tf.gather(params=input_part, indices=indices)
+                                            for (input_part, indices) in zip(input_parts, part_indices)],
+                                           axis=-1),
+                                 first_layer.kernel)
+
+            # Compare sum_i N_i * D_i with E * sum_i D_i to decide what's cheaper:
+            per_part_cost = tf.add_n([tf.shape(input_part)[0] * part_dim
+                                      for (input_part, part_dim) in zip(input_parts, part_dims)])
+            per_index_cost = tf.shape(part_indices[0])[0] * sum(part_dims)
+            activations = tf.cond(per_part_cost < per_index_cost,
+                                  transform_then_gather,
+                                  gather_then_transform)  # Shape [E, H]
+            if first_layer.use_bias:
+                activations += first_layer.bias
+            if first_layer.activation is not None:
+                activations = first_layer.activation(activations)
+
+            if len(self.__layers) == 1:
+                return activations
+            for layer in self.__layers[1:-1]:
+                activations = tf.nn.dropout(activations, rate=self.__dropout_rate)
+                activations = layer(activations)
+            return self.__layers[-1](activations)
+
+
+class EdgeTypeLinearLayers(object):
+    def __init__(self,
+                 num_edge_types: int,
+                 units: int,
+                 num_bases: Optional[int] = None,
+                 name: str = "Weight",
+                 ):
+        """
+        Create linear layers W_\ell (without bias), one per edge type \ell.
+        If num_bases is set, these are decomposed into shared bases as in R-GCN (Schlichtkrull
+        et al., https://arxiv.org/pdf/1703.06103.pdf, Eq. (3)): W_\ell = \sum_b a_{\ell,b} V_b.
+        Then, W_\ell * x = \sum_b a_{\ell,b} * (V_b * x), which allows to compute the B basis
+        transformations once and mix them cheaply per edge type.
+
+        Arguments:
+            num_edge_types: Number L of edge types.
+            units: Dimensionality H of outputs.
+            num_bases: Optional number B of bases. If None, separate weights are used per type.
+            name: Name of the layers. Separate weights are named "Edge_%i_{name}", bases and
+                coefficients "Edge_{name}_Bases" and "Edge_{name}_Basis_Coefficients".
+        """
+        self.__num_edge_types = num_edge_types
+        self.__units = units
+        self.__num_bases = num_bases
+        if num_bases is None:
+            self.__layers = [tf.keras.layers.Dense(units=units,
+                                                   use_bias=False,
+                                                   activation=None,
+                                                   name="Edge_%i_%s" % (edge_type_idx, name))
+                             for edge_type_idx in range(num_edge_types)]  # type: List[tf.keras.layers.Dense]
+        else:
+            # All bases in one layer, with kernel of shape [D, B * H]:
+            self.__bases = tf.keras.layers.Dense(units=num_bases * units,
+                                                 use_bias=False,
+                                                 activation=None,
+                                                 name="Edge_%s_Bases" % name)
+            self.__basis_coefficients = tf.get_variable(shape=(num_edge_types, num_bases),
+                                                        name="Edge_%s_Basis_Coefficients" % name)  # Shape [L, B]
+
+    @property
+    def num_bases(self) -> Optional[int]:
+        return self.__num_bases
+
+    def transform(self, inputs: tf.Tensor, edge_type_idx: int) -> tf.Tensor:
+        """
+        Arguments:
+            inputs: float32 tensor of shape [N, D].
+            edge_type_idx: Index of the edge type \ell.
+
+        Returns:
+            float32 tensor of shape [N, H], W_\ell * inputs.
+        """
+        if self.__num_bases is None:
+            return self.__layers[edge_type_idx](inputs)
+        basis_outputs = tf.reshape(self.__bases(inputs), shape=(-1, self.__num_bases, self.__units))  # Shape [N, B, H]
+        return tf.einsum('nbh,b->nh', basis_outputs, self.__basis_coefficients[edge_type_idx])
+
+    def transform_all_types(self, inputs: tf.Tensor) -> List[tf.Tensor]:
+        """
+        Arguments:
+            inputs: float32 tensor of shape [N, D].
+
+        Returns:
+            List of L float32 tensors of shape [N, H], W_\ell * inputs for all edge types \ell.
+        """
+        if self.__num_bases is None:
+            return [layer(inputs) for layer in self.__layers]
+        basis_outputs = tf.reshape(self.__bases(inputs), shape=(-1, self.__num_bases, self.__units))  # Shape [N, B, H]
+        outputs = tf.einsum('nbh,lb->lnh', basis_outputs, self.__basis_coefficients)  # Shape [L, N, H]
+        return tf.unstack(outputs, num=self.__num_edge_types)
+
+    def sum_over_types(self, per_type_inputs: List[tf.Tensor]) -> tf.Tensor:
+        """
+        Arguments:
+            per_type_inputs: List of L float32 tensors x_\ell of shape [N, D].
+
+        Returns:
+            float32 tensor of shape [N, H], \sum_\ell W_\ell * x_\ell. With bases, this is
+            computed as \sum_b V_b * (\sum_\ell a_{\ell,b} x_\ell), i.e., by a single matmul.
+        """
+        if self.__num_bases is None:
+            return tf.add_n([layer(inputs) for (layer, inputs) in zip(self.__layers, per_type_inputs)])
+
+        input_dim = per_type_inputs[0].shape[-1].value
+        # Make sure that the bases exist, so that we can access their kernel:
+        if not self.__bases.built:
+            self.__bases(tf.zeros(shape=[0, input_dim]))
+
+        basis_inputs = tf.einsum('lnd,lb->nbd',
+                                 tf.stack(per_type_inputs, axis=0),
+                                 self.__basis_coefficients)  # Shape [N, B, D]
+        stacked_bases = \
+            tf.reshape(tf.transpose(tf.reshape(self.__bases.kernel, shape=(input_dim, self.__num_bases, self.__units)),
+                                    perm=(1, 0, 2)),
+                       shape=(self.__num_bases * input_dim, self.__units))  # Shape [B * D, H]
+        return tf.matmul(tf.reshape(basis_inputs, shape=(-1, self.__num_bases * input_dim)),
+                         stacked_bases)  # Shape [N, H]